@@ -0,0 +1,71 @@
+# encoding=utf-8
+"""
+YoloV5 --box_fusion wbf: 逐张图片的numpy weighted_boxes_fusion和整个batch的weighted_boxes_fusion_torch的耗时对比.
+
+Usage:
+    python benchmarks/box_fusion.py --batch_size 8 --num_boxes 2000 --device cuda:0
+
+"""
+import argparse
+import os
+import sys
+import time
+
+import numpy as np
+import torch
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+
+def make_batch(batch_size, num_boxes, num_classes, seed=0):
+    # 检测框集中在少数物体附近, 和模型的输出类似
+    rng = np.random.RandomState(seed)
+    centers = rng.rand(batch_size, 30, 2) * 0.8 + 0.1
+    index = rng.randint(0, 30, (batch_size, num_boxes))
+    xy = np.take_along_axis(centers, index[..., None], 1) + rng.randn(batch_size, num_boxes, 2) * 0.01
+    wh = rng.rand(batch_size, num_boxes, 2) * 0.1 + 0.05
+    boxes = np.concatenate([xy - wh / 2, xy + wh / 2], 2).clip(0, 1).astype(np.float32)
+    scores = rng.rand(batch_size, num_boxes).astype(np.float32)
+    labels = (index + rng.randint(0, 3, (batch_size, num_boxes))) % num_classes
+    return boxes, scores, labels
+
+
+def run_numpy(boxes, scores, labels, iou_thr):
+    from utils.ensemble_boxes import weighted_boxes_fusion
+    return [weighted_boxes_fusion([boxes[i]], [scores[i]], [labels[i]], iou_thr=iou_thr) for i in range(len(boxes))]
+
+
+def run_torch(boxes, scores, labels, iou_thr, device):
+    from utils.ensemble_boxes import weighted_boxes_fusion_torch
+    from utils.ensemble_boxes.ensemble_boxes_torch import batch_to_numpy
+    boxes, scores, labels = [torch.from_numpy(x).to(device) for x in (boxes, scores, labels)]
+    return batch_to_numpy(*weighted_boxes_fusion_torch(boxes, scores, labels, iou_thr=iou_thr))
+
+
+def timeit(fn, repeat):
+    fn()  # warmup
+    start = time.perf_counter()
+    for _ in range(repeat):
+        fn()
+    return (time.perf_counter() - start) / repeat
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--batch_size', type=int, default=8)
+    parser.add_argument('--num_boxes', type=int, default=1000, help='boxes of every image after the conf_thresh filter')
+    parser.add_argument('--num_classes', type=int, default=80)
+    parser.add_argument('--iou_thr', type=float, default=0.5)
+    parser.add_argument('--device', type=str, default='cuda:0' if torch.cuda.is_available() else 'cpu')
+    parser.add_argument('--repeat', type=int, default=5)
+    args = parser.parse_args()
+    sys.argv = sys.argv[:1]  # utils会导入options, options在导入时解析sys.argv
+
+    boxes, scores, labels = make_batch(args.batch_size, args.num_boxes, args.num_classes)
+
+    t_numpy = timeit(lambda: run_numpy(boxes, scores, labels, args.iou_thr), args.repeat)
+    t_torch = timeit(lambda: run_torch(boxes, scores, labels, args.iou_thr, args.device), args.repeat)
+
+    print(f'batch_size={args.batch_size} num_boxes={args.num_boxes} num_classes={args.num_classes} device={args.device}')
+    print(f'numpy, per image:   {t_numpy * 1000:8.1f} ms/batch')
+    print(f'torch, whole batch: {t_torch * 1000:8.1f} ms/batch ({t_numpy / t_torch:.1f}x)')
@@ -1,53 +1,76 @@
 import torch
 import numpy as np
 
-def voc_to_yolo_format(sample, opt):
+MAX_YOLO_BOXES = 50  # yolo_boxes和yolo4_boxes固定50个bbox
+
+# 每个模型训练时用到的target格式, 不在这里的模型不需要yolo格式
+yolo_formats = {
+    'Yolo2': ['yolo_boxes'],
+    'Yolo3': ['yolo_boxes'],
+    'Yolo4': ['yolo4_boxes'],
+    'Yolo5': ['yolo5_boxes'],
+}
+
+
+def voc_to_yolo_format(sample, opt, formats=None):
     """Convert voc to yolo format
 
+    Only the formats consumed by the active model (--model) are built.
+
     Args:
         sample(dict): {
             'bboxes': bboxes,  # xyxy format, origin size, [N, 4]
             'labels': labels,  # labels, [N]
         }
         opt: options
+        formats(list(str)): formats to build, default: yolo_formats[opt.model]
 
     Returns:
         {   'yolo_boxes': yolo_boxes,
             'yolo4_boxes': yolo4_boxes,
             'yolo5_boxes': yolo5_boxes
-        }
+        }  (only keys in formats)
 
     """
+    if formats is None:
+        formats = yolo_formats.get(opt.model, [])
 
-    width = opt.width
-    height = opt.height
-
-    yolo_boxes = np.zeros([50, 5])
-    yolo4_boxes = np.zeros([50, 5])
-
-    yolo5_boxes = np.zeros([len(sample['bboxes']), 5])
-    # sample['bboxes'] = torch.Tensor(sample['bboxes'])
+    target = {}
+    if not formats:
+        return target
 
     bboxes = sample['bboxes']
     labels = sample['labels']
-    for i, bbox in enumerate(bboxes):
-        x1, y1, x2, y2 = bbox
-        w, h = x2 - x1, y2 - y1
-        c_x, c_y = x1 + w / 2, y1 + h / 2
-        w, c_x = w / width, c_x / width
-        h, c_y = h / height, c_y / height
+    if isinstance(bboxes, torch.Tensor):
+        bboxes = bboxes.detach().cpu().numpy()
+    if isinstance(labels, torch.Tensor):
+        labels = labels.detach().cpu().numpy()
 
-        if i < yolo5_boxes.shape[0]:
-            yolo5_boxes[i, :] = labels[i], c_x, c_y, w, h  # 中心点坐标、宽、高
+    bboxes = np.asarray(bboxes, dtype=np.float64).reshape([-1, 4])
+    labels = np.asarray(labels, dtype=np.float64).reshape([-1])
 
-        if i < 50:
-            yolo_boxes[i, :] = labels[i], c_x, c_y, w, h  # 中心点坐标、宽、高
-            yolo4_boxes[i, :] = x1, y1, x2, y2, labels[i]
+    if 'yolo_boxes' in formats or 'yolo5_boxes' in formats:
+        wh = bboxes[:, 2:] - bboxes[:, :2]
+        c_xy = bboxes[:, :2] + wh / 2
+        scale = np.array([opt.width, opt.height], dtype=np.float64)
 
-    target = {}
-    target['yolo_boxes'] = torch.Tensor(yolo_boxes).view([-1])  # labels, c_x, c_y, w, h (固定50×5)
-    target['yolo4_boxes'] = torch.Tensor(yolo4_boxes)
-    target['yolo5_boxes'] = torch.Tensor(yolo5_boxes)  #labels, c_x, c_y, w, h (没有固定的bbox数量)
+        # labels, c_x, c_y, w, h (中心点坐标、宽、高)
+        yolo5_boxes = np.concatenate([labels[:, None], c_xy / scale, wh / scale], axis=1)
 
-    return target
+        if 'yolo_boxes' in formats:
+            yolo_boxes = np.zeros([MAX_YOLO_BOXES, 5])
+            n = min(len(yolo5_boxes), MAX_YOLO_BOXES)
+            yolo_boxes[:n] = yolo5_boxes[:n]
+            target['yolo_boxes'] = torch.Tensor(yolo_boxes).view([-1])  # labels, c_x, c_y, w, h (固定50×5)
 
+        if 'yolo5_boxes' in formats:
+            target['yolo5_boxes'] = torch.Tensor(yolo5_boxes)  # labels, c_x, c_y, w, h (没有固定的bbox数量)
+
+    if 'yolo4_boxes' in formats:
+        yolo4_boxes = np.zeros([MAX_YOLO_BOXES, 5])
+        n = min(len(bboxes), MAX_YOLO_BOXES)
+        yolo4_boxes[:n, :4] = bboxes[:n]
+        yolo4_boxes[:n, 4] = labels[:n]
+        target['yolo4_boxes'] = torch.Tensor(yolo4_boxes)  # x1, y1, x2, y2, labels (固定50×5)
+
+    return target
@@ -8,6 +8,7 @@ from pycocotools.coco import COCO
 import cv2
 
 from dataloader.additional import voc_to_yolo_format
+from dataloader.image_cache import read_image
 
 def coco_90_to_80_classes(id):
     m = [0,1,2,3,4,5,6,7,8,9,10,11,0,12,13,14,15,16,17,18,19,20,21,22,23,24,0,
@@ -20,16 +21,19 @@ def coco_90_to_80_classes(id):
 class CocoDataset(Dataset):
     """Coco dataset."""
 
-    def __init__(self, root_dir, set_name, transforms=None):
+    def __init__(self, root_dir, set_name, transforms=None, image_cache=None):
         """
         Args:
             root_dir (string): COCO directory.
             transforms (callable, optional): Optional transforms to be applied
                 on a sample.
+            image_cache (ImageCache, optional): cache of decoded uint8 images,
+                see dataloader/image_cache.py
         """
         self.root_dir = root_dir
         self.set_name = set_name
         self.transforms = transforms
+        self.image_cache = image_cache
 
         self.coco = COCO(os.path.join(self.root_dir, 'annotations', 'instances_' + self.set_name + '.json'))
         self.image_ids = self.coco.getImgIds()
@@ -59,8 +63,11 @@ class CocoDataset(Dataset):
 
     def __getitem__(self, idx):
 
-        img, path = self.load_image(idx)
+        img, path, (scale_x, scale_y) = self.load_image(idx)
         annot = self.load_annotations(idx)
+        if scale_x != 1. or scale_y != 1.:  # 缓存的图片是缩小过的
+            annot[:, 0:4:2] *= scale_x
+            annot[:, 1:4:2] *= scale_y
         bboxes = annot[:, :4]
         labels = annot[:, 4]
 
@@ -78,6 +85,7 @@ class CocoDataset(Dataset):
         sample['bboxes']= torch.Tensor(sample['bboxes'])
         sample['labels']= torch.Tensor(sample['labels'])
         sample['path'] = path
+        sample['org_size'] = (img.shape[1], img.shape[0])  # 变换前的图片尺寸, --rect_eval时把bbox映射回这个尺寸
 
         sample.update(voc_to_yolo_format(sample, opt))  # yolo format
 
@@ -86,14 +94,17 @@ class CocoDataset(Dataset):
     def load_image(self, image_index):
         image_info = self.coco.loadImgs(self.image_ids[image_index])[0]
         path = os.path.join(self.root_dir, self.set_name, image_info['file_name'])
-        img = cv2.imread(path)
-        img = cv2.cvtColor(img, cv2.COLOR_BGR2RGB)
+
+        if self.image_cache is not None:
+            img, scale = self.image_cache.load(path, (image_info['width'], image_info['height']))
+        else:
+            img, scale = read_image(path), (1., 1.)
 
         #
         # if len(img.shape) == 2:
         #     img = skimage.color.gray2rgb(img)
 
-        return img.astype(np.float32)/255.0 , path
+        return img.astype(np.float32)/255.0 , path, scale
 
     def load_annotations(self, image_index):
         # get ground truth annotations
@@ -134,5 +145,9 @@ class CocoDataset(Dataset):
         image = self.coco.loadImgs(self.image_ids[image_index])[0]
         return float(image['width']) / float(image['height'])
 
+    def aspect_ratios(self):
+        """[N] width / height of every image, read from the annotation json without decoding images."""
+        return np.array([self.image_aspect_ratio(i) for i in range(len(self))])
+
     def num_classes(self):
         return 80
@@ -6,6 +6,8 @@ from dataloader.transforms import get_transform
 
 from dataloader.voc import VOCTrainValDataset
 from dataloader.coco import CocoDataset
+from dataloader.image_cache import get_image_cache
+from dataloader.samplers import AspectRatioBatchSampler, SortedAspectRatioBatchSampler
 import albumentations as A
 from albumentations.pytorch.transforms import ToTensorV2
 
@@ -26,7 +28,7 @@ t = transform()
 
 dataset_variables = ['voc_root', 'train_split', 'val_split', 'class_names', 'img_format', 'data_format']
 
-transform_variables = ['width', 'height', 'train_transform', 'val_transform']
+transform_variables = ['width', 'height', 'train_transform', 'val_transform', 'rect_val_transform', 'cache_min_side']
 
 for v in dataset_variables:
     # 等价于 exec(f'{v}=d.{v}')
@@ -44,65 +46,143 @@ opt.num_classes = len(class_names)
 opt.width = width
 opt.height = height
 
+if opt.rect_eval:
+    if not hasattr(t, 'rect_val_transform'):
+        raise Exception(f'--rect_eval is not supported by transform "{opt.transform}".')
+    val_transform = rect_val_transform
+
+if not hasattr(t, 'cache_min_side'):
+    cache_min_side = max(width, height)  # 缓存的图片短边缩放到transform的工作尺寸
+
+
+if opt.collate_targets:
+    from network import get_collate_targets
+    collate_targets = get_collate_targets(opt.model)  # 训练用的targets在worker里算好
+else:
+    collate_targets = None
+
+
+PAD_DIVISOR = 32
+
+
+def pad_batch(images, divisor=PAD_DIVISOR):
+    """Stack [3, h_i, w_i] images into [b, 3, H, W], padding at the bottom and right.
+
+    H and W are the largest height and width in the batch, rounded up to ``divisor``.
+    bboxes are not changed by padding at the bottom and right.
+    """
+    shapes = set(image.shape for image in images)
+    if len(shapes) == 1:
+        return torch.stack(images)
+
+    c = images[0].shape[0]
+    h = max(image.shape[1] for image in images)
+    w = max(image.shape[2] for image in images)
+    h = (h + divisor - 1) // divisor * divisor
+    w = (w + divisor - 1) // divisor * divisor
+
+    batch = images[0].new_zeros([len(images), c, h, w])
+    for i, image in enumerate(images):
+        batch[i, :, :image.shape[1], :image.shape[2]] = image
+
+    return batch
+
 
 def collate_fn(batch):
     target = {}
     b = len(batch)
-    target['image'] = torch.stack([sample['image'] for sample in batch])
+    target['image'] = pad_batch([sample['image'] for sample in batch])  # 尺寸不同的图片pad到batch内最大的尺寸
     target['bboxes'] = [sample['bboxes'] for sample in batch]
     target['labels'] = [sample['labels'] for sample in batch]
     target['path'] = [sample['path'] for sample in batch]
-    target['yolo_boxes'] = torch.stack([sample['yolo_boxes'] for sample in batch])
-    target['yolo4_boxes'] = torch.stack([sample['yolo4_boxes'] for sample in batch])
-    target['yolo5_boxes'] = torch.cat(  # [b*50, 6] batch中第几张图片, label, c_x, c_y, w, h
-                                [torch.cat([torch.ones([batch[i]['yolo5_boxes'].shape[0], 1]) * i,
-                                batch[i]['yolo5_boxes']], 1) for i in range(b)], 0)
+    target['org_size'] = [sample['org_size'] for sample in batch]  # (w, h) 变换前
+    target['image_size'] = [(sample['image'].shape[2], sample['image'].shape[1]) for sample in batch]  # (w, h) pad前
+
+    # 只有当前模型用到的yolo格式才会出现在sample里
+    if 'yolo_boxes' in batch[0]:
+        target['yolo_boxes'] = torch.stack([sample['yolo_boxes'] for sample in batch])
+    if 'yolo4_boxes' in batch[0]:
+        target['yolo4_boxes'] = torch.stack([sample['yolo4_boxes'] for sample in batch])
+    if 'yolo5_boxes' in batch[0]:
+        target['yolo5_boxes'] = torch.cat(  # [b*50, 6] batch中第几张图片, label, c_x, c_y, w, h
+                                    [torch.cat([torch.ones([batch[i]['yolo5_boxes'].shape[0], 1]) * i,
+                                    batch[i]['yolo5_boxes']], 1) for i in range(b)], 0)
+
+    return target
+
+
+def train_collate_fn(batch):
+    target = collate_fn(batch)
+    if collate_targets is not None:
+        target = collate_targets(target)  # 只有训练需要targets, 验证集用collate_fn
     return target
 
 """
 Datasets
 """
+image_cache = get_image_cache(opt.cache_images, opt.dataset, opt.cache_budget, cache_min_side)
+
 if data_format == 'VOC':
     if hasattr(d, 'train_split'):
         train_dataset = VOCTrainValDataset(voc_root, 
                 class_names,
                 split=train_split,
                 format=img_format,
-                transforms=train_transform)
+                transforms=train_transform,
+                num_workers=opt.anno_workers,
+                image_cache=image_cache)
 
     if hasattr(d, 'val_split'):
         val_dataset = VOCTrainValDataset(voc_root,
                 class_names,
                 split=val_split,
                 format=img_format,
-                transforms=val_transform)
+                transforms=val_transform,
+                num_workers=opt.anno_workers,
+                image_cache=image_cache)
 
 elif data_format == 'COCO':
     if hasattr(d, 'train_split'):
-        train_dataset = CocoDataset(voc_root, train_split, transforms=train_transform)
+        train_dataset = CocoDataset(voc_root, train_split, transforms=train_transform, image_cache=image_cache)
 
     if hasattr(d, 'val_split'):
-        val_dataset = CocoDataset(voc_root, val_split, transforms=val_transform)
+        val_dataset = CocoDataset(voc_root, val_split, transforms=val_transform, image_cache=image_cache)
 
 """
 Dataloaders
 """
-if hasattr(d, 'train_split'):
+if hasattr(d, 'train_split') and opt.aspect_ratio_group:
+    # 长宽比相近的图片组成一个batch, 减少pad的像素
+    train_dataloader = torch.utils.data.DataLoader(train_dataset,
+        batch_sampler=AspectRatioBatchSampler(train_dataset.aspect_ratios(), opt.batch_size, shuffle=True, drop_last=True),
+        collate_fn=train_collate_fn,
+        num_workers=opt.workers,
+        persistent_workers=opt.cache_images == 'ram' and opt.workers > 0)
+elif hasattr(d, 'train_split'):
     train_dataloader = torch.utils.data.DataLoader(train_dataset,
         shuffle=True,
-        collate_fn=collate_fn,
+        collate_fn=train_collate_fn,
         batch_size=opt.batch_size,
         num_workers=opt.workers,
+        persistent_workers=opt.cache_images == 'ram' and opt.workers > 0,  # 每个worker的内存缓存在epoch之间保留
         drop_last=True)
 else:
     train_dataloader = None
 
-if hasattr(d, 'val_split'):
+if hasattr(d, 'val_split') and opt.rect_eval:
+    # 按长宽比排序, 每个batch只pad到32的倍数
+    val_dataloader = torch.utils.data.DataLoader(val_dataset,
+        batch_sampler=SortedAspectRatioBatchSampler(val_dataset.aspect_ratios(), opt.batch_size),
+        collate_fn=collate_fn,
+        num_workers=opt.workers // 2,
+        persistent_workers=opt.cache_images == 'ram' and opt.workers // 2 > 0)
+elif hasattr(d, 'val_split'):
     val_dataloader = torch.utils.data.DataLoader(val_dataset,
         shuffle=False,
         collate_fn=collate_fn,
         batch_size=opt.batch_size,
         num_workers=opt.workers // 2,
+        persistent_workers=opt.cache_images == 'ram' and opt.workers // 2 > 0,
         drop_last=False)
 else:
     val_dataloader = None
\ No newline at end of file
@@ -0,0 +1,168 @@
+# encoding=utf-8
+import os
+import hashlib
+from collections import OrderedDict
+
+import numpy as np
+import cv2
+
+
+def read_image(path):
+    """Decode an image to an uint8 RGB array."""
+    image = cv2.imread(path)
+    if image is None:
+        raise FileNotFoundError(f'{path} not found.')
+    return cv2.cvtColor(image, cv2.COLOR_BGR2RGB)
+
+
+class ImageCache(object):
+    """Base class of decoded image caches.
+
+    Images are kept as uint8 (4x smaller than float32), downscaled so that their short side is
+    ``min_side`` (images are never upscaled). Converting to float is left to the dataset.
+
+    Args:
+        min_side(int): short side of cached images, 0 keeps the original resolution
+
+    """
+    def __init__(self, min_side=0):
+        self.min_side = min_side
+
+    def get(self, key):
+        raise NotImplementedError
+
+    def put(self, key, image):
+        raise NotImplementedError
+
+    def resize(self, image):
+        h, w = image.shape[:2]
+        if not self.min_side or min(h, w) <= self.min_side:
+            return image
+
+        scale = self.min_side / min(h, w)
+        return cv2.resize(image, (round(w * scale), round(h * scale)), interpolation=cv2.INTER_AREA)
+
+    def load(self, path, org_size):
+        """Load a decoded image through the cache.
+
+        Args:
+            path(str): image path
+            org_size(tuple): (width, height) in the annotations, bboxes are relative to this size
+
+        Returns:
+            tuple: (image, (scale_x, scale_y))
+
+            image: uint8 RGB array
+            (scale_x, scale_y): multiply bboxes by these to match the returned image
+
+        """
+        w0, h0 = org_size
+        image = self.get(path)
+
+        if image is None:
+            image = read_image(path)
+            h, w = image.shape[:2]
+            if (w, h) != (w0, h0):  # 标注里的尺寸和图片不一致, 不缓存也不缩放
+                return image, (1., 1.)
+
+            image = self.resize(image)
+            self.put(path, image)
+
+        h, w = image.shape[:2]
+        return image, (w / w0, h / h0)
+
+
+class RamImageCache(ImageCache):
+    """LRU cache of decoded images in memory.
+
+    Every DataLoader worker holds its own cache, so ``budget`` is per process and the
+    dataloaders need ``persistent_workers=True`` to keep the caches between epochs.
+
+    Args:
+        budget(int): maximum bytes of cached pixels
+        min_side(int): short side of cached images, 0 keeps the original resolution
+
+    """
+    def __init__(self, budget, min_side=0):
+        super(RamImageCache, self).__init__(min_side)
+        self.budget = budget
+        self.nbytes = 0
+        self._images = OrderedDict()
+
+    def get(self, key):
+        image = self._images.get(key)
+        if image is not None:
+            self._images.move_to_end(key)
+        return image
+
+    def put(self, key, image):
+        if image.nbytes > self.budget or key in self._images:
+            return
+
+        while self.nbytes + image.nbytes > self.budget:
+            _, evicted = self._images.popitem(last=False)
+            self.nbytes -= evicted.nbytes
+
+        self._images[key] = image
+        self.nbytes += image.nbytes
+
+
+class DiskImageCache(ImageCache):
+    """Decoded images stored as .npy files and read back with ``mmap_mode='r'``.
+
+    The file name is derived from the image path, its size and mtime, so a changed image is
+    decoded again. Files are written to a temporary name and renamed, workers can fill the
+    cache concurrently.
+
+    Args:
+        cache_dir(str): dir to save decoded images
+        min_side(int): short side of cached images, 0 keeps the original resolution
+
+    """
+    def __init__(self, cache_dir, min_side=0):
+        super(DiskImageCache, self).__init__(min_side)
+        self.cache_dir = cache_dir
+        os.makedirs(cache_dir, exist_ok=True)
+
+    def _file(self, key):
+        st = os.stat(key)
+        name = hashlib.md5(f'{os.path.abspath(key)}:{st.st_size}:{st.st_mtime_ns}'.encode('utf-8')).hexdigest()
+        return os.path.join(self.cache_dir, f'{name}.npy')
+
+    def get(self, key):
+        cache_file = self._file(key)
+        if not os.path.isfile(cache_file):
+            return None
+        try:
+            return np.load(cache_file, mmap_mode='r')
+        except (IOError, ValueError):
+            return None
+
+    def put(self, key, image):
+        cache_file = self._file(key)
+        tmp_file = f'{cache_file[:-4]}.tmp{os.getpid()}.npy'
+        np.save(tmp_file, np.ascontiguousarray(image))
+        os.replace(tmp_file, cache_file)
+
+
+def get_image_cache(mode, name, budget=8, min_side=0):
+    """Create the image cache selected by --cache_images.
+
+    Args:
+        mode(str): None, 'ram' or 'disk'
+        name(str): dataset name, used as the dir name of the disk cache
+        budget(float): GB of memory per process for the 'ram' cache
+        min_side(int): short side of cached images, 0 keeps the original resolution
+
+    Returns:
+        ImageCache or None
+
+    """
+    if mode is None:
+        return None
+    elif mode == 'ram':
+        return RamImageCache(int(budget * 1024 ** 3), min_side=min_side)
+    elif mode == 'disk':
+        return DiskImageCache(os.path.join('.cache', f'{name}_images_{min_side}'), min_side=min_side)
+    else:
+        raise Exception('No such image cache: "%s", available: {ram|disk}.' % mode)
@@ -0,0 +1,90 @@
+# encoding=utf-8
+import math
+from collections import defaultdict
+
+import numpy as np
+import torch
+from torch.utils.data.sampler import Sampler
+
+# 长宽比(w/h)分组的边界, 竖图、方图、横图各自组成batch
+ASPECT_RATIO_BINS = (0.5, 0.75, 1.0, 4 / 3, 2.0)
+
+
+class AspectRatioBatchSampler(Sampler):
+    """Batch sampler which only puts images of similar aspect ratio in the same batch.
+
+    Images are bucketed by ``np.digitize(aspect_ratio, bins)``. Indices are drawn in random
+    order and a batch is yielded as soon as one bucket is full. Indices left in partially
+    filled buckets at the end of an epoch are sorted by aspect ratio and batched together,
+    so every image is still seen once per epoch.
+
+    Args:
+        aspect_ratios(array): [N] width / height of every image of the dataset
+        batch_size(int): batch size
+        shuffle(bool): draw indices in random order
+        drop_last(bool): drop the last incomplete batch
+        bins(tuple): bucket boundaries of aspect ratios
+
+    Example:
+        batch_sampler = AspectRatioBatchSampler(dataset.aspect_ratios(), opt.batch_size, drop_last=True)
+        dataloader = DataLoader(dataset, batch_sampler=batch_sampler, collate_fn=collate_fn)
+
+    """
+    def __init__(self, aspect_ratios, batch_size, shuffle=True, drop_last=False, bins=ASPECT_RATIO_BINS):
+        self.aspect_ratios = np.asarray(aspect_ratios, dtype=np.float64)
+        self.group_ids = np.digitize(self.aspect_ratios, bins)
+        self.batch_size = batch_size
+        self.shuffle = shuffle
+        self.drop_last = drop_last
+
+    def __iter__(self):
+        n = len(self.group_ids)
+        order = torch.randperm(n).tolist() if self.shuffle else range(n)
+
+        buffers = defaultdict(list)
+        for idx in order:
+            group = self.group_ids[idx]
+            buffers[group].append(idx)
+            if len(buffers[group]) == self.batch_size:
+                yield buffers[group]
+                buffers[group] = []
+
+        # 剩下不满一个batch的, 按长宽比排序后拼成batch
+        rest = sorted((idx for buffer in buffers.values() for idx in buffer), key=lambda idx: self.aspect_ratios[idx])
+        for i in range(0, len(rest), self.batch_size):
+            batch = rest[i: i + self.batch_size]
+            if len(batch) < self.batch_size and self.drop_last:
+                break
+            yield batch
+
+    def __len__(self):
+        counts = np.bincount(self.group_ids)
+        full = int((counts // self.batch_size).sum())
+        rest = int((counts % self.batch_size).sum())
+
+        if self.drop_last:
+            return full + rest // self.batch_size
+        return full + math.ceil(rest / self.batch_size)
+
+
+class SortedAspectRatioBatchSampler(Sampler):
+    """Batch sampler for evaluation, images are sorted by aspect ratio and batched in that order.
+
+    Images in a batch have similar shapes, so padding each batch to its largest image
+    (see ``pad_batch`` in dataloader/dataloaders.py) wastes few pixels.
+
+    Args:
+        aspect_ratios(array): [N] width / height of every image of the dataset
+        batch_size(int): batch size
+
+    """
+    def __init__(self, aspect_ratios, batch_size):
+        self.order = np.argsort(np.asarray(aspect_ratios, dtype=np.float64), kind='stable').tolist()
+        self.batch_size = batch_size
+
+    def __iter__(self):
+        for i in range(0, len(self.order), self.batch_size):
+            yield self.order[i: i + self.batch_size]
+
+    def __len__(self):
+        return math.ceil(len(self.order) / self.batch_size)
@@ -48,3 +48,18 @@ class FRCNN(object):
             label_fields=['labels']
         )
     )
+
+    # --rect_eval, 不pad成正方形, 由collate_fn按batch pad到32的倍数
+    rect_val_transform = A.Compose(
+        [
+            A.SmallestMaxSize(short_side, p=1.0),  # resize到短边600
+            ToTensorV2(p=1.0),
+        ],
+        p=1.0,
+        bbox_params=A.BboxParams(
+            format='pascal_voc',
+            min_area=0,
+            min_visibility=0,
+            label_fields=['labels']
+        )
+    )
@@ -4,6 +4,7 @@ from albumentations.pytorch.transforms import ToTensorV2
 
 class No_Transform(object):
     width = height = 1000
+    cache_min_side = 0  # 缓存原图, 不缩放
 
     train_transform = A.Compose(  # FRCNN
         [
@@ -19,4 +20,5 @@ class No_Transform(object):
     )
 
     val_transform = train_transform
+    rect_val_transform = train_transform
 
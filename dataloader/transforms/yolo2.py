@@ -58,4 +58,19 @@ class Yolo2(object):
             min_visibility=0,
             label_fields=['labels']
         )
-    )
\ No newline at end of file
+    )
+
+    # --rect_eval, 不pad成正方形, 由collate_fn按batch pad到32的倍数
+    rect_val_transform = A.Compose(
+        [
+            A.LongestMaxSize(width, p=1.0),
+            ToTensorV2(p=1.0),
+        ],
+        p=1.0,
+        bbox_params=A.BboxParams(
+            format='pascal_voc',
+            min_area=0,
+            min_visibility=0,
+            label_fields=['labels']
+        )
+    )
@@ -14,16 +14,119 @@ import misc_utils as utils
 import xml.etree.ElementTree as ET
 import misc_utils as utils
 import random
-import pickle
+import multiprocessing
 import numpy as np
 import cv2
 
 from collections import defaultdict
 from dataloader.additional import voc_to_yolo_format
+from dataloader.voc_index import AnnotationIndex, annotation_fingerprint
+from dataloader.image_cache import read_image
 
 limit = lambda x, minimum, maximum: min(max(minimum, x), maximum)
 
 
+def parse_annotation(xml_file, class_names, use_difficult=False):
+    """Parse one VOC xml annotation.
+
+    Difficult bboxes (unless use_difficult), bboxes of classes not in class_names and
+    bboxes smaller than 2 pixels are dropped.
+
+    Args:
+        xml_file(str): path to Annotations/<id>.xml
+        class_names(list(str)): class names
+        use_difficult(bool): keep difficult bboxes
+
+    Returns:
+        {'bboxes': [[x1, y1, x2, y2], ...],
+         'labels': [class_id, ...],
+         'size': (width, height),
+         'difficult_bbox': number of ignored difficult bboxes
+        }
+
+    """
+    with open(xml_file, 'r') as anno:
+        tree = ET.parse(anno)
+
+    # 解析xml标注
+    root = tree.getroot()
+    bboxes = []
+    labels = []
+    difficult_bbox = 0
+
+    size = root.find('size')
+    width = int(size.find('width').text)
+    height = int(size.find('height').text)
+
+    for obj in root.iter('object'):  # 多个元素
+        class_name = obj.find('name').text
+
+        difficult = obj.find('difficult').text
+        if difficult != '0' and not use_difficult: 
+            difficult_bbox += 1
+            continue  # 忽略困难样本
+
+        if class_name not in class_names:
+            continue  # class_names中没有的类别是忽略还是报错
+            raise Exception(f'"{class_name}" not in class names({class_names}).')
+            
+        class_id = class_names.index(class_name)
+        bbox = obj.find('bndbox')
+        x1 = limit(int(bbox.find('xmin').text), 0, width)
+        y1 = limit(int(bbox.find('ymin').text), 0, height)
+        x2 = limit(int(bbox.find('xmax').text), 0, width)
+        y2 = limit(int(bbox.find('ymax').text), 0, height)
+
+        if x2 - x1 <= 2 or y2 - y1 <= 2:  # 面积很小的标注
+            continue
+
+        bboxes.append([x1, y1, x2, y2])
+        labels.append(class_id)
+
+    return {'bboxes': bboxes, 'labels': labels, 'size': (width, height), 'difficult_bbox': difficult_bbox}
+
+
+def _parse_chunk(args):
+    xml_files, class_names, use_difficult = args
+    return [parse_annotation(xml_file, class_names, use_difficult) for xml_file in xml_files]
+
+
+def parse_annotations(xml_files, class_names, use_difficult=False, num_workers=None, chunk_size=256):
+    """Parse VOC xml annotations with a process pool, results are yielded in the order of xml_files.
+
+    Args:
+        xml_files(list(str)): paths to xml annotations
+        class_names(list(str)): class names
+        use_difficult(bool): keep difficult bboxes
+        num_workers(int): number of processes, None for os.cpu_count(), 0 or 1 for parsing serially
+        chunk_size(int): number of xml files sent to a worker at a time
+
+    Yields:
+        dict: same as `parse_annotation`
+
+    """
+    if num_workers is None:
+        num_workers = os.cpu_count() or 1
+
+    total = len(xml_files)
+    num_workers = min(num_workers, (total + chunk_size - 1) // chunk_size)
+
+    if num_workers <= 1:
+        for i, xml_file in enumerate(xml_files):
+            utils.progress_bar(i, total, 'Load Anno...')
+            yield parse_annotation(xml_file, class_names, use_difficult)
+        return
+
+    chunks = [(xml_files[i: i + chunk_size], class_names, use_difficult) for i in range(0, total, chunk_size)]
+
+    with multiprocessing.Pool(num_workers) as pool:
+        # imap保证结果顺序和xml_files一致
+        for i, annos in enumerate(pool.imap(_parse_chunk, chunks)):
+            utils.progress_bar(i, len(chunks), f'Load Anno ({num_workers} workers)...')
+            for anno in annos:
+                yield anno
+
+
 class VOCTrainValDataset(dataset.Dataset):
     """VOC Dataset for training.
 
@@ -34,7 +137,12 @@ class VOCTrainValDataset(dataset.Dataset):
         format(str): 'jpg' or 'png'
         transforms(albumentations.transform): required, input images and bboxes will be applied simultaneously
         max_size(int): maximum data returned
-        use_cache(bool): whether use cached pickle file or load all xml annotations
+        use_cache(bool): whether use the packed annotation index in .cache (rebuilt automatically
+            when the split file or xml annotations change) or parse all xml annotations
+        use_difficult(bool): keep bboxes marked as difficult
+        num_workers(int): processes used to parse xml annotations when there is no valid cache,
+            None for os.cpu_count(), 0 for parsing serially
+        image_cache(ImageCache): optional cache of decoded uint8 images, see dataloader/image_cache.py
 
     Example:
         import albumentations as A
@@ -60,99 +168,61 @@ class VOCTrainValDataset(dataset.Dataset):
 
     """
 
-    def __init__(self, voc_root, class_names, split='train.txt', format='jpg', transforms=None, max_size=None, use_cache=False, use_difficult=False):
+    def __init__(self, voc_root, class_names, split='train.txt', format='jpg', transforms=None, max_size=None, use_cache=True, use_difficult=False, num_workers=None, image_cache=None):
         utils.color_print(f'Use dataset: {voc_root}, split: {split[:-4]}', 3)
 
         im_list = os.path.join(voc_root, f'ImageSets/Main/{split}')
         image_root = os.path.join(voc_root, 'JPEGImages')
 
-        self.image_paths = []
-        self.bboxes = []
-        self.labels = [] 
-        self.difficults = []
-
-        counter = defaultdict(int)
-        tot_bbox = 0
-        difficult_bbox = 0
+        with open(im_list, 'r') as f:
+            image_ids = [line.rstrip('\n') for line in f]
+            image_ids = [image_id for image_id in image_ids if image_id]
 
         """
-        如果有缓存的pickle文件，就直接从pickle文件读取bboxes
+        如果有缓存的标注索引并且标注文件没有改动，就直接mmap读取
         """
         os.makedirs('.cache', exist_ok=True)
 
-        cache_file = os.path.join('.cache', f'{os.path.basename(voc_root)}_{split[:-4]}.pkl')
-        if use_cache and os.path.isfile(cache_file):
-            with open(cache_file, 'rb') as f:
-                data = pickle.load(f, encoding='bytes')
-            
-            utils.color_print(f'Use cached annoations.', 3)
+        cache_dir = os.path.join('.cache', f'{os.path.basename(os.path.normpath(voc_root))}_{split[:-4]}')
+        fingerprint = annotation_fingerprint(voc_root, split, class_names, use_difficult, format, image_ids)
 
-            self.image_paths, self.bboxes, self.labels, self.difficults, \
-            counter, tot_bbox, difficult_bbox = data
-            
+        self.index = AnnotationIndex.load(cache_dir, fingerprint) if use_cache else None
+
+        if self.index is not None:
+            utils.color_print(f'Use cached annoations.', 3)
         else:  # 没有缓存文件
-            with open(im_list, 'r') as f:
-                lines = f.readlines()
-                for i, line in enumerate(lines):
-                    utils.progress_bar(i, len(lines), 'Load Anno...')
-                    image_id = line.rstrip('\n')
-                    abspath = os.path.abspath(os.path.join(image_root, f'{image_id}.{format}'))
-                    self.image_paths.append(abspath)
-                    with open(os.path.join(voc_root, f'Annotations/{image_id}.xml'), 'r') as anno:
-                        tree = ET.parse(anno)
-
-                    # 解析xml标注
-                    root = tree.getroot()
-                    bboxes = []
-                    labels = []
-
-                    size = root.find('size')
-                    width = int(size.find('width').text)
-                    height = int(size.find('height').text)
-
-                    for obj in root.iter('object'):  # 多个元素
-                        # difficult = obj.find('difficult').text
-                        class_name = obj.find('name').text
-
-                        difficult = obj.find('difficult').text
-                        if difficult != '0' and not use_difficult: 
-                            difficult_bbox += 1
-                            continue  # 忽略困难样本
-
-                        if class_name not in class_names:
-                            continue  # class_names中没有的类别是忽略还是报错
-                            raise Exception(f'"{class_name}" not in class names({class_names}).')
-                            
-                        class_id = class_names.index(class_name)
-                        bbox = obj.find('bndbox')
-                        x1 = limit(int(bbox.find('xmin').text), 0, width)
-                        y1 = limit(int(bbox.find('ymin').text), 0, height)
-                        x2 = limit(int(bbox.find('xmax').text), 0, width)
-                        y2 = limit(int(bbox.find('ymax').text), 0, height)
-
-                        if x2 - x1 <= 2 or y2 - y1 <= 2:  # 面积很小的标注
-                            continue
-
-                        counter[class_name] += 1
-                        tot_bbox += 1
-                        bboxes.append([x1, y1, x2, y2])
-                        labels.append(class_id)
-
-                    self.bboxes.append(bboxes)
-                    self.labels.append(labels)
+            bboxes, labels, sizes = [], [], []
+            counter = defaultdict(int)
+            tot_bbox = 0
+            difficult_bbox = 0
+
+            xml_files = [os.path.join(voc_root, f'Annotations/{image_id}.xml') for image_id in image_ids]
+
+            for anno in parse_annotations(xml_files, class_names, use_difficult, num_workers=num_workers):
+                bboxes.append(anno['bboxes'])
+                labels.append(anno['labels'])
+                sizes.append(anno['size'])
+
+                for class_id in anno['labels']:
+                    counter[class_names[class_id]] += 1
+                tot_bbox += len(anno['labels'])
+                difficult_bbox += anno['difficult_bbox']
 
             """
             存放到缓存文件
             """
-            data = [self.image_paths, self.bboxes, self.labels, self.difficults, \
-                counter, tot_bbox, difficult_bbox]
-
-            with open(cache_file, 'wb') as f:
-                pickle.dump(data, f)
+            self.index = AnnotationIndex.save(cache_dir, image_root, format, image_ids, bboxes, labels, sizes,
+                                              fingerprint=fingerprint,
+                                              counter=counter,
+                                              tot_bbox=tot_bbox,
+                                              difficult_bbox=difficult_bbox)
 
+        counter = self.index.meta['counter']
+        tot_bbox = self.index.meta['tot_bbox']
+        difficult_bbox = self.index.meta['difficult_bbox']
 
         for name in class_names:
-            utils.color_print(f'{name}: {counter[name]} ({counter[name]/tot_bbox*100:.2f}%)', 5)
+            utils.color_print(f'{name}: {counter.get(name, 0)} ({counter.get(name, 0)/max(tot_bbox, 1)*100:.2f}%)', 5)
         
         utils.color_print(f'Total bboxes: {tot_bbox}', 4)
         if difficult_bbox:
@@ -165,19 +235,27 @@ class VOCTrainValDataset(dataset.Dataset):
 
         self.transforms = transforms
         self.max_size = max_size
+        self.image_cache = image_cache
 
 
     def load_image_and_boxes(self, index):
-        image_path = self.image_paths[index]
+        image_path = self.index.path(index)
         if not os.path.exists(image_path):
             raise FileNotFoundError(f'{image_path} not found.')
 
-        image = cv2.imread(image_path)
-        image = cv2.cvtColor(image, cv2.COLOR_BGR2RGB).astype(np.float32)
-        image /= 255.0  # 转成0~1之间
+        bboxes = self.index.boxes(index)
+        labels = self.index.labels(index)
+
+        if self.image_cache is not None:
+            image, (scale_x, scale_y) = self.image_cache.load(image_path, self.index.size(index))
+            if scale_x != 1. or scale_y != 1.:  # 缓存的图片是缩小过的
+                bboxes[:, 0::2] *= scale_x
+                bboxes[:, 1::2] *= scale_y
+        else:
+            image = read_image(image_path)
 
-        bboxes = np.array(self.bboxes[index])
-        labels = np.array(self.labels[index])
+        image = image.astype(np.float32)
+        image /= 255.0  # 转成0~1之间
 
         h, w, _ = image.shape
 
@@ -197,7 +275,7 @@ class VOCTrainValDataset(dataset.Dataset):
              'yolo_boxes': yolo_boxes,
              'yolo4_boxes': yolo4_boxes,
              'yolo5_boxes': yolo5_boxes
-            }
+            }  (only the yolo format used by --model, see dataloader/additional.py)
 
         """
         image, bboxes, labels, image_path, (org_w, org_h) = self.load_image_and_boxes(index)
@@ -218,13 +296,23 @@ class VOCTrainValDataset(dataset.Dataset):
         sample['bboxes'] = torch.Tensor(sample['bboxes']) 
         sample['labels'] = torch.Tensor(sample['labels'])  # <--- add this!
         sample['path'] = image_path
+        sample['org_size'] = (org_w, org_h)  # 变换前的图片尺寸, --rect_eval时把bbox映射回这个尺寸
 
         sample.update(voc_to_yolo_format(sample, opt))
 
         return sample
 
+    def image_aspect_ratio(self, index):
+        w, h = self.index.size(index)
+        return float(w) / float(h)
+
+    def aspect_ratios(self):
+        """[N] width / height of every image, read from the annotation index without decoding images."""
+        sizes = np.asarray(self.index.sizes[:len(self)], dtype=np.float64)
+        return sizes[:, 0] / sizes[:, 1]
+
     def __len__(self):
         if self.max_size is not None:
-            return min(self.max_size, len(self.image_paths))
+            return min(self.max_size, len(self.index))
 
-        return len(self.image_paths)
\ No newline at end of file
+        return len(self.index)
\ No newline at end of file
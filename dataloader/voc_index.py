@@ -0,0 +1,237 @@
+# encoding=utf-8
+import os
+import json
+import shutil
+import hashlib
+
+import numpy as np
+
+INDEX_VERSION = 1
+
+_ARRAYS = ['boxes', 'labels', 'offsets', 'sizes', 'ids', 'id_offsets']
+
+
+def annotation_fingerprint(voc_root, split, class_names, use_difficult, format, image_ids):
+    """Fingerprint of everything a packed index depends on.
+
+    Any change to the split file, to one of the xml files listed in it, to the class names
+    or to the filtering options gives a different fingerprint, so a stale index is rebuilt.
+
+    Args:
+        voc_root(str): root dir to voc dataset
+        split(str): .txt file in ImageSets/Main
+        class_names(list(str)): class names
+        use_difficult(bool): whether difficult bboxes are kept
+        format(str): 'jpg' or 'png'
+        image_ids(list(str)): image ids listed in the split file
+
+    Returns:
+        str: md5 hex digest
+
+    """
+    im_list = os.path.join(voc_root, f'ImageSets/Main/{split}')
+    anno_root = os.path.join(voc_root, 'Annotations')
+
+    md5 = hashlib.md5()
+    md5.update(repr((INDEX_VERSION, os.path.abspath(voc_root), split, list(class_names),
+                     bool(use_difficult), format)).encode('utf-8'))
+
+    st = os.stat(im_list)
+    md5.update(repr((st.st_size, st.st_mtime_ns)).encode('utf-8'))
+
+    # 每个xml的(大小, 修改时间), 和split文件一样, 任何一个xml改变都会重建
+    stats = np.zeros([len(image_ids), 2], dtype=np.int64)
+    for i, image_id in enumerate(image_ids):
+        st = os.stat(os.path.join(anno_root, f'{image_id}.xml'))
+        stats[i] = st.st_size, st.st_mtime_ns
+
+    md5.update(stats.tobytes())
+
+    return md5.hexdigest()
+
+
+def _load_array(file):
+    """np.load with mmap_mode='r', arrays of size 0 (e.g. a split without bboxes) can not be
+    memory-mapped by every numpy version and are loaded into memory instead."""
+    with open(file, 'rb') as fp:
+        version = np.lib.format.read_magic(fp)
+        if version == (1, 0):
+            shape, _, _ = np.lib.format.read_array_header_1_0(fp)
+        else:
+            shape, _, _ = np.lib.format.read_array_header_2_0(fp)
+
+    if int(np.prod(shape)) == 0:
+        return np.load(file)
+
+    return np.load(file, mmap_mode='r')
+
+
+class AnnotationIndex(object):
+    """Packed, memory-mapped annotations of one VOC split.
+
+    All bboxes of the split are stored in one flat float32 array and all labels in one int16
+    array, ``offsets[i]:offsets[i+1]`` selects the annotations of image ``i``. Image paths are
+    interned as ``image_root`` + one byte buffer of image ids, so there are no per-image Python
+    objects. The arrays are opened with ``mmap_mode='r'``, DataLoader workers share the same
+    pages instead of copying millions of small lists.
+
+    Files in ``cache_dir``:
+        boxes.npy       float32 [M, 4]  x1, y1, x2, y2
+        labels.npy      int16   [M]
+        offsets.npy     int64   [N + 1]
+        sizes.npy       int32   [N, 2]  width, height
+        ids.npy         uint8   [L]     utf-8 image ids, concatenated
+        id_offsets.npy  int64   [N + 1]
+        meta.json       fingerprint, image_root, format and bbox statistics
+
+    Example:
+        index = AnnotationIndex.load('.cache/voc_train', fingerprint)
+        if index is None:
+            index = AnnotationIndex.save('.cache/voc_train', image_root, 'jpg', image_ids,
+                                         bboxes, labels, sizes, fingerprint=fingerprint)
+
+        path, boxes, labels = index.path(0), index.boxes(0), index.labels(0)
+
+    """
+
+    def __init__(self, cache_dir, arrays, meta):
+        self.cache_dir = cache_dir
+        self.meta = meta
+        self.image_root = meta['image_root']
+        self.format = meta['format']
+
+        self._boxes = arrays['boxes']
+        self._labels = arrays['labels']
+        self._offsets = arrays['offsets']
+        self._sizes = arrays['sizes']
+        self._ids = arrays['ids']
+        self._id_offsets = arrays['id_offsets']
+
+    @classmethod
+    def load(cls, cache_dir, fingerprint=None):
+        """Open a packed index.
+
+        Returns:
+            AnnotationIndex or None if the index does not exist or its fingerprint is stale.
+
+        """
+        meta_file = os.path.join(cache_dir, 'meta.json')
+        if not os.path.isfile(meta_file):
+            return None
+
+        with open(meta_file, 'r') as f:
+            meta = json.load(f)
+
+        if meta.get('version') != INDEX_VERSION:
+            return None
+
+        if fingerprint is not None and meta.get('fingerprint') != fingerprint:
+            return None
+
+        try:
+            arrays = {name: _load_array(os.path.join(cache_dir, f'{name}.npy')) for name in _ARRAYS}
+        except (IOError, ValueError):
+            return None
+
+        return cls(cache_dir, arrays, meta)
+
+    @classmethod
+    def save(cls, cache_dir, image_root, format, image_ids, bboxes, labels, sizes, fingerprint=None, **stats):
+        """Pack parsed annotations and write them to ``cache_dir``.
+
+        The files are written to a temporary dir first and moved into place, so concurrent
+        readers never see a half written index.
+
+        Args:
+            cache_dir(str): output dir
+            image_root(str): dir of the images, paths are ``image_root/<id>.<format>``
+            format(str): 'jpg' or 'png'
+            image_ids(list(str)): N image ids
+            bboxes(list): N lists of [x1, y1, x2, y2]
+            labels(list): N lists of class ids
+            sizes(list): N (width, height) tuples
+            fingerprint(str): see `annotation_fingerprint`
+            **stats: extra json serializable values saved in meta (e.g. counter, tot_bbox)
+
+        Returns:
+            AnnotationIndex: the saved index, memory-mapped
+
+        """
+        counts = np.array([len(b) for b in bboxes], dtype=np.int64)
+        offsets = np.zeros([len(bboxes) + 1], dtype=np.int64)
+        np.cumsum(counts, out=offsets[1:])
+
+        flat_boxes = [box for boxes_i in bboxes for box in boxes_i]
+        flat_labels = [label for labels_i in labels for label in labels_i]
+
+        encoded = [image_id.encode('utf-8') for image_id in image_ids]
+        id_offsets = np.zeros([len(encoded) + 1], dtype=np.int64)
+        np.cumsum([len(e) for e in encoded], out=id_offsets[1:])
+
+        arrays = {
+            'boxes': np.array(flat_boxes, dtype=np.float32).reshape([-1, 4]),
+            'labels': np.array(flat_labels, dtype=np.int16),
+            'offsets': offsets,
+            'sizes': np.array(sizes, dtype=np.int32).reshape([-1, 2]),
+            'ids': np.frombuffer(b''.join(encoded), dtype=np.uint8),
+            'id_offsets': id_offsets,
+        }
+
+        meta = {
+            'version': INDEX_VERSION,
+            'fingerprint': fingerprint,
+            'image_root': os.path.abspath(image_root),
+            'format': format,
+        }
+        meta.update(stats)
+
+        tmp_dir = f'{cache_dir}.tmp{os.getpid()}'
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+        os.makedirs(tmp_dir)
+
+        for name, array in arrays.items():
+            np.save(os.path.join(tmp_dir, f'{name}.npy'), array)
+
+        with open(os.path.join(tmp_dir, 'meta.json'), 'w') as f:
+            json.dump(meta, f)
+
+        shutil.rmtree(cache_dir, ignore_errors=True)
+        os.replace(tmp_dir, cache_dir)
+
+        return cls.load(cache_dir)
+
+    def __len__(self):
+        return len(self._offsets) - 1
+
+    @property
+    def num_boxes(self):
+        return len(self._labels)
+
+    def image_id(self, index):
+        s, e = self._id_offsets[index], self._id_offsets[index + 1]
+        return self._ids[s:e].tobytes().decode('utf-8')
+
+    def path(self, index):
+        return os.path.join(self.image_root, f'{self.image_id(index)}.{self.format}')
+
+    def boxes(self, index):
+        """float32 [Ni, 4] bboxes of image ``index``, a copy that is safe to modify."""
+        return np.array(self._boxes[self._offsets[index]:self._offsets[index + 1]])
+
+    def labels(self, index):
+        return np.array(self._labels[self._offsets[index]:self._offsets[index + 1]])
+
+    def size(self, index):
+        """(width, height) recorded in the xml of image ``index``."""
+        w, h = self._sizes[index]
+        return int(w), int(h)
+
+    @property
+    def sizes(self):
+        """int32 [N, 2] (width, height) of all images."""
+        return self._sizes
+
+    @property
+    def counts(self):
+        """int64 [N] number of bboxes of each image."""
+        return np.diff(self._offsets)
@@ -7,7 +7,7 @@ import numpy as np
 import torch
 import os
 
-from .effdet import get_efficientdet_config, EfficientDet, DetBenchTrain
+from .effdet import get_efficientdet_config, EfficientDet, DetBenchTrain, get_anchor_labeler
 from .effdet.efficientdet import HeadNet
 
 from options import opt
@@ -22,18 +22,49 @@ from mscv import ExponentialMovingAverage, print_network, load_checkpoint, save_
 import misc_utils as utils
 
 
+MODEL_NAME = 'tf_efficientdet_d5'
+
+
 def get_net(pretrained=True):
-    config = get_efficientdet_config('tf_efficientdet_d5')
+    config = get_efficientdet_config(MODEL_NAME)
     net = EfficientDet(config, pretrained_backbone=False)
     if pretrained:
         checkpoint = torch.load('/home/ubuntu/.cache/torch/checkpoints/efficientdet_d5-ef44aea8.pth')
         net.load_state_dict(checkpoint)
     config.num_classes = opt.num_classes
-    config.image_size = opt.scale
+    if opt.scale:  # 不指定--scale时用config默认的尺寸
+        config.image_size = opt.scale
     net.class_net = HeadNet(config, num_outputs=config.num_classes, norm_kwargs=dict(eps=.001, momentum=.01))
     return DetBenchTrain(net, config)
 
 
+def to_effdet_targets(bboxes, labels):
+    """xyxy bboxes and labels from 0 of the dataloader to the yxyx bboxes and labels from 1 of effdet."""
+    bboxes = [bbox[:, [1, 0, 3, 2]].float() for bbox in bboxes]
+    labels = [label.float() + 1 for label in labels]
+    return bboxes, labels
+
+
+class AnchorTargets(object):
+    """--collate_targets, 在dataloader的worker里给整个batch的anchor打标签, sample['anchor_targets']直接用于训练.
+    """
+    def __init__(self):
+        self.anchor_labeler = None
+
+    def __call__(self, sample):
+        if self.anchor_labeler is None:  # 在worker里第一次用到时创建
+            config = get_efficientdet_config(MODEL_NAME)
+            config.num_classes = opt.num_classes
+            if opt.scale:  # anchor按每个batch的图片尺寸生成, 这里只是默认尺寸
+                config.image_size = opt.scale
+            self.anchor_labeler = get_anchor_labeler(config)
+
+        bboxes, labels = to_effdet_targets(sample['bboxes'], sample['labels'])
+        image_size = tuple(sample['image'].shape[-2:])
+        sample['anchor_targets'] = self.anchor_labeler.batch_label_anchors(bboxes, labels, image_size)
+        return sample
+
+
 class Model(BaseModel):
     def __init__(self, opt):
         super(Model, self).__init__()
@@ -71,18 +102,18 @@ class Model(BaseModel):
         return {}
 
     def forward(self, sample):
-        labels = sample['labels']
-        for i in range(len(labels)):
-            labels[i] += 1   # effdet的label从1开始
-
-        image, bboxes, labels = sample['image'], sample['bboxes'], sample['labels']
-
-        for bbox in bboxes:
-            bbox[:,[0,1,2,3]] = bbox[:,[1,0,3,2]]  # yxyx
-
-        image = image.to(opt.device)
-        bboxes = [bbox.to(opt.device).float() for bbox in bboxes]
-        labels = [label.to(opt.device).float() for label in labels]
+        image = sample['image'].to(opt.device)
+
+        if 'anchor_targets' in sample:  # --collate_targets, 已经在dataloader里打好标签
+            cls_targets, box_targets, num_positives = sample['anchor_targets']
+            targets = ([t.to(opt.device) for t in cls_targets], [t.to(opt.device) for t in box_targets],
+                       num_positives.to(opt.device))
+            loss, _, _ = self.detector(image, None, None, targets)
+            return loss
+
+        bboxes, labels = to_effdet_targets(sample['bboxes'], sample['labels'])  # yxyx, effdet的label从1开始
+        bboxes = [bbox.to(opt.device) for bbox in bboxes]
+        labels = [label.to(opt.device) for label in labels]
 
         # import ipdb
         # ipdb.set_trace()
@@ -1,4 +1,4 @@
 from .efficientdet import EfficientDet
-from .bench import DetBenchEval, DetBenchTrain
+from .bench import DetBenchEval, DetBenchTrain, get_anchor_labeler
 from .config.config import get_efficientdet_config
 from .helpers import load_checkpoint, load_pretrained
\ No newline at end of file
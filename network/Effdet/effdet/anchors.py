@@ -35,6 +35,7 @@ from .object_detection import box_list
 from .object_detection import faster_rcnn_box_coder
 from .object_detection import region_similarity_calculator
 from .object_detection import target_assigner
+from utils.grid_cache import TensorCache
 
 # The minimum score to consider a logit for identifying detections.
 MIN_CLASS_SCORE = -5.0
@@ -118,8 +119,8 @@ def _generate_anchor_boxes(image_size, anchor_scale, anchor_configs):
     """Generates multiscale anchor boxes.
 
     Args:
-        image_size: integer number of input image size. The input image has the same dimension for
-            width and height. The image_size should be divided by the largest feature stride 2^max_level.
+        image_size: integer number of input image size (same dimension for width and height), or a tuple
+            (height, width). The image_size should be divided by the largest feature stride 2^max_level.
 
         anchor_scale: float number representing the scale of size of the base
             anchor to the feature stride 2^level.
@@ -133,19 +134,20 @@ def _generate_anchor_boxes(image_size, anchor_scale, anchor_configs):
     Raises:
         ValueError: input size must be the multiple of largest feature stride.
     """
+    image_height, image_width = _image_hw(image_size)
     boxes_all = []
     for _, configs in anchor_configs.items():
         boxes_level = []
         for config in configs:
             stride, octave_scale, aspect = config
-            if image_size % stride != 0:
+            if image_height % stride != 0 or image_width % stride != 0:
                 raise ValueError("input size must be divided by the stride.")
             base_anchor_size = anchor_scale * stride * 2 ** octave_scale
             anchor_size_x_2 = base_anchor_size * aspect[0] / 2.0
             anchor_size_y_2 = base_anchor_size * aspect[1] / 2.0
 
-            x = np.arange(stride / 2, image_size, stride)
-            y = np.arange(stride / 2, image_size, stride)
+            x = np.arange(stride / 2, image_width, stride)
+            y = np.arange(stride / 2, image_height, stride)
             xv, yv = np.meshgrid(x, y)
             xv = xv.reshape(-1)
             yv = yv.reshape(-1)
@@ -162,6 +164,13 @@ def _generate_anchor_boxes(image_size, anchor_scale, anchor_configs):
     return anchor_boxes
 
 
+def _image_hw(image_size):
+    """(height, width) of an integer image size or a (height, width) tuple."""
+    if isinstance(image_size, int):
+        return image_size, image_size
+    return int(image_size[0]), int(image_size[1])
+
+
 def generate_detections(cls_outputs, box_outputs, anchor_boxes, indices, classes, image_scale):
     """Generates detections with RetinaNet model outputs and anchors.
 
@@ -225,7 +234,7 @@ def generate_detections(cls_outputs, box_outputs, anchor_boxes, indices, classes
 class Anchors(nn.Module):
     """RetinaNet Anchors class."""
 
-    def __init__(self, min_level, max_level, num_scales, aspect_ratios, anchor_scale, image_size):
+    def __init__(self, min_level, max_level, num_scales, aspect_ratios, anchor_scale, image_size, cache_size=8):
         """Constructs multiscale RetinaNet anchors.
 
         Args:
@@ -247,6 +256,8 @@ class Anchors(nn.Module):
             image_size: integer number of input image size. The input image has the
                 same dimension for width and height. The image_size should be divided by
                 the largest feature stride 2^max_level.
+
+            cache_size: number of other image sizes whose anchors are cached, see get_boxes.
         """
         super(Anchors, self).__init__()
         self.min_level = min_level
@@ -257,17 +268,44 @@ class Anchors(nn.Module):
         self.image_size = image_size
         self.config = self._generate_configs()
         self.register_buffer('boxes', self._generate_boxes())
+        self.cache = TensorCache(maxsize=cache_size)
 
     def _generate_configs(self):
         """Generate configurations of anchor boxes."""
         return _generate_anchor_configs(self.min_level, self.max_level, self.num_scales, self.aspect_ratios)
 
-    def _generate_boxes(self):
+    def _generate_boxes(self, image_size=None):
         """Generates multiscale anchor boxes."""
-        boxes = _generate_anchor_boxes(self.image_size, self.anchor_scale, self.config)
+        if image_size is None:
+            image_size = self.image_size
+        boxes = _generate_anchor_boxes(image_size, self.anchor_scale, self.config)
         boxes = torch.from_numpy(boxes).float()
         return boxes
 
+    def get_boxes(self, image_size=None, device=None, dtype=torch.float32):
+        """Anchor boxes of an image size, generated once for every (image size, device, dtype).
+
+        Args:
+            image_size: integer or (height, width), None for self.image_size.
+
+        Returns:
+            a torch tensor with shape [N, 4], same layout as self.boxes.
+        """
+        device = self.boxes.device if device is None else torch.device(device)
+        if image_size is None or _image_hw(image_size) == _image_hw(self.image_size):
+            if device == self.boxes.device and dtype == self.boxes.dtype:
+                return self.boxes
+
+        image_size = _image_hw(self.image_size if image_size is None else image_size)
+        return self.cache.get((image_size, str(device), dtype),
+                              lambda: self._generate_boxes(image_size).to(device=device, dtype=dtype))
+
+    def get_feat_sizes(self, image_size=None):
+        """(height, width) of the feature map of every level."""
+        image_height, image_width = _image_hw(self.image_size if image_size is None else image_size)
+        return [(image_height // 2 ** level, image_width // 2 ** level)
+                for level in range(self.min_level, self.max_level + 1)]
+
     def get_anchors_per_location(self):
         return self.num_scales * len(self.aspect_ratios)
 
@@ -298,25 +336,26 @@ class AnchorLabeler(nn.Module):
         box_coder = faster_rcnn_box_coder.FasterRcnnBoxCoder()
 
         self.target_assigner = target_assigner.TargetAssigner(similarity_calc, matcher, box_coder)
+        self.matcher = matcher
+        self.box_coder = box_coder
         self.anchors = anchors
         self.match_threshold = match_threshold
         self.num_classes = num_classes
 
-    def _unpack_labels(self, labels):
-        """Unpacks an array of labels into multiscales labels."""
-        labels_unpacked = []
-        anchors = self.anchors
-        count = 0
-        for level in range(anchors.min_level, anchors.max_level + 1):
-            feat_size = int(anchors.image_size / 2 ** level)
-            steps = feat_size ** 2 * anchors.get_anchors_per_location()
-            indices = torch.arange(count, count + steps, device=labels.device)
-            count += steps
-            labels_unpacked.append(
-                torch.index_select(labels, 0, indices).view([feat_size, feat_size, -1]))
-        return labels_unpacked
-
-    def label_anchors(self, gt_boxes, gt_labels):
+    def _unpack_labels(self, labels, image_size=None, batched=False):
+        """Unpacks an array of labels into multiscales labels.
+
+        labels is [N, ...] of one image, or [B, N, ...] of a batch when batched is True.
+        The labels of every level are views of labels when labels is contiguous, otherwise they are copied.
+        """
+        num_anchors = self.anchors.get_anchors_per_location()
+        feat_sizes = self.anchors.get_feat_sizes(image_size)
+        steps = [feat_height * feat_width * num_anchors for feat_height, feat_width in feat_sizes]
+        prefix = list(labels.shape[:1]) if batched else []
+        return [level.reshape(prefix + [feat_height, feat_width, -1])
+                for level, (feat_height, feat_width) in zip(labels.split(steps, dim=int(batched)), feat_sizes)]
+
+    def label_anchors(self, gt_boxes, gt_labels, image_size=None):
         """Labels anchors with ground truth inputs.
 
         Args:
@@ -325,6 +364,8 @@ class AnchorLabeler(nn.Module):
 
             gt_labels: A integer tensor with shape [N, 1] representing groundtruth classes.
 
+            image_size: integer or (height, width) of the input image, None for anchors.image_size.
+
         Returns:
             cls_targets_dict: ordered dictionary with keys [min_level, min_level+1, ..., max_level].
                 The values are tensor with shape [height_l, width_l, num_anchors]. The height_l and width_l
@@ -337,7 +378,7 @@ class AnchorLabeler(nn.Module):
             num_positives: scalar tensor storing number of positives in an image.
         """
         gt_box_list = box_list.BoxList(gt_boxes)
-        anchor_box_list = box_list.BoxList(self.anchors.boxes)
+        anchor_box_list = box_list.BoxList(self.anchors.get_boxes(image_size, gt_boxes.device))
 
         # cls_weights, box_weights are not used
         cls_targets, _, box_targets, _, matches = self.target_assigner.assign(anchor_box_list, gt_box_list, gt_labels)
@@ -347,8 +388,69 @@ class AnchorLabeler(nn.Module):
         cls_targets = cls_targets.long()
 
         # Unpack labels.
-        cls_targets_dict = self._unpack_labels(cls_targets)
-        box_targets_dict = self._unpack_labels(box_targets)
+        cls_targets_dict = self._unpack_labels(cls_targets, image_size)
+        box_targets_dict = self._unpack_labels(box_targets, image_size)
         num_positives = (matches.match_results != -1).float().sum()
 
         return cls_targets_dict, box_targets_dict, num_positives
+
+    def batch_label_anchors(self, gt_boxes, gt_labels, image_size=None):
+        """Labels anchors of a whole batch with one matcher call, same targets as label_anchors of every image.
+
+        Args:
+            gt_boxes: a list of [N_i, 4] float tensors ([y0, x0, y1, x1]), or a [B, M, 4] tensor.
+
+            gt_labels: a list of [N_i] tensors, or a [B, M] tensor padded with -1. Classes start from 1.
+
+            image_size: integer or (height, width) of the input image, None for anchors.image_size.
+
+        Returns:
+            cls_targets: list of tensors with shape [B, height_l, width_l, num_anchors] of every level.
+
+            box_targets: list of tensors with shape [B, height_l, width_l, num_anchors * 4] of every level.
+
+            num_positives: float tensor with shape [B], number of positives in every image.
+        """
+        gt_boxes, gt_labels = pad_groundtruth(gt_boxes, gt_labels)
+        batch_size = gt_boxes.shape[0]
+        anchor_boxes = self.anchors.get_boxes(image_size, gt_boxes.device)
+        num_anchors = anchor_boxes.shape[0]
+
+        similarity = region_similarity_calculator.batch_iou(gt_boxes, anchor_boxes)  # [B, M, N]
+        matches = self.matcher.match_batch(similarity, gt_labels != -1)  # [B, N]
+        matched = matches >= 0
+        matches = matches.clamp(min=0)
+
+        matched_gt_boxes = gt_boxes.gather(1, matches.unsqueeze(-1).expand(-1, -1, 4))
+        box_targets = self.box_coder.encode(box_list.BoxList(matched_gt_boxes.view(-1, 4)),
+                                            box_list.BoxList(anchor_boxes.repeat(batch_size, 1)))
+        box_targets = box_targets.view(batch_size, num_anchors, 4)
+        box_targets = torch.where(matched.unsqueeze(-1), box_targets, torch.zeros_like(box_targets))
+
+        # class labels start from 1 and the background class = -1
+        cls_targets = torch.where(matched, gt_labels.gather(1, matches), torch.zeros_like(matches, dtype=gt_labels.dtype))
+        cls_targets = cls_targets.long() - 1
+
+        cls_targets = self._unpack_labels(cls_targets, image_size, batched=True)
+        box_targets = self._unpack_labels(box_targets, image_size, batched=True)
+        num_positives = matched.float().sum(1)
+
+        return cls_targets, box_targets, num_positives
+
+
+def pad_groundtruth(gt_boxes, gt_labels):
+    """Pads lists of [N_i, 4] boxes and [N_i] labels to [B, M, 4] and [B, M], labels of the padding are -1.
+
+    Tensors already padded are returned as they are.
+    """
+    if torch.is_tensor(gt_boxes):
+        return gt_boxes, gt_labels
+
+    max_num = max([len(boxes) for boxes in gt_boxes] + [1])
+    padded_boxes = gt_boxes[0].new_zeros([len(gt_boxes), max_num, 4])
+    padded_labels = gt_boxes[0].new_full([len(gt_boxes), max_num], -1)
+    for i, (boxes, labels) in enumerate(zip(gt_boxes, gt_labels)):
+        if len(boxes):
+            padded_boxes[i, :len(boxes)] = boxes
+            padded_labels[i, :len(boxes)] = labels.view(-1).to(padded_labels)
+    return padded_boxes, padded_labels
@@ -8,7 +8,7 @@ from .anchors import Anchors, AnchorLabeler, generate_detections, MAX_DETECTION_
 from .loss import DetectionLoss
 
 
-def _post_process(config, cls_outputs, box_outputs):
+def _post_process(config, cls_outputs, box_outputs, topk=MAX_DETECTION_POINTS):
     """Selects top-k predictions.
 
     Post-proc code adapted from Tensorflow version at: https://github.com/google/automl/tree/master/efficientdet
@@ -22,6 +22,8 @@ def _post_process(config, cls_outputs, box_outputs):
 
         box_outputs: an OrderDict with keys representing levels and values
             representing box regression targets in [batch_size, height, width, num_anchors * 4].
+
+        topk: number of (anchor, class) pairs kept for every image, MAX_DETECTION_POINTS by default.
     """
     batch_size = cls_outputs[0].shape[0]
     cls_outputs_all = torch.cat([
@@ -32,7 +34,8 @@ def _post_process(config, cls_outputs, box_outputs):
         box_outputs[level].permute(0, 2, 3, 1).reshape([batch_size, -1, 4])
         for level in range(config.num_levels)], 1)
 
-    _, cls_topk_indices_all = torch.topk(cls_outputs_all.reshape(batch_size, -1), dim=1, k=MAX_DETECTION_POINTS)
+    topk = min(topk, cls_outputs_all.shape[1] * config.num_classes)
+    _, cls_topk_indices_all = torch.topk(cls_outputs_all.reshape(batch_size, -1), dim=1, k=topk)
     indices_all = cls_topk_indices_all / config.num_classes
     classes_all = cls_topk_indices_all % config.num_classes
 
@@ -56,43 +59,51 @@ class DetBenchEval(nn.Module):
             config.min_level, config.max_level,
             config.num_scales, config.aspect_ratios,
             config.anchor_scale, config.image_size)
+        self.pre_nms_topk = MAX_DETECTION_POINTS
 
     def forward(self, x, image_scales):
         class_out, box_out = self.model(x)
-        class_out, box_out, indices, classes = _post_process(self.config, class_out, box_out)
+        class_out, box_out, indices, classes = _post_process(self.config, class_out, box_out, topk=self.pre_nms_topk)
+
+        anchor_boxes = self.anchors.get_boxes(x.shape[-2:], x.device)  # 每种输入大小只生成一次
 
         batch_detections = []
         # FIXME we may be able to do this as a batch with some tensor reshaping/indexing, PR welcome
         for i in range(x.shape[0]):
             detections = generate_detections(
-                class_out[i], box_out[i], self.anchors.boxes, indices[i], classes[i], image_scales[i])
+                class_out[i], box_out[i], anchor_boxes, indices[i], classes[i], image_scales[i])
             batch_detections.append(detections)
         return torch.stack(batch_detections, dim=0)
 
 
+def get_anchor_labeler(config):
+    """AnchorLabeler of a config, also used to label anchors in dataloader workers."""
+    anchors = Anchors(
+        config.min_level, config.max_level,
+        config.num_scales, config.aspect_ratios,
+        config.anchor_scale, config.image_size)
+    return AnchorLabeler(anchors, config.num_classes, match_threshold=0.5)
+
+
 class DetBenchTrain(nn.Module):
     def __init__(self, model, config):
         super(DetBenchTrain, self).__init__()
         self.config = config
         self.model = model
-        anchors = Anchors(
-            config.min_level, config.max_level,
-            config.num_scales, config.aspect_ratios,
-            config.anchor_scale, config.image_size)
-        self.anchor_labeler = AnchorLabeler(anchors, config.num_classes, match_threshold=0.5)
+        self.anchor_labeler = get_anchor_labeler(config)
         self.loss_fn = DetectionLoss(self.config)
 
-    def forward(self, x, gt_boxes, gt_labels):
+    def forward(self, x, gt_boxes, gt_labels, targets=None):
+        """
+        Args:
+            targets: (cls_targets, box_targets, num_positives) of AnchorLabeler.batch_label_anchors, e.g. labeled
+                in dataloader workers. gt_boxes and gt_labels are not used when targets is given.
+        """
         class_out, box_out = self.model(x)
 
-        cls_targets = []
-        box_targets = []
-        num_positives = []
-        # FIXME this may be a bottleneck, would be faster if batched, or should be done in loader/dataset?
-        for i in range(x.shape[0]):
-            gt_class_out, gt_box_out, num_positive = self.anchor_labeler.label_anchors(gt_boxes[i], gt_labels[i])
-            cls_targets.append(gt_class_out)
-            box_targets.append(gt_box_out)
-            num_positives.append(num_positive)
+        if targets is None:
+            # 整个batch一起匹配
+            targets = self.anchor_labeler.batch_label_anchors(gt_boxes, gt_labels, tuple(x.shape[-2:]))
+        cls_targets, box_targets, num_positives = targets
 
         return self.loss_fn(class_out, box_out, cls_targets, box_targets, num_positives)
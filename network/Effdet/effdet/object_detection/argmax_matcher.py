@@ -154,6 +154,52 @@ class ArgMaxMatcher(matcher.Matcher):
         else:
             return _match_when_rows_are_non_empty()
 
+    def match_batch(self, similarity_matrix, valid):
+        """Matches the columns of every image of a batch, same results as _match of each image.
+
+        Args:
+            similarity_matrix: tensor of shape [B, M, N], groundtruth of every image padded to M rows.
+            valid: bool tensor of shape [B, M], False for the padding rows.
+
+        Returns:
+            match_results: long tensor of shape [B, N].
+        """
+        batch_size, num_rows, num_columns = similarity_matrix.shape
+        if num_rows == 0:
+            return -1 * torch.ones([batch_size, num_columns], dtype=torch.long, device=similarity_matrix.device)
+
+        # padding的行不会被匹配到
+        similarity_matrix = similarity_matrix.masked_fill(~valid.unsqueeze(-1), -1)
+        matched_vals, matches = torch.max(similarity_matrix, 1)
+
+        if self._matched_threshold is not None:
+            below_unmatched_threshold = self._unmatched_threshold > matched_vals
+            between_thresholds = (matched_vals >= self._unmatched_threshold) & \
+                                 (self._matched_threshold > matched_vals)
+
+            if self._negatives_lower_than_unmatched:
+                matches[below_unmatched_threshold] = -1
+                matches[between_thresholds] = -2
+            else:
+                matches[below_unmatched_threshold] = -2
+                matches[between_thresholds] = -1
+
+        # 没有gt的图片全部为负样本
+        matches = matches.masked_fill(~valid.any(1, keepdim=True), -1)
+
+        if self._force_match_for_each_row:
+            # 多个行强制匹配到同一列时取序号小的行, 同_match中one_hot后的argmax
+            batch_idx, row_idx = valid.nonzero(as_tuple=True)
+            column_idx = torch.argmax(similarity_matrix, 2)[batch_idx, row_idx]
+            key = batch_idx * num_columns + column_idx
+            order = (key * num_rows + row_idx).argsort()
+            key, row_idx = key[order], row_idx[order]
+            first = torch.ones_like(key, dtype=torch.bool)
+            first[1:] = key[1:] != key[:-1]
+            matches.view(-1)[key[first]] = row_idx[first]
+
+        return matches
+
     def _set_values_using_indicator(self, x, indicator, val):
         """Set the indicated fields of x to val.
 
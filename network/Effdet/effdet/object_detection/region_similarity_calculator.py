@@ -75,6 +75,27 @@ def iou(boxlist1, boxlist2):
     return torch.where(intersections == 0.0, torch.zeros_like(intersections), intersections / unions)
 
 
+def batch_iou(boxes1, boxes2):
+    """Computes pairwise iou of the boxes of every image with boxes shared by the batch.
+
+    Args:
+        boxes1: a tensor with shape [B, M, 4], [y_min, x_min, y_max, x_max] of every image
+        boxes2: a tensor with shape [N, 4], e.g. anchors
+
+    Returns:
+        a tensor with shape [B, M, N] representing pairwise iou scores, same values as iou.
+    """
+    y_min1, x_min1, y_max1, x_max1 = [t.unsqueeze(-1) for t in boxes1.unbind(-1)]
+    y_min2, x_min2, y_max2, x_max2 = boxes2.unbind(-1)
+    intersect_heights = torch.clamp(torch.min(y_max1, y_max2) - torch.max(y_min1, y_min2), min=0)
+    intersect_widths = torch.clamp(torch.min(x_max1, x_max2) - torch.max(x_min1, x_min2), min=0)
+    intersections = intersect_heights * intersect_widths
+    areas1 = (y_max1 - y_min1) * (x_max1 - x_min1)
+    areas2 = (y_max2 - y_min2) * (x_max2 - x_min2)
+    unions = areas1 + areas2 - intersections
+    return torch.where(intersections == 0.0, torch.zeros_like(intersections), intersections / unions)
+
+
 class RegionSimilarityCalculator(object):
     """Abstract base class for region similarity calculator."""
     __metaclass__ = ABCMeta
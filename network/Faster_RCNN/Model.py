@@ -16,6 +16,7 @@ from optimizer import get_optimizer
 from scheduler import get_scheduler
 
 from network.base_model import BaseModel
+from utils.postprocess import get_postprocess_config
 from mscv import ExponentialMovingAverage, print_network, load_checkpoint, save_checkpoint
 # from mscv.cnn import normal_init
 from mscv.summary import write_image
@@ -52,6 +53,13 @@ class Model(BaseModel):
 
         # replace the pre-trained head with a new one
         self.detector.roi_heads.box_predictor = FastRCNNPredictor(in_features, opt.num_classes + 1)
+
+        # 阈值过滤和NMS在torchvision的roi_heads中完成
+        self.postprocess_cfg = get_postprocess_config(opt, conf_thresh=0.5, nms_thresh=0.5, max_per_image=100)
+        self.detector.roi_heads.score_thresh = self.postprocess_cfg.conf_thresh
+        self.detector.roi_heads.nms_thresh = self.postprocess_cfg.nms_thresh
+        if self.postprocess_cfg.max_per_image:
+            self.detector.roi_heads.detections_per_img = self.postprocess_cfg.max_per_image
         print_network(self.detector)
 
         self.optimizer = get_optimizer(opt, self.detector)
@@ -106,7 +114,7 @@ class Model(BaseModel):
         return {}
 
     def forward(self, image):  # test
-        conf_thresh = 0.5
+        conf_thresh = self.postprocess_cfg.conf_thresh
 
         image = list(im for im in image)
 
@@ -15,6 +15,7 @@ from optimizer import get_optimizer
 from scheduler import get_scheduler
 
 from network.base_model import BaseModel
+from utils.postprocess import get_postprocess_config
 from mscv import ExponentialMovingAverage, print_network, load_checkpoint, save_checkpoint
 # from mscv.cnn import normal_init
 from mscv.summary import write_image
@@ -33,6 +34,8 @@ class Model(BaseModel):
         # # replace the pre-trained head with a new one
         # self.detector.roi_heads.box_predictor = FastRCNNPredictor(in_features, opt.num_classes + 1)
         self.detector = Retina_50(opt.num_classes,pretrained=True)
+        self.postprocess_cfg = get_postprocess_config(opt, conf_thresh=0.05, nms_thresh=0.5, max_per_image=None)
+        self.detector.pre_nms_topk = self.postprocess_cfg.pre_nms_topk
 
         #####################
         #    Init weights
@@ -72,27 +75,9 @@ class Model(BaseModel):
         return {}
 
     def forward(self, image):  # test
-        conf_thresh = 0.  # 0.5 for vis result
+        bboxes, scores = self.detector(image)
 
-        batch_bboxes = []
-        batch_labels = []
-        batch_scores = []
-
-        for i in range(image.shape[0]):
-            single_image = image[i: i+1]
-
-            scores, labels, bboxes = self.detector(single_image)  # RetinaNet只支持单张检测
-
-            conf = scores > conf_thresh
-            bboxes = bboxes[conf].detach().cpu().numpy()
-            labels = labels[conf].detach().cpu().numpy()
-            scores = scores[conf].detach().cpu().numpy()
-
-            batch_bboxes.append(bboxes)
-            batch_labels.append(labels)
-            batch_scores.append(scores)
-
-        return batch_bboxes, batch_labels, batch_scores
+        return self.postprocess_cfg(bboxes, scores)
 
     def inference(self, x, progress_idx=None):
         raise NotImplementedError
@@ -2,6 +2,8 @@ import numpy as np
 import torch
 import torch.nn as nn
 
+from utils.grid_cache import TensorCache
+
 
 class Anchors(nn.Module):
     def __init__(self, pyramid_levels=None, strides=None, sizes=None, ratios=None, scales=None):
@@ -17,10 +19,16 @@ class Anchors(nn.Module):
             self.ratios = np.array([0.5, 1, 2])
         if scales is None:
             self.scales = np.array([2 ** 0, 2 ** (1.0 / 3.0), 2 ** (2.0 / 3.0)])
+        self.cache = TensorCache(maxsize=8)  # 每种输入大小只生成一次anchors
 
     def forward(self, image):
+        image_shape = tuple(image.shape[2:])
+        dtype = image.dtype if image.is_floating_point() else torch.float32
+
+        return self.cache.get((image_shape, str(image.device), dtype),
+                              lambda: self._generate_anchors(image_shape).to(device=image.device, dtype=dtype))
 
-        image_shape = image.shape[2:]
+    def _generate_anchors(self, image_shape):
         image_shape = np.array(image_shape)
         image_shapes = [(image_shape + 2 ** x - 1) // (2 ** x) for x in self.pyramid_levels]
 
@@ -34,10 +42,7 @@ class Anchors(nn.Module):
 
         all_anchors = np.expand_dims(all_anchors, axis=0)
 
-        if torch.cuda.is_available():
-            return torch.from_numpy(all_anchors.astype(np.float32)).cuda()
-        else:
-            return torch.from_numpy(all_anchors.astype(np.float32))
+        return torch.from_numpy(all_anchors.astype(np.float32))
 
 
 def generate_anchors(base_size=16, ratios=None, scales=None):
@@ -23,155 +23,137 @@ def calc_iou(a, b):
     return IoU
 
 
-class FocalLoss(nn.Module):
-    # def __init__(self):
-
-    def forward(self, classifications, regressions, anchors, annotations):
-        alpha = 0.25
-        gamma = 2.0
-        batch_size = classifications.shape[0]
-        classification_losses = []
-        regression_losses = []
-
-        anchor = anchors[0, :, :]
-
-        anchor_widths = anchor[:, 2] - anchor[:, 0]
-        anchor_heights = anchor[:, 3] - anchor[:, 1]
-        anchor_ctr_x = anchor[:, 0] + 0.5 * anchor_widths
-        anchor_ctr_y = anchor[:, 1] + 0.5 * anchor_heights
-
-        for j in range(batch_size):
-
-            classification = classifications[j, :, :]
-            regression = regressions[j, :, :]
-            bbox_annotation = annotations[j]
-            bbox_annotation = bbox_annotation[bbox_annotation[:, 4] != -1]
+def calc_iou_batch(anchors, boxes, valid):
+    """IoU of anchors [N, 4] with the (padded) annotations of every image [B, M, 4], same formula as calc_iou.
 
-            classification = torch.clamp(classification, 1e-4, 1.0 - 1e-4)
+    Returns:
+        Tensor: [B, N, M], -1 for padding
+    """
+    area = (boxes[:, :, 2] - boxes[:, :, 0]) * (boxes[:, :, 3] - boxes[:, :, 1])  # [B, M]
 
-            if bbox_annotation.shape[0] == 0:
-                if torch.cuda.is_available():
-                    alpha_factor = torch.ones(classification.shape).cuda() * alpha
+    iw = torch.min(anchors[None, :, 2:3], boxes[:, None, :, 2]) - torch.max(anchors[None, :, 0:1], boxes[:, None, :, 0])
+    ih = torch.min(anchors[None, :, 3:4], boxes[:, None, :, 3]) - torch.max(anchors[None, :, 1:2], boxes[:, None, :, 1])
 
-                    alpha_factor = 1. - alpha_factor
-                    focal_weight = classification
-                    focal_weight = alpha_factor * torch.pow(focal_weight, gamma)
-
-                    bce = -(torch.log(1.0 - classification))
-
-                    # cls_loss = focal_weight * torch.pow(bce, gamma)
-                    cls_loss = focal_weight * bce
-                    classification_losses.append(cls_loss.sum())
-                    regression_losses.append(torch.tensor(0).float())
+    iw = torch.clamp(iw, min=0)
+    ih = torch.clamp(ih, min=0)
 
-                else:
-                    alpha_factor = torch.ones(classification.shape) * alpha
+    anchor_area = (anchors[:, 2] - anchors[:, 0]) * (anchors[:, 3] - anchors[:, 1])
+    ua = anchor_area[None, :, None] + area[:, None, :] - iw * ih
 
-                    alpha_factor = 1. - alpha_factor
-                    focal_weight = classification
-                    focal_weight = alpha_factor * torch.pow(focal_weight, gamma)
+    ua = torch.clamp(ua, min=1e-8)
 
-                    bce = -(torch.log(1.0 - classification))
+    IoU = iw * ih / ua
 
-                    # cls_loss = focal_weight * torch.pow(bce, gamma)
-                    cls_loss = focal_weight * bce
-                    classification_losses.append(cls_loss.sum())
-                    regression_losses.append(torch.tensor(0).float())
+    return torch.where(valid[:, None, :], IoU, IoU.new_tensor(-1.))
 
-                continue
 
-            IoU = calc_iou(anchors[0, :, :], bbox_annotation[:, :4])  # num_anchors x num_annotations
+def pad_annotations(annotations, device=None):
+    """Pad a list of [M_j, 5] annotations (x1, y1, x2, y2, label) to [B, M, 5], padding is -1.
 
-            IoU_max, IoU_argmax = torch.max(IoU, dim=1)  # num_anchors x 1
+    A [B, M, 5] tensor (padded with label -1) is returned as is.
+    """
+    if torch.is_tensor(annotations):
+        return annotations.to(device) if device is not None else annotations
 
-            # import pdb
-            # pdb.set_trace()
+    max_num = max([len(a) for a in annotations] + [1])
+    padded = torch.full([len(annotations), max_num, 5], -1., device=device)
+    for j, a in enumerate(annotations):
+        if len(a):
+            padded[j, :len(a)] = a.to(padded)
+    return padded
 
-            # compute the loss for classification
-            targets = torch.ones(classification.shape) * -1
 
-            if torch.cuda.is_available():
-                targets = targets.cuda()
+class FocalLoss(nn.Module):
+    # def __init__(self):
 
-            targets[torch.lt(IoU_max, 0.4), :] = 0
+    def forward(self, classifications, regressions, anchors, annotations):
+        """Focal loss and smooth L1 loss of the whole batch at once.
 
-            positive_indices = torch.ge(IoU_max, 0.5)
+        Args:
+            classifications(Tensor): [B, N, num_classes]
+            regressions(Tensor): [B, N, 4]
+            anchors(Tensor): [1, N, 4]
+            annotations: list of [M_j, 5] Tensors, or [B, M, 5] padded with label -1
 
-            num_positive_anchors = positive_indices.sum()
+        Returns:
+            tuple: (classification loss [1], regression loss [1]), mean of the images
+        """
+        alpha = 0.25
+        gamma = 2.0
+        batch_size = classifications.shape[0]
 
-            assigned_annotations = bbox_annotation[IoU_argmax, :]
+        anchor = anchors[0, :, :]
 
-            targets[positive_indices, :] = 0
-            targets[positive_indices, assigned_annotations[positive_indices, 4].long()] = 1
+        anchor_widths = anchor[:, 2] - anchor[:, 0]
+        anchor_heights = anchor[:, 3] - anchor[:, 1]
+        anchor_ctr_x = anchor[:, 0] + 0.5 * anchor_widths
+        anchor_ctr_y = anchor[:, 1] + 0.5 * anchor_heights
 
-            if torch.cuda.is_available():
-                alpha_factor = torch.ones(targets.shape).cuda() * alpha
-            else:
-                alpha_factor = torch.ones(targets.shape) * alpha
+        annotations = pad_annotations(annotations, classifications.device)  # [B, M, 5]
+        valid = annotations[:, :, 4] != -1
 
-            alpha_factor = torch.where(torch.eq(targets, 1.), alpha_factor, 1. - alpha_factor)
-            focal_weight = torch.where(torch.eq(targets, 1.), 1. - classification, classification)
-            focal_weight = alpha_factor * torch.pow(focal_weight, gamma)
+        IoU = calc_iou_batch(anchor, annotations[:, :, :4], valid)  # [B, num_anchors, M]
+        IoU_max, IoU_argmax = torch.max(IoU, dim=2)  # [B, num_anchors]
 
-            bce = -(targets * torch.log(classification) + (1.0 - targets) * torch.log(1.0 - classification))
+        positive_indices = torch.ge(IoU_max, 0.5)
+        ignore_indices = torch.ge(IoU_max, 0.4) & ~positive_indices  # targets == -1
+        num_positive_anchors = positive_indices.sum(1)  # [B]
 
-            # cls_loss = focal_weight * torch.pow(bce, gamma)
-            cls_loss = focal_weight * bce
+        # [B, num_anchors, 5]
+        assigned_annotations = annotations.gather(1, IoU_argmax[..., None].expand(-1, -1, 5))
 
-            if torch.cuda.is_available():
-                cls_loss = torch.where(torch.ne(targets, -1.0), cls_loss, torch.zeros(cls_loss.shape).cuda())
-            else:
-                cls_loss = torch.where(torch.ne(targets, -1.0), cls_loss, torch.zeros(cls_loss.shape))
+        # compute the loss for classification
+        classification = torch.clamp(classifications, 1e-4, 1.0 - 1e-4)
 
-            classification_losses.append(cls_loss.sum() / torch.clamp(num_positive_anchors.float(), min=1.0))
+        # 所有类别先按负样本计算, 正样本所在的类别再替换成正样本的loss, 不需要生成targets和alpha_factor
+        negative_loss = (1. - alpha) * torch.pow(classification, gamma) * -torch.log(1.0 - classification)
+        cls_loss = negative_loss.sum(2)  # [B, num_anchors]
 
-            # compute the loss for regression
+        labels = assigned_annotations[:, :, 4].long().clamp(min=0)[..., None]
+        p = classification.gather(2, labels)[..., 0]
+        positive_loss = alpha * torch.pow(1. - p, gamma) * -torch.log(p)
+        cls_loss = cls_loss + torch.where(positive_indices, positive_loss - negative_loss.gather(2, labels)[..., 0],
+                                          torch.zeros_like(p))
+        cls_loss = torch.where(ignore_indices, torch.zeros_like(cls_loss), cls_loss)
 
-            if positive_indices.sum() > 0:
-                assigned_annotations = assigned_annotations[positive_indices, :]
+        classification_losses = cls_loss.sum(1) / torch.clamp(num_positive_anchors.float(), min=1.0)
 
-                anchor_widths_pi = anchor_widths[positive_indices]
-                anchor_heights_pi = anchor_heights[positive_indices]
-                anchor_ctr_x_pi = anchor_ctr_x[positive_indices]
-                anchor_ctr_y_pi = anchor_ctr_y[positive_indices]
+        # compute the loss for regression
+        batch_idx, anchor_idx = positive_indices.nonzero(as_tuple=True)
+        assigned = assigned_annotations[batch_idx, anchor_idx]
 
-                gt_widths = assigned_annotations[:, 2] - assigned_annotations[:, 0]
-                gt_heights = assigned_annotations[:, 3] - assigned_annotations[:, 1]
-                gt_ctr_x = assigned_annotations[:, 0] + 0.5 * gt_widths
-                gt_ctr_y = assigned_annotations[:, 1] + 0.5 * gt_heights
+        anchor_widths_pi = anchor_widths[anchor_idx]
+        anchor_heights_pi = anchor_heights[anchor_idx]
+        anchor_ctr_x_pi = anchor_ctr_x[anchor_idx]
+        anchor_ctr_y_pi = anchor_ctr_y[anchor_idx]
 
-                # clip widths to 1
-                gt_widths = torch.clamp(gt_widths, min=1)
-                gt_heights = torch.clamp(gt_heights, min=1)
+        gt_widths = assigned[:, 2] - assigned[:, 0]
+        gt_heights = assigned[:, 3] - assigned[:, 1]
+        gt_ctr_x = assigned[:, 0] + 0.5 * gt_widths
+        gt_ctr_y = assigned[:, 1] + 0.5 * gt_heights
 
-                targets_dx = (gt_ctr_x - anchor_ctr_x_pi) / anchor_widths_pi
-                targets_dy = (gt_ctr_y - anchor_ctr_y_pi) / anchor_heights_pi
-                targets_dw = torch.log(gt_widths / anchor_widths_pi)
-                targets_dh = torch.log(gt_heights / anchor_heights_pi)
+        # clip widths to 1
+        gt_widths = torch.clamp(gt_widths, min=1)
+        gt_heights = torch.clamp(gt_heights, min=1)
 
-                targets = torch.stack((targets_dx, targets_dy, targets_dw, targets_dh))
-                targets = targets.t()
+        targets_dx = (gt_ctr_x - anchor_ctr_x_pi) / anchor_widths_pi
+        targets_dy = (gt_ctr_y - anchor_ctr_y_pi) / anchor_heights_pi
+        targets_dw = torch.log(gt_widths / anchor_widths_pi)
+        targets_dh = torch.log(gt_heights / anchor_heights_pi)
 
-                if torch.cuda.is_available():
-                    targets = targets / torch.Tensor([[0.1, 0.1, 0.2, 0.2]]).cuda()
-                else:
-                    targets = targets / torch.Tensor([[0.1, 0.1, 0.2, 0.2]])
+        targets = torch.stack((targets_dx, targets_dy, targets_dw, targets_dh), dim=1)
+        targets = targets / targets.new_tensor([[0.1, 0.1, 0.2, 0.2]])
 
-                negative_indices = 1 + (~positive_indices)
+        regression_diff = torch.abs(targets - regressions[batch_idx, anchor_idx, :])
 
-                regression_diff = torch.abs(targets - regression[positive_indices, :])
+        regression_loss = torch.where(
+            torch.le(regression_diff, 1.0 / 9.0),
+            0.5 * 9.0 * torch.pow(regression_diff, 2),
+            regression_diff - 0.5 / 9.0
+        )
 
-                regression_loss = torch.where(
-                    torch.le(regression_diff, 1.0 / 9.0),
-                    0.5 * 9.0 * torch.pow(regression_diff, 2),
-                    regression_diff - 0.5 / 9.0
-                )
-                regression_losses.append(regression_loss.mean())
-            else:
-                if torch.cuda.is_available():
-                    regression_losses.append(torch.tensor(0).float().cuda())
-                else:
-                    regression_losses.append(torch.tensor(0).float())
+        # 每张图的mean, 没有正样本的图loss为0
+        regression_losses = regression_loss.new_zeros(batch_size).index_add_(0, batch_idx, regression_loss.sum(1))
+        regression_losses = regression_losses / torch.clamp(num_positive_anchors.float() * 4, min=1.0)
 
-        return torch.stack(classification_losses).mean(dim=0, keepdim=True), torch.stack(regression_losses).mean(dim=0,
-                                                                                                                 keepdim=True)
\ No newline at end of file
+        return classification_losses.mean(dim=0, keepdim=True), regression_losses.mean(dim=0, keepdim=True)
\ No newline at end of file
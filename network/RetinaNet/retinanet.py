@@ -6,6 +6,7 @@ from torchvision.ops import nms
 from network.RetinaNet.utils import BasicBlock, Bottleneck, BBoxTransform, ClipBoxes
 from network.RetinaNet.anchors import Anchors
 from network.RetinaNet import losses
+from utils.postprocess import gather_boxes
 
 model_urls = {
     'resnet18': 'https://download.pytorch.org/models/resnet18-5c106cde.pth',
@@ -188,6 +189,8 @@ class ResNet(nn.Module):
 
         self.focalLoss = losses.FocalLoss()
 
+        self.pre_nms_topk = None  # 测试时每个level只解码分数最高的pre_nms_topk个anchor
+
         for m in self.modules():
             if isinstance(m, nn.Conv2d):
                 n = m.kernel_size[0] * m.kernel_size[1] * m.out_channels
@@ -256,45 +259,42 @@ class ResNet(nn.Module):
         if self.training:
             return self.focalLoss(classification, regression, anchors, annotations)
         else:
+            if self.pre_nms_topk:
+                sizes = [f.shape[2] * f.shape[3] * self.classificationModel.num_anchors for f in features]
+                anchors, regression, classification = self.select_topk(anchors, regression, classification, sizes)
+
             transformed_anchors = self.regressBoxes(anchors, regression)
             transformed_anchors = self.clipBoxes(transformed_anchors, img_batch)
 
-            finalResult = [[], [], []]
-
-            finalScores = torch.Tensor([])
-            finalAnchorBoxesIndexes = torch.Tensor([]).long()
-            finalAnchorBoxesCoordinates = torch.Tensor([])
-
-            if torch.cuda.is_available():
-                finalScores = finalScores.cuda()
-                finalAnchorBoxesIndexes = finalAnchorBoxesIndexes.cuda()
-                finalAnchorBoxesCoordinates = finalAnchorBoxesCoordinates.cuda()
+            # [B, N, 4] boxes, [B, N, num_classes] scores, thresholding and NMS are done by utils/postprocess.py
+            return transformed_anchors, classification
 
-            for i in range(classification.shape[2]):
-                scores = torch.squeeze(classification[:, :, i])
-                scores_over_thresh = (scores > 0.05)
-                if scores_over_thresh.sum() == 0:
-                    # no boxes to NMS, just continue
-                    continue
+    def select_topk(self, anchors, regression, classification, sizes):
+        """Keep the pre_nms_topk anchors with the highest class score of every pyramid level.
 
-                scores = scores[scores_over_thresh]
-                anchorBoxes = torch.squeeze(transformed_anchors)
-                anchorBoxes = anchorBoxes[scores_over_thresh]
-                anchors_nms_idx = nms(anchorBoxes, scores, 0.5)
+        Args:
+            anchors(Tensor): [1, N, 4]
+            regression(Tensor): [B, N, 4]
+            classification(Tensor): [B, N, num_classes]
+            sizes(list): number of anchors of every level, sum(sizes) == N
 
-                finalResult[0].extend(scores[anchors_nms_idx])
-                finalResult[1].extend(torch.tensor([i] * anchors_nms_idx.shape[0]))
-                finalResult[2].extend(anchorBoxes[anchors_nms_idx])
+        Returns:
+            tuple: (anchors [B, n, 4], regression [B, n, 4], classification [B, n, num_classes])
 
-                finalScores = torch.cat((finalScores, scores[anchors_nms_idx]))
-                finalAnchorBoxesIndexesValue = torch.tensor([i] * anchors_nms_idx.shape[0])
-                if torch.cuda.is_available():
-                    finalAnchorBoxesIndexesValue = finalAnchorBoxesIndexesValue.cuda()
+        """
+        batch_size = classification.shape[0]
+        max_scores = classification.max(2)[0]
 
-                finalAnchorBoxesIndexes = torch.cat((finalAnchorBoxesIndexes, finalAnchorBoxesIndexesValue))
-                finalAnchorBoxesCoordinates = torch.cat((finalAnchorBoxesCoordinates, anchorBoxes[anchors_nms_idx]))
+        indices = []
+        start = 0
+        for size in sizes:
+            k = min(self.pre_nms_topk, size)
+            indices.append(max_scores[:, start: start + size].topk(k, dim=1)[1] + start)
+            start += size
+        indices = torch.cat(indices, dim=1)
 
-            return finalScores, finalAnchorBoxesIndexes, finalAnchorBoxesCoordinates
+        anchors = anchors.expand(batch_size, -1, -1)
+        return gather_boxes(anchors, indices), gather_boxes(regression, indices), gather_boxes(classification, indices)
 
 
 
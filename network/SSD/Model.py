@@ -15,18 +15,53 @@ from optimizer import get_optimizer
 from scheduler import get_scheduler
 
 from network.base_model import BaseModel
+from utils.postprocess import get_postprocess_config
 from mscv import ExponentialMovingAverage, print_network, load_checkpoint, save_checkpoint
 from mscv.summary import write_image
 # from mscv.cnn import normal_init
 
 import misc_utils as utils
 
+CENTER_VARIANCE = 0.1
+SIZE_VARIANCE = 0.2
+THRESHOLD = 0.5
+
+
+def get_target_transform(opt):
+    return SSDTargetTransform(PriorBox(opt)(), CENTER_VARIANCE, SIZE_VARIANCE, THRESHOLD)
+
+
+def to_ssd_targets(image, bboxes, labels):
+    """bboxes normalized by the image size and labels from 1 (0 is the background), the sample is not modified."""
+    height, width = image.shape[-2:]
+    scale = torch.tensor([width, height, width, height], dtype=torch.float32)
+    bboxes = [torch.as_tensor(bbox).float() / scale for bbox in bboxes]
+    labels = [torch.as_tensor(label).long() + 1 for label in labels]
+    return bboxes, labels
+
+
+class PriorTargets(object):
+    """--collate_targets, 在dataloader的worker里给整个batch匹配prior, sample['prior_targets']直接用于训练.
+    """
+    def __init__(self):
+        self.target_transform = None
+
+    def __call__(self, sample):
+        if self.target_transform is None:  # 在worker里第一次用到时创建
+            self.target_transform = get_target_transform(opt)
+
+        bboxes, labels = to_ssd_targets(sample['image'], sample['bboxes'], sample['labels'])
+        sample['prior_targets'] = self.target_transform.batch(bboxes, labels)
+        return sample
+
 
 class Model(BaseModel):
     def __init__(self, opt):
         super(Model, self).__init__()
         self.opt = opt
         self.detector = SSDDetector(opt).to(device=opt.device)
+        self.postprocess_cfg = get_postprocess_config(opt, conf_thresh=0.5, nms_thresh=0.45, max_per_image=100)
+        self.detector.box_head.post_processor.cfg = self.postprocess_cfg
         #####################
         #    Init weights
         #####################
@@ -40,14 +75,7 @@ class Model(BaseModel):
         self.avg_meters = ExponentialMovingAverage(0.95)
         self.save_dir = os.path.join(opt.checkpoint_dir, opt.tag)
 
-        CENTER_VARIANCE = 0.1
-        SIZE_VARIANCE = 0.2
-        THRESHOLD = 0.5
-
-        self.target_transform = SSDTargetTransform(PriorBox(opt)(),
-                                   CENTER_VARIANCE,
-                                   SIZE_VARIANCE,
-                                   THRESHOLD)
+        self.target_transform = get_target_transform(opt)
 
     def update(self, sample, *arg):
         """
@@ -75,22 +103,18 @@ class Model(BaseModel):
             return self.forward_test(sample)
 
     def forward_train(self, sample):
-        labels = sample['labels']
-        for label in labels:
-            label += 1.  # effdet的label从1开始
-
-        image, bboxes, labels = sample['image'], sample['bboxes'], sample['labels']
-
-        for box in bboxes:
-            box[:, 0::2] /= 512  # width
-            box[:, 1::2] /= 512  # height
+        image = sample['image']
 
-        for b in range(len(labels)):
-            bboxes[b], labels[b] = self.target_transform(bboxes[b], labels[b])
+        if 'prior_targets' in sample:  # --collate_targets, 已经在dataloader里匹配好
+            bboxes, labels = sample['prior_targets']
+        else:
+            # 整个batch一起在device上匹配
+            bboxes, labels = to_ssd_targets(image, sample['bboxes'], sample['labels'])
+            bboxes, labels = self.target_transform.batch(bboxes, labels, opt.device)
 
         image = image.to(opt.device)
-        bboxes = torch.stack(bboxes).to(opt.device)
-        labels = torch.stack(labels).long().to(opt.device)
+        bboxes = bboxes.to(opt.device)
+        labels = labels.long().to(opt.device)
 
         targets = {'boxes': bboxes, 'labels': labels}
 
@@ -99,29 +123,8 @@ class Model(BaseModel):
         return loss_dict
 
     def forward_test(self, image):
-        conf_thresh = 0.5
-
-        batch_bboxes = []
-        batch_labels = []
-        batch_scores = []
-
-        outputs = self.detector(image)
-
-        for b in range(len(outputs)):  #
-            output = outputs[b]
-            boxes = output['boxes']
-            labels = output['labels']
-            scores = output['scores']
-            boxes = boxes[scores > conf_thresh]
-            labels = labels[scores > conf_thresh]
-            labels = labels - 1
-            scores = scores[scores > conf_thresh]
-
-            batch_bboxes.append(boxes.detach().cpu().numpy())
-            batch_labels.append(labels.detach().cpu().numpy())
-            batch_scores.append(scores.detach().cpu().numpy())
-
-        return batch_bboxes, batch_labels, batch_scores
+        # 后处理参数见self.postprocess_cfg
+        return self.detector(image)
 
     def inference(self, x, progress_idx=None):
         raise NotImplementedError
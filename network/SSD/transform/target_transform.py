@@ -23,3 +23,29 @@ class SSDTargetTransform:
         locations = box_utils.convert_boxes_to_locations(boxes, self.center_form_priors, self.center_variance, self.size_variance)
 
         return locations, labels
+
+    def batch(self, gt_boxes, gt_labels, device=None):
+        """Match the priors of a whole batch at once.
+
+        Args:
+            gt_boxes: list of (num_targets, 4) normalized corner form boxes.
+            gt_labels: list of (num_targets) labels, 0 is the background.
+            device: device to match on, cpu by default (e.g. in dataloader workers).
+        Returns:
+            locations (batch_size, num_priors, 4), labels (batch_size, num_priors)
+        """
+        max_num = max([len(boxes) for boxes in gt_boxes] + [1])
+        padded_boxes = torch.zeros([len(gt_boxes), max_num, 4], device=device)
+        padded_labels = torch.full([len(gt_boxes), max_num], -1, dtype=torch.long, device=device)
+        for i, (boxes, labels) in enumerate(zip(gt_boxes, gt_labels)):
+            if len(boxes):
+                padded_boxes[i, :len(boxes)] = torch.as_tensor(boxes).to(padded_boxes)
+                padded_labels[i, :len(boxes)] = torch.as_tensor(labels).view(-1).to(padded_labels)
+
+        priors = self.corner_form_priors.to(padded_boxes)
+        boxes, labels = box_utils.assign_priors_batch(padded_boxes, padded_labels, priors, self.iou_threshold)
+        boxes = box_utils.corner_form_to_center_form(boxes)
+        locations = box_utils.convert_boxes_to_locations(boxes, self.center_form_priors.to(boxes),
+                                                         self.center_variance, self.size_variance)
+
+        return locations, labels
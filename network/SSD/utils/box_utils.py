@@ -101,6 +101,45 @@ def assign_priors(gt_boxes, gt_labels, corner_form_priors,
     return boxes, labels
 
 
+def assign_priors_batch(gt_boxes, gt_labels, corner_form_priors, iou_threshold):
+    """Assign ground truth boxes and targets to priors for a whole batch, same results as assign_priors of every image.
+
+    Args:
+        gt_boxes (batch_size, num_targets, 4): ground truth boxes, padded.
+        gt_labels (batch_size, num_targets): labels of targets, -1 for padding.
+        corner_form_priors (num_priors, 4): corner form priors
+    Returns:
+        boxes (batch_size, num_priors, 4): real values for priors.
+        labels (batch_size, num_priros): labels for priors.
+    """
+    batch_size, num_targets = gt_labels.shape
+    num_priors = corner_form_priors.size(0)
+    valid = gt_labels >= 0
+    # size: batch_size x num_priors x num_targets, padding is -1
+    ious = iou_of(gt_boxes.unsqueeze(1), corner_form_priors.view(1, -1, 1, 4))
+    ious = ious.masked_fill(~valid.unsqueeze(1), -1)
+    # size: batch_size x num_priors
+    best_target_per_prior, best_target_per_prior_index = ious.max(2)
+    # size: batch_size x num_targets
+    best_prior_per_target_index = ious.argmax(1)
+
+    # 同一个prior是多个target的最佳prior时, 和assign_priors的循环一样保留最后一个target
+    batch_idx, target_idx = valid.nonzero(as_tuple=True)
+    prior_idx = batch_idx * num_priors + best_prior_per_target_index[batch_idx, target_idx]
+    order = (prior_idx * num_targets + target_idx).argsort()
+    prior_idx, target_idx = prior_idx[order], target_idx[order]
+    last = torch.ones_like(prior_idx, dtype=torch.bool)
+    last[:-1] = prior_idx[1:] != prior_idx[:-1]
+    best_target_per_prior_index.view(-1)[prior_idx[last]] = target_idx[last]
+    # 2.0 is used to make sure every target has a prior assigned
+    best_target_per_prior.view(-1)[prior_idx] = 2
+    # size: batch_size x num_priors
+    labels = gt_labels.gather(1, best_target_per_prior_index)
+    labels[best_target_per_prior < iou_threshold] = 0  # the backgournd id
+    boxes = gt_boxes.gather(1, best_target_per_prior_index.unsqueeze(-1).expand(-1, -1, 4))
+    return boxes, labels
+
+
 def hard_negative_mining(loss, labels, neg_pos_ratio):
     """
     It used to suppress the presence of a large number of negative prediction.
@@ -9,9 +9,7 @@ import torch.nn as nn
 from .yolo.darknet import Darknet
 from .yolo.utils import get_all_boxes
 from .yolo.image import correct_yolo_boxes
-from utils import to_numpy, xywh_to_xyxy, keep
-
-from torchvision.ops import nms
+from utils.postprocess import postprocess, get_postprocess_config
 
 from options import opt
 
@@ -26,7 +24,8 @@ from mscv.summary import write_loss
 import misc_utils as utils
 import ipdb
 
-conf_thresh = 0.005
+# 默认的后处理参数, 可以用--postprocess和--conf_thresh等参数修改
+conf_thresh = 0.005  # objectness的阈值
 cls_thresh = 0.01
 nms_thresh = 0.45
 DO_FAST_EVAL = False  # 只保留概率最高的类，能够加快eval速度但会降低精度
@@ -46,6 +45,9 @@ class Model(BaseModel):
         self.detector = Darknet(cfgfile, device=opt.device).to(opt.device)
         print_network(self.detector)
 
+        self.postprocess_cfg = get_postprocess_config(opt, conf_thresh=conf_thresh, nms_thresh=nms_thresh,
+                                                      max_per_image=None, multi_label=not DO_FAST_EVAL)
+
         # 在--load之前加载weights文件(可选)
         if opt.weights:
             utils.color_print('Load Yolo weights from %s.' % opt.weights, 3)
@@ -97,63 +99,38 @@ class Model(BaseModel):
         Args:
             image: [b, 3, h, w] Tensor
         """
-        batch_bboxes = []
-        batch_labels = []
-        batch_scores = []
-
         if self.detector.net_name() == 'region':  # region_layer
             shape = (0, 0)
         else:
-            shape = (opt.width, opt.height)
+            shape = (image.shape[3], image.shape[2])  # 输入可以不是正方形(--rect_eval)
 
         num_classes = self.detector.num_classes
+        cfg = self.postprocess_cfg
 
         outputs = self.detector(image)
 
-        outputs = get_all_boxes(outputs, shape, conf_thresh, num_classes,
+        outputs = get_all_boxes(outputs, shape, cfg.conf_thresh, num_classes,
                                   device=opt.device, only_objectness=False,
-                                  validation=True)
-
-        # ipdb.set_trace()
-
-        for b in range(image.shape[0]):
-            preds = outputs[b]
-            preds = preds[preds[:, 4] > conf_thresh]
-
-            boxes = preds[:, :4]
-            det_conf = preds[:, 4]
-            cls_conf = preds[:, 5:]
+                                  validation=True, topk=cfg.pre_nms_topk)
 
-            b, c, h, w = image.shape
+        b, c, h, w = image.shape
 
-            boxes = xywh_to_xyxy(boxes, w, h)  # yolo的xywh转成输出的xyxy
+        """yolo的xywh转成输出的xyxy"""
+        xy, wh = outputs[..., 0:2], outputs[..., 2:4]
+        boxes = torch.cat([xy - wh / 2, xy + wh / 2], dim=2).clamp(min=0, max=1)
+        boxes = boxes * boxes.new_tensor([w, h, w, h])
 
-            nms_indices = nms(boxes, det_conf, nms_thresh)
-            if len(nms_indices) == 0:
-                batch_bboxes.append(np.array([[]], np.float32))
-                batch_labels.append(np.array([], np.int32))
-                batch_scores.append(np.array([], np.float32))
-                continue
-
-            boxes, det_conf, cls_conf = keep(nms_indices, [boxes, det_conf, cls_conf])
-            max_conf, labels = torch.max(cls_conf, 1)
-
-            scores = det_conf * max_conf
-
-            if not DO_FAST_EVAL:  # 只保留概率最高的类，能够加快eval速度但会降低精度
-                repeat_boxes = boxes.repeat([num_classes, 1])
-                repeat_det_conf = det_conf.repeat(num_classes)
-                repeat_conf = cls_conf.transpose(1, 0).contiguous().view(-1)
-                repeat_labels = torch.linspace(0, num_classes-1, num_classes).repeat(boxes.shape[0], 1).transpose(1, 0).contiguous().view(-1)
-
-                boxes, det_conf, cls_conf, labels = keep(repeat_conf>cls_thresh, [repeat_boxes, repeat_det_conf, repeat_conf, repeat_labels])
-                scores = det_conf * cls_conf
-
-            batch_bboxes.append(to_numpy(boxes))
-            batch_labels.append(to_numpy(labels, np.int32))
-            batch_scores.append(to_numpy(scores))
+        det_conf = outputs[..., 4:5]
+        cls_conf = outputs[..., 5:]
+        if not cfg.multi_label:  # 只保留概率最高的类，能够加快eval速度但会降低精度
+            scores = det_conf * cls_conf
+        else:
+            scores = det_conf * cls_conf * (cls_conf > cls_thresh)
+        scores = scores * (det_conf > cfg.conf_thresh)  # conf_thresh是objectness的阈值
 
-        return batch_bboxes, batch_labels, batch_scores
+        return postprocess(boxes, scores, conf_thresh=0., nms_thresh=cfg.nms_thresh,
+                           max_per_image=cfg.max_per_image, multi_label=cfg.multi_label, agnostic=cfg.agnostic,
+                           pre_nms_topk=cfg.pre_nms_topk)
 
 
     def evaluate(self, dataloader, epoch, writer, logger, data_name='val'):
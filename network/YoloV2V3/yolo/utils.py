@@ -75,13 +75,78 @@ def multi_bbox_ious(boxes1, boxes2, x1y1x2y2=True):
     uarea = area1 + area2 - carea
     return carea/uarea
 
+def match_targets(pred_boxes, target, anchors, nH, nW, wh_scale, ignore_thresh):
+    """
+    build_targets中和循环无关的部分, 一次处理整个batch的所有gt (RegionLayer和YoloLayer共用)
+
+    Args:
+        pred_boxes: [nB * nA * nH * nW, 4] 预测框 (x, y, w, h), x和y以grid为单位
+        target: [nB, 50 * 5] (cls, x, y, w, h), 归一化到[0, 1], 第一个x为0的框之后的框都忽略
+        anchors: [nA, anchor_step] Tensor, (w, h)的单位和wh_scale一致, anchor_step为4时后两列是anchor的(x, y)
+        wh_scale: (scale_w, scale_h), gt的w和h乘以它们
+        ignore_thresh: 和任意gt的IoU大于它的预测框不计算noobj loss
+
+    Returns:
+        dict: 'ignore': [nB, nA, nH, nW] bool,
+              以下都是[nGT]: 'b', 'best_n', 'gj', 'gi', 'gx', 'gy', 'gw', 'gh', 'cls', 'wh'(归一化的w*h),
+              'iou'(gt和对应预测框的IoU), 'last'(同一个cell有多个gt时只有最后一个为True, 和原来逐个赋值的结果相同)
+    """
+    nB = target.size(0)
+    nA = anchors.size(0)
+    device = pred_boxes.device
+
+    tbox = target.view(nB, -1, 5).to(device=device, dtype=pred_boxes.dtype)
+    valid = (tbox[:, :, 1] != 0).long().cumprod(1).bool()
+
+    gx = tbox[:, :, 1] * nW
+    gy = tbox[:, :, 2] * nH
+    gw = tbox[:, :, 3] * wh_scale[0]
+    gh = tbox[:, :, 4] * wh_scale[1]
+
+    # [nB, nA * nH * nW, 50], 所有预测框和所有gt一次计算IoU
+    pred = pred_boxes.view(nB, -1, 1, 4).permute(3, 0, 1, 2)
+    ious = multi_bbox_ious(pred, torch.stack((gx, gy, gw, gh))[:, :, None, :], x1y1x2y2=False)
+    ious = torch.where(valid[:, None, :], ious, torch.zeros_like(ious))
+    ignore = (ious.max(2)[0] > ignore_thresh).view(nB, nA, nH, nW)
+
+    b, t = valid.nonzero(as_tuple=True)
+    gx, gy, gw, gh = gx[b, t], gy[b, t], gw[b, t], gh[b, t]
+    gi, gj = gx.long(), gy.long()
+
+    # 形状最接近的anchor, [nGT, nA]
+    zeros = torch.zeros_like(gw)
+    anchor_boxes = torch.cat((torch.zeros_like(anchors[:, :2]), anchors[:, :2]), 1).t()[:, None, :]
+    anchor_ious = multi_bbox_ious(anchor_boxes, torch.stack((zeros, zeros, gw, gh))[:, :, None], x1y1x2y2=False)
+    best_iou, best_n = torch.max(anchor_ious, 1)
+
+    if anchors.size(1) == 4:  # this part is not tested.
+        # IoU相同的anchor中选择中心离gt最近的
+        an_pos = anchors[:, 2:4]
+        dist = ((gi.float()[:, None] + an_pos[None, :, 0]) - gx[:, None]) ** 2 + \
+               ((gj.float()[:, None] + an_pos[None, :, 1]) - gy[:, None]) ** 2
+        dist = torch.where(anchor_ious == best_iou[:, None], dist, torch.full_like(dist, 10000))
+        _, best_n = torch.min(dist, 1)
+
+    cell = ((b * nA + best_n) * nH + gj) * nW + gi
+    iou = multi_bbox_ious(torch.stack((gx, gy, gw, gh)), pred_boxes[cell].t(), x1y1x2y2=False)
+
+    # 同一个cell的gt中只保留最后一个
+    num_gt = len(cell)
+    order = (cell * num_gt + torch.arange(num_gt, device=device)).argsort()
+    last = torch.ones(num_gt, dtype=torch.bool, device=device)
+    last[order[:-1]] = cell[order[1:]] != cell[order[:-1]]
+
+    return {'ignore': ignore, 'b': b, 'best_n': best_n, 'gj': gj, 'gi': gi, 'gx': gx, 'gy': gy, 'gw': gw, 'gh': gh,
+            'cls': tbox[b, t, 0], 'wh': tbox[b, t, 3] * tbox[b, t, 4], 'iou': iou, 'last': last}
+
+
 def convert2cpu(gpu_matrix):
     return torch.FloatTensor(gpu_matrix.size()).copy_(gpu_matrix)
 
 def convert2cpu_long(gpu_matrix):
     return torch.LongTensor(gpu_matrix.size()).copy_(gpu_matrix)
 
-def get_all_boxes(output, netshape, conf_thresh, num_classes, only_objectness=1, validation=False, device='cuda:0'):
+def get_all_boxes(output, netshape, conf_thresh, num_classes, only_objectness=1, validation=False, device='cuda:0', topk=None):
     """
     Args:
         output: 网络输出，格式如下
@@ -108,6 +173,7 @@ def get_all_boxes(output, netshape, conf_thresh, num_classes, only_objectness=1,
             ....
 
         ]
+        topk: 每个尺度每张图只解码objectness最高的topk个框, None表示全部解码
 
     Returns:
         all_boxes: [batch, N, 5 + num_classes] Tensor, N是bbox的数量, 
@@ -135,14 +201,15 @@ def get_all_boxes(output, netshape, conf_thresh, num_classes, only_objectness=1,
             num_anchors,
             only_objectness=only_objectness, 
             validation=validation, 
-            device=device
+            device=device,
+            topk=topk
         )
         all_boxes = torch.cat([all_boxes, b], dim=1)
 
     return all_boxes
 
 
-def get_region_boxes(output, netshape, conf_thresh, num_classes, anchors, num_anchors, only_objectness=1, validation=False, device='cuda:0'):
+def get_region_boxes(output, netshape, conf_thresh, num_classes, anchors, num_anchors, only_objectness=1, validation=False, device='cuda:0', topk=None):
     # device = torch.device("cuda" if use_cuda else "cpu")
     anchors = anchors.to(device)
     anchor_step = anchors.size(0)//num_anchors
@@ -152,42 +219,35 @@ def get_region_boxes(output, netshape, conf_thresh, num_classes, anchors, num_an
     assert(output.size(1) == (5+num_classes)*num_anchors)
     h = output.size(2)
     w = output.size(3)
-    cls_anchor_dim = batch*num_anchors*h*w
     if netshape[0] != 0:
         nw, nh = netshape
     else:
         nw, nh = w, h
 
-    t0 = time.time()
-    all_boxes = []
-    output = output.view(batch*num_anchors, 5+num_classes, h*w).transpose(0,1).contiguous().view(5+num_classes, cls_anchor_dim)
-
-    grid_x = torch.linspace(0, w-1, w).repeat(batch*num_anchors, h, 1).view(cls_anchor_dim).to(device)
-    grid_y = torch.linspace(0, h-1, h).repeat(w,1).t().repeat(batch*num_anchors, 1, 1).view(cls_anchor_dim).to(device)
-    ix = torch.LongTensor(range(0,2)).to(device)
-    anchor_w = anchors.view(num_anchors, anchor_step).index_select(1, ix[0]).repeat(batch, h*w).view(cls_anchor_dim)
-    anchor_h = anchors.view(num_anchors, anchor_step).index_select(1, ix[1]).repeat(batch, h*w).view(cls_anchor_dim)
-
-    xs, ys = output[0].sigmoid() + grid_x, output[1].sigmoid() + grid_y
-    ws, hs = output[2].exp() * anchor_w.detach(), output[3].exp() * anchor_h.detach()
-    det_confs = output[4].sigmoid()
-
-    # by ysyun, dim=1 means input is 2D or even dimension else dim=0
-    cls_confs = torch.nn.Softmax(dim=1)(output[5:5+num_classes].transpose(0,1)).detach()
-    cls_max_confs, cls_max_ids = torch.max(cls_confs, 1)
-    cls_max_confs = cls_max_confs.view(-1)
-    cls_max_ids = cls_max_ids.view(-1)
-    
-    sz_hw = h * w
-    sz_hwa = sz_hw * num_anchors
-
-    xs = (xs.view([batch, -1]) / w).unsqueeze(2)
-    ys = (ys.view([batch, -1]) / h).unsqueeze(2)
-    ws = (ws.view([batch, -1]) / nw).unsqueeze(2)
-    hs = (hs.view([batch, -1]) / nh).unsqueeze(2)
-
-    det_confs = det_confs.view([batch, -1]).unsqueeze(2)
-    cls_confs = cls_confs.view([batch, h * w * num_anchors, -1])
+    # [batch, num_anchors * h * w, 5 + num_classes], 第n个框是第n // (h*w)个anchor, 位置为n % (h*w)
+    output = output.view(batch, num_anchors, 5+num_classes, h*w).permute(0, 1, 3, 2).reshape(batch, num_anchors*h*w, 5+num_classes)
+
+    if topk is not None and 0 < topk < num_anchors*h*w:
+        # sigmoid是单调的, 直接用objectness的输出选出topk再解码
+        _, index = output[:, :, 4].topk(topk, dim=1)
+        output = output.gather(1, index.unsqueeze(2).expand(-1, -1, 5+num_classes))
+    else:
+        index = torch.arange(num_anchors*h*w, device=output.device).repeat(batch, 1)
+
+    pos = index % (h*w)
+    grid_x = (pos % w).float()
+    grid_y = (pos // w).float()
+    anchor_wh = anchors.view(num_anchors, anchor_step)[:, :2].detach()
+    anchor_w = anchor_wh[index // (h*w), 0]
+    anchor_h = anchor_wh[index // (h*w), 1]
+
+    xs = ((output[:, :, 0].sigmoid() + grid_x) / w).unsqueeze(2)
+    ys = ((output[:, :, 1].sigmoid() + grid_y) / h).unsqueeze(2)
+    ws = (output[:, :, 2].exp() * anchor_w / nw).unsqueeze(2)
+    hs = (output[:, :, 3].exp() * anchor_h / nh).unsqueeze(2)
+    det_confs = output[:, :, 4].sigmoid().unsqueeze(2)
+    cls_confs = torch.nn.Softmax(dim=2)(output[:, :, 5:5+num_classes]).detach()
+
     all_boxes = torch.cat([xs,ys,ws,hs,det_confs,cls_confs],2)
     return all_boxes
 
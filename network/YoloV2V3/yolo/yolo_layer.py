@@ -5,7 +5,7 @@ import time
 import torch
 import torch.nn as nn
 import torch.nn.functional as F
-from .utils import bbox_iou, multi_bbox_ious, convert2cpu
+from .utils import match_targets
 
 class YoloLayer(nn.Module):
     def __init__(self, anchor_mask=[], num_classes=0, anchors=[1.0], num_anchors=1, device=None):
@@ -36,69 +36,37 @@ class YoloLayer(nn.Module):
 
     def build_targets(self, pred_boxes, target, anchors, nA, nH, nW):
         nB = target.size(0)
-        anchor_step = anchors.size(1) # anchors[nA][anchor_step]
-        noobj_mask = torch.ones (nB, nA, nH, nW)
-        obj_mask   = torch.zeros(nB, nA, nH, nW)
-        coord_mask = torch.zeros(nB, nA, nH, nW)
-        tcoord     = torch.zeros( 4, nB, nA, nH, nW)
-        tconf      = torch.zeros(nB, nA, nH, nW)
-        tcls       = torch.zeros(nB, nA, nH, nW, self.num_classes)
-
-        nAnchors = nA*nH*nW
-        nPixels  = nH*nW
-        nGT = 0
-        nRecall = 0
-        nRecall75 = 0
-
-        # it works faster on CPU than on GPU.
-        anchors = anchors.to("cpu")
-
-        for b in range(nB):
-            cur_pred_boxes = pred_boxes[b*nAnchors:(b+1)*nAnchors].t()
-            cur_ious = torch.zeros(nAnchors)
-            tbox = target[b].view(-1,5).to("cpu")
-
-            for t in range(50):
-                if tbox[t][1] == 0:
-                    break
-                gx, gy = tbox[t][1] * nW, tbox[t][2] * nH
-                gw, gh = tbox[t][3] * self.net_width, tbox[t][4] * self.net_height
-                cur_gt_boxes = torch.FloatTensor([gx, gy, gw, gh]).repeat(nAnchors,1).t()
-                cur_ious = torch.max(cur_ious, multi_bbox_ious(cur_pred_boxes, cur_gt_boxes, x1y1x2y2=False))
-            ignore_ix = (cur_ious>self.ignore_thresh).view(nA,nH,nW)
-            noobj_mask[b][ignore_ix] = 0
-
-            for t in range(50):
-                if tbox[t][1] == 0:
-                    break
-                nGT += 1
-                gx, gy = tbox[t][1] * nW, tbox[t][2] * nH
-                gw, gh = tbox[t][3] * self.net_width, tbox[t][4] * self.net_height
-                gw, gh = gw.float(), gh.float()
-                gi, gj = int(gx), int(gy)
-
-                tmp_gt_boxes = torch.FloatTensor([0, 0, gw, gh]).repeat(nA,1).t()
-                anchor_boxes = torch.cat((torch.zeros(nA, anchor_step), anchors),1).t()
-                _, best_n = torch.max(multi_bbox_ious(anchor_boxes, tmp_gt_boxes, x1y1x2y2=False), 0)
-
-                gt_box = torch.FloatTensor([gx, gy, gw, gh])
-                pred_box = pred_boxes[b*nAnchors+best_n*nPixels+gj*nW+gi]
-                iou = bbox_iou(gt_box, pred_box, x1y1x2y2=False)
-
-                obj_mask  [b][best_n][gj][gi] = 1
-                noobj_mask[b][best_n][gj][gi] = 0
-                coord_mask[b][best_n][gj][gi] = 2. - tbox[t][3]*tbox[t][4]
-                tcoord [0][b][best_n][gj][gi] = gx - gi
-                tcoord [1][b][best_n][gj][gi] = gy - gj
-                tcoord [2][b][best_n][gj][gi] = math.log(gw/anchors[best_n][0])
-                tcoord [3][b][best_n][gj][gi] = math.log(gh/anchors[best_n][1])
-                tcls      [b][best_n][gj][gi][int(tbox[t][0])] = 1
-                tconf     [b][best_n][gj][gi] = iou if self.rescore else 1.
-
-                if iou > 0.5:
-                    nRecall += 1
-                    if iou > 0.75:
-                        nRecall75 += 1
+        device = pred_boxes.device
+        noobj_mask = torch.ones (nB, nA, nH, nW, device=device)
+        obj_mask   = torch.zeros(nB, nA, nH, nW, device=device)
+        coord_mask = torch.zeros(nB, nA, nH, nW, device=device)
+        tcoord     = torch.zeros( 4, nB, nA, nH, nW, device=device)
+        tconf      = torch.zeros(nB, nA, nH, nW, device=device)
+        tcls       = torch.zeros(nB, nA, nH, nW, self.num_classes, device=device)
+
+        # 整个batch的gt一起处理, 不再拷贝到cpu上逐个循环
+        m = match_targets(pred_boxes, target, anchors, nH, nW, (self.net_width, self.net_height), self.ignore_thresh)
+        noobj_mask[m['ignore']] = 0
+
+        # 所有gt的类别都置为1
+        tcls[m['b'], m['best_n'], m['gj'], m['gi'], m['cls'].long()] = 1
+
+        # 同一个cell有多个gt时保留最后一个
+        last = m['last']
+        b, best_n, gj, gi = m['b'][last], m['best_n'][last], m['gj'][last], m['gi'][last]
+
+        obj_mask  [b, best_n, gj, gi] = 1
+        noobj_mask[b, best_n, gj, gi] = 0
+        coord_mask[b, best_n, gj, gi] = 2. - m['wh'][last]
+        tcoord [0, b, best_n, gj, gi] = m['gx'][last] - gi.float()
+        tcoord [1, b, best_n, gj, gi] = m['gy'][last] - gj.float()
+        tcoord [2, b, best_n, gj, gi] = torch.log(m['gw'][last] / anchors[best_n, 0])
+        tcoord [3, b, best_n, gj, gi] = torch.log(m['gh'][last] / anchors[best_n, 1])
+        tconf     [b, best_n, gj, gi] = m['iou'][last] if self.rescore else 1.
+
+        nGT = len(m['iou'])
+        nRecall = int((m['iou'] > 0.5).sum())
+        nRecall75 = int((m['iou'] > 0.75).sum())
 
         return nGT, nRecall, nRecall75, obj_mask, noobj_mask, coord_mask, tcoord, tconf, tcls
 
@@ -137,8 +105,8 @@ class YoloLayer(nn.Module):
         pred_boxes[1] = coord[1] + grid_y
         pred_boxes[2] = coord[2].exp() * anchor_w
         pred_boxes[3] = coord[3].exp() * anchor_h
-        # for build_targets. it works faster on CPU than on GPU
-        pred_boxes = convert2cpu(pred_boxes.transpose(0,1).contiguous().view(-1,4)).detach()
+        # build_targets在同一个device上完成
+        pred_boxes = pred_boxes.transpose(0,1).contiguous().view(-1,4).detach()
 
         t2 = time.time()
         nGT, nRecall, nRecall75, obj_mask, noobj_mask, coord_mask, tcoord, tconf, tcls = \
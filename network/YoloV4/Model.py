@@ -17,7 +17,7 @@ from options import opt
 from optimizer import get_optimizer
 from scheduler import get_scheduler
 
-from torchvision.ops import nms
+from utils.postprocess import get_postprocess_config
 from network.base_model import BaseModel
 from mscv import ExponentialMovingAverage, print_network, load_checkpoint, save_checkpoint
 # from mscv.cnn import normal_init
@@ -25,6 +25,7 @@ from mscv.summary import write_image
 from network.YoloV4.loss import Yolo_loss
 from network.YoloV4 import config as cfg
 from network.YoloV4 import tools
+from network.YoloV4.tools.yolo_layer import YoloLayer
 
 import misc_utils as utils
 
@@ -40,7 +41,14 @@ class Model(BaseModel):
         # # replace the pre-trained head with a new one
         # self.detector.roi_heads.box_predictor = FastRCNNPredictor(in_features, opt.num_classes + 1)
         self.detector = yolov4(inference=True, n_classes=opt.num_classes)
-        
+
+        # 每个框只保留概率最高的类
+        self.postprocess_cfg = get_postprocess_config(opt, conf_thresh=0.001, nms_thresh=0.45, max_per_image=None,
+                                                      multi_label=False)
+        for m in self.detector.modules():
+            if isinstance(m, YoloLayer):
+                m.pre_nms_topk = self.postprocess_cfg.pre_nms_topk  # 每个尺度只解码topk个框
+
         # """
         # 预训练模型
         # """
@@ -88,69 +96,14 @@ class Model(BaseModel):
         return {}
 
     def forward(self, image):  # test
-        conf_thresh = 0.001
-        nms_thresh = 0.45
-
-        batch_bboxes = []
-        batch_labels = []
-        batch_scores = []
-
         box_array, confs = self.detector(image)
-        
-        # [batch, num, 1, 4], num=16128
-        box_array = box_array[:, :, 0] #.detach().cpu().numpy()
-        # [batch, num, num_classes]
-        # confs = confs.detach().cpu().numpy()
-
-        # ipdb.set_trace()
-
-        # max_conf = np.max(confs, axis=2)
-        # max_id = np.argmax(confs, axis=2)
-
-        max_conf, max_id = torch.max(confs, dim=2)
-        
-        b = box_array.shape[0]
 
-        for i in range(b):
-            argwhere = max_conf[i] > conf_thresh
-            l_box_array = box_array[i, argwhere, :]
-            l_max_conf = max_conf[i, argwhere]
-            l_max_id = max_id[i, argwhere]
-
-            boxes = []
-            labels = []
-            scores = []
-
-            for j in range(opt.num_classes):
-
-                cls_argwhere = l_max_id == j
-                ll_box_array = l_box_array[cls_argwhere, :]
-                ll_max_conf = l_max_conf[cls_argwhere]
-                ll_max_id = l_max_id[cls_argwhere]
-
-                # keep = nms_cpu(ll_box_array, ll_max_conf, nms_thresh)
-                keep = nms(ll_box_array, ll_max_conf, nms_thresh)
-                
-                if (keep.shape[0] > 0):
-                    ll_box_array = ll_box_array[keep]
-                    ll_box_array = torch.clamp(ll_box_array, min=0, max=1)
-                    ll_box_array[:, 0::2] *= opt.width
-                    ll_box_array[:, 1::2] *= opt.height
-
-                    ll_max_conf = ll_max_conf[keep]
-                    ll_max_id = ll_max_id[keep]
-
-                    boxes.extend(ll_box_array.detach().cpu().numpy().tolist())
-                    labels.extend(ll_max_id.detach().cpu().numpy().tolist())
-                    scores.extend(ll_max_conf.detach().cpu().numpy().tolist())
-                else:
-                    pass
-
-            batch_bboxes.append(np.array(boxes))
-            batch_labels.append(np.array(labels).astype(np.int32))
-            batch_scores.append(np.array(scores))
+        # [batch, num, 1, 4], num=16128
+        box_array = box_array[:, :, 0].clamp(min=0, max=1)
+        box_array = box_array * box_array.new_tensor([image.shape[3], image.shape[2], image.shape[3], image.shape[2]])  # 输入可以不是正方形(--rect_eval)
 
-        return batch_bboxes, batch_labels, batch_scores
+        # [batch, num, num_classes]
+        return self.postprocess_cfg(box_array, confs)
 
     def inference(self, x, progress_idx=None):
         raise NotImplementedError
@@ -91,6 +91,30 @@ def bboxes_iou(bboxes_a, bboxes_b, xyxy=True, GIoU=False, DIoU=False, CIoU=False
     return iou
 
 
+def bboxes_iou_batch(bboxes_a, bboxes_b):
+    """IoUs between (x, y, w, h) boxes of every image, same values as bboxes_iou(xyxy=False).
+    Args:
+        bboxes_a (Tensor): [B, N, 4]
+        bboxes_b (Tensor): [B, K, 4]
+    Returns:
+        Tensor: [B, N, K]
+    """
+    # intersection top left
+    tl = torch.max((bboxes_a[:, :, None, :2] - bboxes_a[:, :, None, 2:] / 2),
+                   (bboxes_b[:, None, :, :2] - bboxes_b[:, None, :, 2:] / 2))
+    # intersection bottom right
+    br = torch.min((bboxes_a[:, :, None, :2] + bboxes_a[:, :, None, 2:] / 2),
+                   (bboxes_b[:, None, :, :2] + bboxes_b[:, None, :, 2:] / 2))
+
+    area_a = torch.prod(bboxes_a[:, :, 2:], 2)
+    area_b = torch.prod(bboxes_b[:, :, 2:], 2)
+
+    en = (tl < br).type(tl.type()).prod(dim=3)
+    area_i = torch.prod(br - tl, 3) * en
+    area_u = area_a[:, :, None] + area_b[:, None, :] - area_i
+    return area_i / area_u
+
+
 class Yolo_loss(nn.Module):
     def __init__(self, n_classes=1, n_anchors=3, device=None, batch=2):
         super(Yolo_loss, self).__init__()
@@ -105,6 +129,7 @@ class Yolo_loss(nn.Module):
         self.ignore_thre = 0.5
 
         self.masked_anchors, self.ref_anchors, self.grid_x, self.grid_y, self.anchor_w, self.anchor_h = [], [], [], [], [], []
+        self.anch_mask_tensors = [torch.tensor(mask, device=device) for mask in self.anch_masks]
 
         for i in range(3):
             all_anchors_grid = [(w / self.strides[i], h / self.strides[i]) for w, h in self.anchors]
@@ -121,79 +146,83 @@ class Yolo_loss(nn.Module):
             anchor_h = torch.from_numpy(masked_anchors[:, 1]).repeat(batch, fsize, fsize, 1).permute(0, 3, 1, 2).to(
                 device)
 
-            self.masked_anchors.append(masked_anchors)
-            self.ref_anchors.append(ref_anchors)
+            self.masked_anchors.append(torch.from_numpy(masked_anchors).to(device))
+            self.ref_anchors.append(ref_anchors.to(device))
             self.grid_x.append(grid_x)
             self.grid_y.append(grid_y)
             self.anchor_w.append(anchor_w)
             self.anchor_h.append(anchor_h)
 
     def build_target(self, pred, labels, batchsize, fsize, n_ch, output_id):
-        # target assignment
+        # target assignment, 整个batch的所有truth一起处理
         tgt_mask = torch.zeros(batchsize, self.n_anchors, fsize, fsize, 4 + self.n_classes).to(device=self.device)
         obj_mask = torch.ones(batchsize, self.n_anchors, fsize, fsize).to(device=self.device)
         tgt_scale = torch.zeros(batchsize, self.n_anchors, fsize, fsize, 2).to(self.device)
         target = torch.zeros(batchsize, self.n_anchors, fsize, fsize, n_ch).to(self.device)
 
-        # labels = labels.cpu().data
+        labels = labels.to(pred.device)
         nlabel = (labels.sum(dim=2) > 0).sum(dim=1)  # number of objects
+        valid = torch.arange(labels.shape[1], device=labels.device)[None] < nlabel[:, None]  # 每张图的前nlabel个
+        if not valid.any():
+            return obj_mask, tgt_mask, tgt_scale, target
 
         truth_x_all = (labels[:, :, 2] + labels[:, :, 0]) / (self.strides[output_id] * 2)
         truth_y_all = (labels[:, :, 3] + labels[:, :, 1]) / (self.strides[output_id] * 2)
         truth_w_all = (labels[:, :, 2] - labels[:, :, 0]) / self.strides[output_id]
         truth_h_all = (labels[:, :, 3] - labels[:, :, 1]) / self.strides[output_id]
-        truth_i_all = truth_x_all.to(torch.int16).cpu().numpy()
-        truth_j_all = truth_y_all.to(torch.int16).cpu().numpy()
-
-        for b in range(batchsize):
-            n = int(nlabel[b])
-            if n == 0:
-                continue
-            truth_box = torch.zeros(n, 4).to(self.device)
-            truth_box[:n, 2] = truth_w_all[b, :n]
-            truth_box[:n, 3] = truth_h_all[b, :n]
-            truth_i = truth_i_all[b, :n]
-            truth_j = truth_j_all[b, :n]
-
-            # calculate iou between truth and reference anchors
-            anchor_ious_all = bboxes_iou(truth_box.cpu(), self.ref_anchors[output_id], CIoU=True)
-
-            # temp = bbox_iou(truth_box.cpu(), self.ref_anchors[output_id])
-
-            best_n_all = anchor_ious_all.argmax(dim=1)
-            best_n = best_n_all % 3
-            best_n_mask = ((best_n_all == self.anch_masks[output_id][0]) |
-                           (best_n_all == self.anch_masks[output_id][1]) |
-                           (best_n_all == self.anch_masks[output_id][2]))
-
-            if sum(best_n_mask) == 0:
-                continue
-
-            truth_box[:n, 0] = truth_x_all[b, :n]
-            truth_box[:n, 1] = truth_y_all[b, :n]
-
-            pred_ious = bboxes_iou(pred[b].view(-1, 4), truth_box, xyxy=False)
-            pred_best_iou, _ = pred_ious.max(dim=1)
-            pred_best_iou = (pred_best_iou > self.ignore_thre)
-            pred_best_iou = pred_best_iou.view(pred[b].shape[:3])
-            # set mask to zero (ignore) if pred matches truth
-            obj_mask[b] = ~ pred_best_iou
-
-            for ti in range(best_n.shape[0]):
-                if best_n_mask[ti] == 1:
-                    i, j = truth_i[ti], truth_j[ti]
-                    a = best_n[ti]
-                    obj_mask[b, a, j, i] = 1
-                    tgt_mask[b, a, j, i, :] = 1
-                    target[b, a, j, i, 0] = truth_x_all[b, ti] - truth_x_all[b, ti].to(torch.int16).to(torch.float)
-                    target[b, a, j, i, 1] = truth_y_all[b, ti] - truth_y_all[b, ti].to(torch.int16).to(torch.float)
-                    target[b, a, j, i, 2] = torch.log(
-                        truth_w_all[b, ti] / torch.Tensor(self.masked_anchors[output_id])[best_n[ti], 0] + 1e-16)
-                    target[b, a, j, i, 3] = torch.log(
-                        truth_h_all[b, ti] / torch.Tensor(self.masked_anchors[output_id])[best_n[ti], 1] + 1e-16)
-                    target[b, a, j, i, 4] = 1
-                    target[b, a, j, i, 5 + labels[b, ti, 4].to(torch.int16).cpu().numpy()] = 1
-                    tgt_scale[b, a, j, i, :] = torch.sqrt(2 - truth_w_all[b, ti] * truth_h_all[b, ti] / fsize / fsize)
+
+        b, t = valid.nonzero(as_tuple=True)
+        truth_x, truth_y = truth_x_all[b, t], truth_y_all[b, t]
+        truth_w, truth_h = truth_w_all[b, t], truth_h_all[b, t]
+
+        # calculate iou between truth and reference anchors
+        truth_box = torch.zeros(len(b), 4, device=pred.device)
+        truth_box[:, 2] = truth_w
+        truth_box[:, 3] = truth_h
+        anchor_ious_all = bboxes_iou(truth_box, self.ref_anchors[output_id], CIoU=True)
+
+        best_n_all = anchor_ious_all.argmax(dim=1)
+        best_n = best_n_all % 3
+        best_n_mask = (best_n_all[:, None] == self.anch_mask_tensors[output_id][None]).any(dim=1)
+
+        # 没有truth分配到这一层的图片不忽略任何预测框
+        has_truth = torch.zeros(batchsize, dtype=torch.bool, device=pred.device)
+        has_truth[b[best_n_mask]] = True
+
+        # set mask to zero (ignore) if pred matches truth
+        truth_boxes_all = torch.stack((truth_x_all, truth_y_all, truth_w_all, truth_h_all), dim=2)
+        pred_ious = bboxes_iou_batch(pred.view(batchsize, -1, 4), truth_boxes_all)
+        pred_ious = torch.where(valid[:, None, :], pred_ious, torch.zeros_like(pred_ious))
+        pred_best_iou = (pred_ious.max(dim=2)[0] > self.ignore_thre).view(pred.shape[:4])
+        obj_mask[has_truth] = (~pred_best_iou[has_truth]).float()
+
+        b, t, a = b[best_n_mask], t[best_n_mask], best_n[best_n_mask]
+        truth_x, truth_y = truth_x[best_n_mask], truth_y[best_n_mask]
+        truth_w, truth_h = truth_w[best_n_mask], truth_h[best_n_mask]
+        i, j = truth_x.to(torch.int16).long(), truth_y.to(torch.int16).long()
+
+        obj_mask[b, a, j, i] = 1
+        tgt_mask[b, a, j, i, :] = 1
+        target[b, a, j, i, 4] = 1
+        target[b, a, j, i, 5 + labels[b, t, 4].to(torch.int16).long()] = 1
+
+        # 同一个cell有多个truth时, 和逐个赋值一样保留最后一个
+        num_truth = len(b)
+        cell = ((b * self.n_anchors + a) * fsize + j) * fsize + i
+        order = (cell * num_truth + torch.arange(num_truth, device=cell.device)).argsort()
+        last = torch.ones(num_truth, dtype=torch.bool, device=cell.device)
+        last[order[:-1]] = cell[order[1:]] != cell[order[:-1]]
+
+        b, a, j, i = b[last], a[last], j[last], i[last]
+        truth_x, truth_y = truth_x[last], truth_y[last]
+        truth_w, truth_h = truth_w[last], truth_h[last]
+        masked_anchors = self.masked_anchors[output_id]
+
+        target[b, a, j, i, 0] = truth_x - truth_x.to(torch.int16).to(torch.float)
+        target[b, a, j, i, 1] = truth_y - truth_y.to(torch.int16).to(torch.float)
+        target[b, a, j, i, 2] = torch.log(truth_w / masked_anchors[a, 0] + 1e-16)
+        target[b, a, j, i, 3] = torch.log(truth_h / masked_anchors[a, 1] + 1e-16)
+        tgt_scale[b, a, j, i, :] = torch.sqrt(2 - truth_w * truth_h / fsize / fsize)[:, None]
         return obj_mask, tgt_mask, tgt_scale, target
 
     def forward(self, xin, labels=None):
@@ -1,302 +1,98 @@
 import torch.nn as nn
 import torch.nn.functional as F
 from .torch_utils import *
+from utils.grid_cache import get_grid, get_anchors
 
 
-def yolo_forward(output, conf_thresh, num_classes, anchors, num_anchors, scale_x_y, only_objectness=1,
-                 validation=False):
-    # Output would be invalid if it does not satisfy this assert
-    # assert (output.size(1) == (5 + num_classes) * num_anchors)
+def yolo_decode(output, num_classes, anchors, num_anchors, scale_x_y):
+    """Decode all boxes of a yolo layer on a single [batch, num_anchors, 5 + num_classes, H, W] view of the output,
+    grids and anchors are cached by shape (see utils/grid_cache.py).
 
-    # print(output.size())
-
-    # Slice the second dimension (channel) of output into:
-    # [ 2, 2, 1, num_classes, 2, 2, 1, num_classes, 2, 2, 1, num_classes ]
-    # And then into
-    # bxy = [ 6 ] bwh = [ 6 ] det_conf = [ 3 ] cls_conf = [ num_classes * 3 ]
-    batch = output.size(0)
-    H = output.size(2)
-    W = output.size(3)
-
-    bxy_list = []
-    bwh_list = []
-    det_confs_list = []
-    cls_confs_list = []
-
-    for i in range(num_anchors):
-        begin = i * (5 + num_classes)
-        end = (i + 1) * (5 + num_classes)
-
-        bxy_list.append(output[:, begin: begin + 2])
-        bwh_list.append(output[:, begin + 2: begin + 4])
-        det_confs_list.append(output[:, begin + 4: begin + 5])
-        cls_confs_list.append(output[:, begin + 5: end])
-
-    # Shape: [batch, num_anchors * 2, H, W]
-    bxy = torch.cat(bxy_list, dim=1)
-    # Shape: [batch, num_anchors * 2, H, W]
-    bwh = torch.cat(bwh_list, dim=1)
-
-    # Shape: [batch, num_anchors, H, W]
-    det_confs = torch.cat(det_confs_list, dim=1)
-    # Shape: [batch, num_anchors * H * W]
-    det_confs = det_confs.view(batch, num_anchors * H * W)
-
-    # Shape: [batch, num_anchors * num_classes, H, W]
-    cls_confs = torch.cat(cls_confs_list, dim=1)
-    # Shape: [batch, num_anchors, num_classes, H * W]
-    cls_confs = cls_confs.view(batch, num_anchors, num_classes, H * W)
-    # Shape: [batch, num_anchors, num_classes, H * W] --> [batch, num_anchors * H * W, num_classes]
-    cls_confs = cls_confs.permute(0, 1, 3, 2).reshape(batch, num_anchors * H * W, num_classes)
-
-    # Apply sigmoid(), exp() and softmax() to slices
-    #
-    bxy = torch.sigmoid(bxy) * scale_x_y - 0.5 * (scale_x_y - 1)
-    bwh = torch.exp(bwh)
-    det_confs = torch.sigmoid(det_confs)
-    cls_confs = torch.sigmoid(cls_confs)
-
-    # Prepare C-x, C-y, P-w, P-h (None of them are torch related)
-    grid_x = np.expand_dims(np.expand_dims(np.expand_dims(np.linspace(0, W - 1, W), axis=0).repeat(H, 0), axis=0),
-                            axis=0)
-    grid_y = np.expand_dims(np.expand_dims(np.expand_dims(np.linspace(0, H - 1, H), axis=1).repeat(W, 1), axis=0),
-                            axis=0)
-    # grid_x = torch.linspace(0, W - 1, W).reshape(1, 1, 1, W).repeat(1, 1, H, 1)
-    # grid_y = torch.linspace(0, H - 1, H).reshape(1, 1, H, 1).repeat(1, 1, 1, W)
-
-    anchor_w = []
-    anchor_h = []
-    for i in range(num_anchors):
-        anchor_w.append(anchors[i * 2])
-        anchor_h.append(anchors[i * 2 + 1])
-
-    device = None
-    cuda_check = output.is_cuda
-    if cuda_check:
-        device = output.get_device()
-
-    bx_list = []
-    by_list = []
-    bw_list = []
-    bh_list = []
-
-    # Apply C-x, C-y, P-w, P-h
-    for i in range(num_anchors):
-        ii = i * 2
-        # Shape: [batch, 1, H, W]
-        bx = bxy[:, ii: ii + 1] + torch.tensor(grid_x, device=device,
-                                               dtype=torch.float32)  # grid_x.to(device=device, dtype=torch.float32)
-        # Shape: [batch, 1, H, W]
-        by = bxy[:, ii + 1: ii + 2] + torch.tensor(grid_y, device=device,
-                                                   dtype=torch.float32)  # grid_y.to(device=device, dtype=torch.float32)
-        # Shape: [batch, 1, H, W]
-        bw = bwh[:, ii: ii + 1] * anchor_w[i]
-        # Shape: [batch, 1, H, W]
-        bh = bwh[:, ii + 1: ii + 2] * anchor_h[i]
-
-        bx_list.append(bx)
-        by_list.append(by)
-        bw_list.append(bw)
-        bh_list.append(bh)
-
-    ########################################
-    #   Figure out bboxes from slices     #
-    ########################################
-
-    # Shape: [batch, num_anchors, H, W]
-    bx = torch.cat(bx_list, dim=1)
-    # Shape: [batch, num_anchors, H, W]
-    by = torch.cat(by_list, dim=1)
-    # Shape: [batch, num_anchors, H, W]
-    bw = torch.cat(bw_list, dim=1)
-    # Shape: [batch, num_anchors, H, W]
-    bh = torch.cat(bh_list, dim=1)
-
-    # Shape: [batch, 2 * num_anchors, H, W]
-    bx_bw = torch.cat((bx, bw), dim=1)
-    # Shape: [batch, 2 * num_anchors, H, W]
-    by_bh = torch.cat((by, bh), dim=1)
-
-    # normalize coordinates to [0, 1]
-    bx_bw /= W
-    by_bh /= H
-
-    # Shape: [batch, num_anchors * H * W, 1]
-    bx = bx_bw[:, :num_anchors].view(batch, num_anchors * H * W, 1)
-    by = by_bh[:, :num_anchors].view(batch, num_anchors * H * W, 1)
-    bw = bx_bw[:, num_anchors:].view(batch, num_anchors * H * W, 1)
-    bh = by_bh[:, num_anchors:].view(batch, num_anchors * H * W, 1)
+    boxes: [batch, num_anchors * H * W, 1, 4], box n is anchor n // (H * W) at position n % (H * W)
+    confs: [batch, num_anchors * H * W, num_classes]
+    """
+    batch, _, H, W = output.shape
+    output = output.view(batch, num_anchors, 5 + num_classes, H, W)
 
-    bx1 = bx - bw * 0.5
-    by1 = by - bh * 0.5
-    bx2 = bx1 + bw
-    by2 = by1 + bh
+    # [H, W, 2] -> [2, H, W]
+    grid = get_grid(H, W, output.device, output.dtype).permute(2, 0, 1)
+    # [num_anchors, 2] -> [1, num_anchors, 2, 1, 1]
+    anchor_wh = get_anchors(anchors, output.device, output.dtype).view(1, num_anchors, 2, 1, 1)
+    size = output.new_tensor([W, H]).view(1, 1, 2, 1, 1)
 
-    # Shape: [batch, num_anchors * h * w, 4] -> [batch, num_anchors * h * w, 1, 4]
-    boxes = torch.cat((bx1, by1, bx2, by2), dim=2).view(batch, num_anchors * H * W, 1, 4)
-    # boxes = boxes.repeat(1, 1, num_classes, 1)
+    # Shape: [batch, num_anchors, 2, H, W], normalize coordinates to [0, 1]
+    bxy = (torch.sigmoid(output[:, :, 0:2]) * scale_x_y - 0.5 * (scale_x_y - 1) + grid) / size
+    bwh = torch.exp(output[:, :, 2:4]) * anchor_wh / size
 
-    # boxes:     [batch, num_anchors * H * W, 1, 4]
-    # cls_confs: [batch, num_anchors * H * W, num_classes]
-    # det_confs: [batch, num_anchors * H * W]
+    bxy1 = bxy - bwh * 0.5
+    bxy2 = bxy1 + bwh
 
-    det_confs = det_confs.view(batch, num_anchors * H * W, 1)
-    confs = cls_confs * det_confs
+    # Shape: [batch, num_anchors, 4, H, W] -> [batch, num_anchors * H * W, 1, 4]
+    boxes = torch.cat((bxy1, bxy2), dim=2).permute(0, 1, 3, 4, 2).reshape(batch, num_anchors * H * W, 1, 4)
 
-    # boxes: [batch, num_anchors * H * W, 1, 4]
-    # confs: [batch, num_anchors * H * W, num_classes]
+    # Shape: [batch, num_anchors, num_classes, H, W] -> [batch, num_anchors * H * W, num_classes]
+    confs = torch.sigmoid(output[:, :, 5:]) * torch.sigmoid(output[:, :, 4:5])
+    confs = confs.permute(0, 1, 3, 4, 2).reshape(batch, num_anchors * H * W, num_classes)
 
     return boxes, confs
 
 
-def yolo_forward_dynamic(output, conf_thresh, num_classes, anchors, num_anchors, scale_x_y, only_objectness=1,
-                         validation=False):
+def yolo_forward(output, conf_thresh, num_classes, anchors, num_anchors, scale_x_y, only_objectness=1,
+                 validation=False):
     # Output would be invalid if it does not satisfy this assert
     # assert (output.size(1) == (5 + num_classes) * num_anchors)
 
-    # print(output.size())
-
-    # Slice the second dimension (channel) of output into:
-    # [ 2, 2, 1, num_classes, 2, 2, 1, num_classes, 2, 2, 1, num_classes ]
-    # And then into
-    # bxy = [ 6 ] bwh = [ 6 ] det_conf = [ 3 ] cls_conf = [ num_classes * 3 ]
-    # batch = output.size(0)
-    # H = output.size(2)
-    # W = output.size(3)
-
-    bxy_list = []
-    bwh_list = []
-    det_confs_list = []
-    cls_confs_list = []
-
-    for i in range(num_anchors):
-        begin = i * (5 + num_classes)
-        end = (i + 1) * (5 + num_classes)
-
-        bxy_list.append(output[:, begin: begin + 2])
-        bwh_list.append(output[:, begin + 2: begin + 4])
-        det_confs_list.append(output[:, begin + 4: begin + 5])
-        cls_confs_list.append(output[:, begin + 5: end])
-
-    # Shape: [batch, num_anchors * 2, H, W]
-    bxy = torch.cat(bxy_list, dim=1)
-    # Shape: [batch, num_anchors * 2, H, W]
-    bwh = torch.cat(bwh_list, dim=1)
-
-    # Shape: [batch, num_anchors, H, W]
-    det_confs = torch.cat(det_confs_list, dim=1)
-    # Shape: [batch, num_anchors * H * W]
-    det_confs = det_confs.view(output.size(0), num_anchors * output.size(2) * output.size(3))
-
-    # Shape: [batch, num_anchors * num_classes, H, W]
-    cls_confs = torch.cat(cls_confs_list, dim=1)
-    # Shape: [batch, num_anchors, num_classes, H * W]
-    cls_confs = cls_confs.view(output.size(0), num_anchors, num_classes, output.size(2) * output.size(3))
-    # Shape: [batch, num_anchors, num_classes, H * W] --> [batch, num_anchors * H * W, num_classes]
-    cls_confs = cls_confs.permute(0, 1, 3, 2).reshape(output.size(0), num_anchors * output.size(2) * output.size(3),
-                                                      num_classes)
-
-    # Apply sigmoid(), exp() and softmax() to slices
-    #
-    bxy = torch.sigmoid(bxy) * scale_x_y - 0.5 * (scale_x_y - 1)
-    bwh = torch.exp(bwh)
-    det_confs = torch.sigmoid(det_confs)
-    cls_confs = torch.sigmoid(cls_confs)
-
-    # Prepare C-x, C-y, P-w, P-h (None of them are torch related)
-    grid_x = np.expand_dims(np.expand_dims(
-        np.expand_dims(np.linspace(0, output.size(3) - 1, output.size(3)), axis=0).repeat(output.size(2), 0), axis=0),
-                            axis=0)
-    grid_y = np.expand_dims(np.expand_dims(
-        np.expand_dims(np.linspace(0, output.size(2) - 1, output.size(2)), axis=1).repeat(output.size(3), 1), axis=0),
-                            axis=0)
-    # grid_x = torch.linspace(0, W - 1, W).reshape(1, 1, 1, W).repeat(1, 1, H, 1)
-    # grid_y = torch.linspace(0, H - 1, H).reshape(1, 1, H, 1).repeat(1, 1, 1, W)
-
-    anchor_w = []
-    anchor_h = []
-    for i in range(num_anchors):
-        anchor_w.append(anchors[i * 2])
-        anchor_h.append(anchors[i * 2 + 1])
-
-    device = None
-    cuda_check = output.is_cuda
-    if cuda_check:
-        device = output.get_device()
-
-    bx_list = []
-    by_list = []
-    bw_list = []
-    bh_list = []
-
-    # Apply C-x, C-y, P-w, P-h
-    for i in range(num_anchors):
-        ii = i * 2
-        # Shape: [batch, 1, H, W]
-        bx = bxy[:, ii: ii + 1] + torch.tensor(grid_x, device=device,
-                                               dtype=torch.float32)  # grid_x.to(device=device, dtype=torch.float32)
-        # Shape: [batch, 1, H, W]
-        by = bxy[:, ii + 1: ii + 2] + torch.tensor(grid_y, device=device,
-                                                   dtype=torch.float32)  # grid_y.to(device=device, dtype=torch.float32)
-        # Shape: [batch, 1, H, W]
-        bw = bwh[:, ii: ii + 1] * anchor_w[i]
-        # Shape: [batch, 1, H, W]
-        bh = bwh[:, ii + 1: ii + 2] * anchor_h[i]
-
-        bx_list.append(bx)
-        by_list.append(by)
-        bw_list.append(bw)
-        bh_list.append(bh)
-
-    ########################################
-    #   Figure out bboxes from slices     #
-    ########################################
-
-    # Shape: [batch, num_anchors, H, W]
-    bx = torch.cat(bx_list, dim=1)
-    # Shape: [batch, num_anchors, H, W]
-    by = torch.cat(by_list, dim=1)
-    # Shape: [batch, num_anchors, H, W]
-    bw = torch.cat(bw_list, dim=1)
-    # Shape: [batch, num_anchors, H, W]
-    bh = torch.cat(bh_list, dim=1)
-
-    # Shape: [batch, 2 * num_anchors, H, W]
-    bx_bw = torch.cat((bx, bw), dim=1)
-    # Shape: [batch, 2 * num_anchors, H, W]
-    by_bh = torch.cat((by, bh), dim=1)
-
-    # normalize coordinates to [0, 1]
-    bx_bw /= output.size(3)
-    by_bh /= output.size(2)
-
-    # Shape: [batch, num_anchors * H * W, 1]
-    bx = bx_bw[:, :num_anchors].view(output.size(0), num_anchors * output.size(2) * output.size(3), 1)
-    by = by_bh[:, :num_anchors].view(output.size(0), num_anchors * output.size(2) * output.size(3), 1)
-    bw = bx_bw[:, num_anchors:].view(output.size(0), num_anchors * output.size(2) * output.size(3), 1)
-    bh = by_bh[:, num_anchors:].view(output.size(0), num_anchors * output.size(2) * output.size(3), 1)
+    # boxes: [batch, num_anchors * H * W, 1, 4]
+    # confs: [batch, num_anchors * H * W, num_classes]
+    return yolo_decode(output, num_classes, anchors, num_anchors, scale_x_y)
+
+
+def yolo_forward_topk(output, num_classes, anchors, num_anchors, scale_x_y, topk):
+    """Same outputs as yolo_forward_dynamic, but only the topk boxes (by objectness) of every image are decoded
+
+    boxes: [batch, topk, 1, 4]
+    confs: [batch, topk, num_classes]
+    """
+    batch, _, H, W = output.shape
+
+    # [batch, num_anchors * H * W, 5 + num_classes], box n is anchor n // (H * W) at position n % (H * W)
+    output = output.view(batch, num_anchors, 5 + num_classes, H * W).permute(0, 1, 3, 2)
+    output = output.reshape(batch, num_anchors * H * W, 5 + num_classes)
+
+    # sigmoid() is monotonic, select on the raw objectness
+    _, index = output[:, :, 4].topk(topk, dim=1)
+    output = output.gather(1, index.unsqueeze(2).expand(-1, -1, 5 + num_classes))
+
+    pos = index % (H * W)
+    grid_x = (pos % W).float()
+    grid_y = (pos // W).float()
+    anchors = get_anchors(anchors, output.device, output.dtype)
+    anchor_w = anchors[index // (H * W), 0]
+    anchor_h = anchors[index // (H * W), 1]
+
+    bxy = torch.sigmoid(output[:, :, 0:2]) * scale_x_y - 0.5 * (scale_x_y - 1)
+    bwh = torch.exp(output[:, :, 2:4])
+
+    bx = (bxy[:, :, 0] + grid_x) / W
+    by = (bxy[:, :, 1] + grid_y) / H
+    bw = bwh[:, :, 0] * anchor_w / W
+    bh = bwh[:, :, 1] * anchor_h / H
 
     bx1 = bx - bw * 0.5
     by1 = by - bh * 0.5
-    bx2 = bx1 + bw
-    by2 = by1 + bh
+    boxes = torch.stack((bx1, by1, bx1 + bw, by1 + bh), dim=2).view(batch, topk, 1, 4)
 
-    # Shape: [batch, num_anchors * h * w, 4] -> [batch, num_anchors * h * w, 1, 4]
-    boxes = torch.cat((bx1, by1, bx2, by2), dim=2).view(output.size(0), num_anchors * output.size(2) * output.size(3),
-                                                        1, 4)
-    # boxes = boxes.repeat(1, 1, num_classes, 1)
+    confs = torch.sigmoid(output[:, :, 5:]) * torch.sigmoid(output[:, :, 4:5])
 
-    # boxes:     [batch, num_anchors * H * W, 1, 4]
-    # cls_confs: [batch, num_anchors * H * W, num_classes]
-    # det_confs: [batch, num_anchors * H * W]
+    return boxes, confs
 
-    det_confs = det_confs.view(output.size(0), num_anchors * output.size(2) * output.size(3), 1)
-    confs = cls_confs * det_confs
 
-    # boxes: [batch, num_anchors * H * W, 1, 4]
-    # confs: [batch, num_anchors * H * W, num_classes]
+def yolo_forward_dynamic(output, conf_thresh, num_classes, anchors, num_anchors, scale_x_y, only_objectness=1,
+                         validation=False, topk=None):
+    if topk is not None and 0 < topk < num_anchors * output.size(2) * output.size(3):
+        return yolo_forward_topk(output, num_classes, anchors, num_anchors, scale_x_y, topk)
 
-    return boxes, confs
+    return yolo_decode(output, num_classes, anchors, num_anchors, scale_x_y)
 
 
 class YoloLayer(nn.Module):
@@ -320,6 +116,7 @@ class YoloLayer(nn.Module):
         self.stride = stride
         self.seen = 0
         self.scale_x_y = 1
+        self.pre_nms_topk = None  # 每张图只解码objectness最高的pre_nms_topk个框
 
         self.model_out = model_out
 
@@ -332,4 +129,4 @@ class YoloLayer(nn.Module):
         masked_anchors = [anchor / self.stride for anchor in masked_anchors]
 
         return yolo_forward_dynamic(output, self.thresh, self.num_classes, masked_anchors, len(self.anchor_mask),
-                                    scale_x_y=self.scale_x_y)
+                                    scale_x_y=self.scale_x_y, topk=self.pre_nms_topk)
@@ -21,10 +21,13 @@ from .utils import *
 
 from torchvision.ops import nms
 from .utils import non_max_suppression
-from utils.ensemble_boxes.ensemble_boxes_wbf import weighted_boxes_fusion
+from utils.postprocess import postprocess, get_postprocess_config, select_topk
+from utils.ensemble_boxes.ensemble_boxes_torch import weighted_boxes_fusion_torch, batch_to_numpy
 
 import misc_utils as utils
 
+MAX_WBF_BOXES = 3000  # 每张图片只融合分数最高的MAX_WBF_BOXES个框
+
 hyp = {'momentum': 0.937,  # SGD momentum
        'weight_decay': 5e-4,  # optimizer weight decay
        'giou': 0.05,  # giou loss gain
@@ -49,6 +52,7 @@ class Model(BaseModel):
         self.detector.hyp = hyp
         self.detector.gr = 1.0
         self.detector.nc = opt.num_classes
+        self.postprocess_cfg = get_postprocess_config(opt, conf_thresh=0.001, nms_thresh=0.65, max_per_image=300)
         #####################
         #    Init weights
         #####################
@@ -97,73 +101,26 @@ class Model(BaseModel):
         return {}
 
     def forward(self, image):  # test
-        batch_bboxes = []
-        batch_labels = []
-        batch_scores = []
-
         inf_out, _ = self.detector(image)
-        
-        bboxes = non_max_suppression(inf_out, conf_thres=0.001, iou_thres=0.65, merge=False)
-
-        b = len(bboxes)
-        for bi in range(b):
-            pred = bboxes[bi]
-            if pred is None:
-                batch_bboxes.append(np.array([[]]))
-                batch_labels.append(np.array([]))
-                batch_scores.append(np.array([]))
-            else:
-                boxes = pred[:,:4].cpu().detach().numpy()
-                scores = pred[:,4].cpu().detach().numpy()
-                labels = pred[:,5].cpu().detach().numpy().astype(np.int32)
-                batch_bboxes.append(boxes)
-                batch_labels.append(labels)
-                batch_scores.append(scores)
-
-        # ipdb.set_trace()
-        """xywh转x1y1x2y2"""
-        # bboxes[:, :, 0] = bboxes[:, :, 0] - bboxes[:, :, 2] / 2
-        # bboxes[:, :, 1] = bboxes[:, :, 1] - bboxes[:, :, 3] / 2
-        # bboxes[:, :, 2] += bboxes[:, :, 0]
-        # bboxes[:, :, 3] += bboxes[:, :, 1]
-
-        # b = image.shape[0]  # batch有几张图
-        # for bi in range(b):
-        #     bbox = bboxes[bi]
-        #     conf_bbox = bbox[bbox[:, 4] > opt.conf_thresh]
-        #     xyxy_bbox = conf_bbox[:, :4]  # x1y1x2y2坐标
-        #     scores = conf_bbox[:, 4]
-
-        #     nms_indices = nms(xyxy_bbox, scores, opt.nms_thresh)
-
-        #     xyxy_bbox = xyxy_bbox[nms_indices]
-        #     scores = scores[nms_indices]  # 检测的置信度
-        #     classification = conf_bbox[nms_indices, 5:]
-
-            
-
-        #     if len(classification) != 0:
-        #         prob, class_id = torch.max(classification, 1)
-        #         # scores = scores * prob  # 乘以最高类别的置信度
-        #     else:
-        #         class_id = torch.Tensor([])
-
-        #     if opt.box_fusion == 'wbf':
-        #         pass
-        #         # boxes, scores, labels = weighted_boxes_fusion([xyxy_bbox.detach().cpu().numpy()], 
-        #         #                                             [scores.detach().cpu().numpy()], 
-        #         #                                             [np.zeros([xyxy_bbox.shape[0]], dtype=np.int32)], 
-        #         #                                             iou_thr=0.5)
-        #     elif opt.box_fusion == 'nms':
-        #         boxes = xyxy_bbox.detach().cpu().numpy()
-        #         scores = scores.detach().cpu().numpy()
-        #         labels = class_id.detach().cpu().numpy()
-
-        #     batch_bboxes.append(boxes)
-        #     batch_labels.append(labels)
-        #     batch_scores.append(scores)
-
-        return batch_bboxes, batch_labels, batch_scores
+        inf_out = inf_out.float()
+
+        boxes = xywh2xyxy(inf_out[..., :4].reshape(-1, 4)).view(inf_out.shape[0], -1, 4)
+        obj_conf = inf_out[..., 4:5]
+        scores = inf_out[..., 5:] * obj_conf  # conf = obj_conf * cls_conf
+
+        cfg = self.postprocess_cfg
+        if cfg.box_fusion == 'wbf':  # 在GPU上对整个batch做wbf, 只拷贝一次到cpu
+            boxes, scores = select_topk(boxes, scores, cfg.pre_nms_topk)
+            cls_conf, class_id = scores.max(2)
+            fused = weighted_boxes_fusion_torch(boxes, cls_conf, class_id, mask=cls_conf > cfg.conf_thresh,
+                                                iou_thr=cfg.wbf_thresh, max_boxes=MAX_WBF_BOXES,
+                                                max_per_image=cfg.max_per_image)
+            return batch_to_numpy(*fused)
+
+        scores = scores * (obj_conf > cfg.conf_thresh)  # candidates
+        return postprocess(boxes, scores, conf_thresh=cfg.conf_thresh, nms_thresh=cfg.nms_thresh,
+                           max_per_image=cfg.max_per_image, multi_label=cfg.multi_label and scores.shape[2] > 1,
+                           agnostic=cfg.agnostic, pre_nms_topk=cfg.pre_nms_topk)
 
     def inference(self, x, progress_idx=None):
         raise NotImplementedError
@@ -22,6 +22,8 @@ from scipy.signal import butter, filtfilt
 from tqdm import tqdm
 
 from . import torch_utils  #  torch_utils, google_utils
+from utils.grid_cache import TensorCache
+from utils.postprocess import topk_per_image
 
 # Set printoptions
 torch.set_printoptions(linewidth=320, precision=5, profile='long')
@@ -439,15 +441,14 @@ class BCEBlurWithLogitsLoss(nn.Module):
 
 def compute_loss(p, targets, model):  # predictions, targets, model
     device = targets.device
-    ft = torch.cuda.FloatTensor if p[0].is_cuda else torch.Tensor
-    lcls, lbox, lobj = ft([0]).to(device), ft([0]).to(device), ft([0]).to(device)
+    lcls, lbox, lobj = torch.zeros(1, device=device), torch.zeros(1, device=device), torch.zeros(1, device=device)
     tcls, tbox, indices, anchors = build_targets(p, targets, model)  # targets
     h = model.hyp  # hyperparameters
     red = 'mean'  # Loss reduction (sum or mean)
 
     # Define criteria
-    BCEcls = nn.BCEWithLogitsLoss(pos_weight=ft([h['cls_pw']]), reduction=red).to(device)
-    BCEobj = nn.BCEWithLogitsLoss(pos_weight=ft([h['obj_pw']]), reduction=red).to(device)
+    BCEcls = nn.BCEWithLogitsLoss(pos_weight=torch.tensor([h['cls_pw']], device=device), reduction=red)
+    BCEobj = nn.BCEWithLogitsLoss(pos_weight=torch.tensor([h['obj_pw']], device=device), reduction=red)
 
     # class label smoothing https://arxiv.org/pdf/1902.04103.pdf eqn 3
     cp, cn = smooth_BCE(eps=0.0)
@@ -463,7 +464,7 @@ def compute_loss(p, targets, model):  # predictions, targets, model
     balance = [4.0, 1.0, 0.4] if np == 3 else [4.0, 1.0, 0.4, 0.1]  # P3-5 or P3-6
     for i, pi in enumerate(p):  # layer index, layer predictions
         b, a, gj, gi = indices[i]  # image, anchor, gridy, gridx
-        tobj = torch.zeros_like(pi[..., 0]).to(device)  # target obj
+        tobj = torch.zeros_like(pi[..., 0])  # target obj
 
         nb = b.shape[0]  # number of targets
         if nb:
@@ -473,7 +474,7 @@ def compute_loss(p, targets, model):  # predictions, targets, model
             # GIoU
             pxy = ps[:, :2].sigmoid() * 2. - 0.5
             pwh = (ps[:, 2:4].sigmoid() * 2) ** 2 * anchors[i]
-            pbox = torch.cat((pxy, pwh), 1).to(device)  # predicted box
+            pbox = torch.cat((pxy, pwh), 1)  # predicted box
             giou = bbox_iou(pbox.t(), tbox[i], x1y1x2y2=False, GIoU=True)  # giou(prediction, target)
             lbox += (1.0 - giou).sum() if red == 'sum' else (1.0 - giou).mean()  # giou loss
 
@@ -482,8 +483,8 @@ def compute_loss(p, targets, model):  # predictions, targets, model
 
             # Class
             if model.nc > 1:  # cls loss (only if multiple classes)
-                t = torch.full_like(ps[:, 5:], cn).to(device)  # targets
-                t[range(nb), tcls[i]] = cp
+                t = torch.full_like(ps[:, 5:], cn)  # targets
+                t[torch.arange(nb, device=device), tcls[i]] = cp
                 lcls += BCEcls(ps[:, 5:], t)  # BCE
 
             # Append targets to text file
@@ -508,42 +509,65 @@ def compute_loss(p, targets, model):  # predictions, targets, model
     return loss * bs, torch.cat((lbox, lobj, lcls, loss)).detach()
 
 
+_target_tensors = TensorCache()
+
+
+def _anchor_indices(na, nt, device):
+    # [nt, na] anchor index of every target, cached by (na, nt rounded up to a power of 2, device)
+    bucket = 1 << max(nt - 1, 0).bit_length()
+    ai = _target_tensors.get(('ai', na, bucket, str(device)),
+                             lambda: torch.arange(na, device=device).view(1, na).repeat(bucket, 1))
+    return ai[:nt]
+
+
+def _overlap_offsets(g, device):
+    # [5, 1, 2] offsets of the target cell and its 4 neighbours
+    return _target_tensors.get(('off', g, str(device)), lambda: torch.tensor(
+        [[0, 0], [1, 0], [0, 1], [-1, 0], [0, -1]], device=device).float().view(5, 1, 2) * g)
+
+
+def _grid_gain(ny, nx, device):
+    # normalized to gridspace gain of (image, class, x, y, w, h)
+    return _target_tensors.get(('gain', ny, nx, str(device)),
+                               lambda: torch.tensor([1, 1, nx, ny, nx, ny], device=device).float())
+
+
 def build_targets(p, targets, model):
     # Build targets for compute_loss(), input targets(image,class,x,y,w,h)
+    # targets按图片排好序时(collate_fn的顺序), 每层的结果也按图片排列, compute_loss中取pi[b, a, gj, gi]是连续的
     det = model.module.model[-1] if type(model) in (nn.parallel.DataParallel, nn.parallel.DistributedDataParallel) \
         else model.model[-1]  # Detect() module
     na, nt = det.na, targets.shape[0]  # number of anchors, targets
     tcls, tbox, indices, anch = [], [], [], []
-    gain = torch.ones(6, device=targets.device)  # normalized to gridspace gain
-    off = torch.tensor([[1, 0], [0, 1], [-1, 0], [0, -1]], device=targets.device).float()  # overlap offsets
-    at = torch.arange(na).view(na, 1).repeat(1, nt)  # anchor tensor, same as .repeat_interleave(nt)
+    device = targets.device
+    ai = _anchor_indices(na, nt, device)  # anchor tensor [nt, na], 按层缓存, 不再每次arange+repeat
 
     g = 0.5  # offset
     style = 'rect4'
+    n_off = 5 if style == 'rect4' else 3
+    off = _overlap_offsets(g, device)[:n_off]  # overlap offsets * g
     for i in range(det.nl):
         anchors = det.anchors[i]
-        gain[2:] = torch.tensor(p[i].shape)[[3, 2, 3, 2]]  # xyxy gain
+        gain = _grid_gain(p[i].shape[2], p[i].shape[3], device)  # xyxy gain
 
         # Match targets to anchors
-        a, t, offsets = [], targets * gain, 0
+        a, t, offsets = ai[:0, 0], targets * gain, 0
         if nt:
-            r = t[None, :, 4:6] / anchors[:, None]  # wh ratio
+            r = t[:, None, 4:6] / anchors[None]  # wh ratio
             j = torch.max(r, 1. / r).max(2)[0] < model.hyp['anchor_t']  # compare
             # j = wh_iou(anchors, t[:, 4:6]) > model.hyp['iou_t']  # iou(3,n) = wh_iou(anchors(3,2), gwh(n,2))
-            a, t = at[j], t.repeat(na, 1, 1)[j]  # filter
+            a, t = ai[j], t[:, None].expand(-1, na, -1)[j]  # filter, 按target的顺序
 
-            # overlaps
+            # overlaps, 所有offset一次筛选, 不再逐个cat
             gxy = t[:, 2:4]  # grid xy
-            z = torch.zeros_like(gxy)
+            j, k = ((gxy % 1. < g) & (gxy > 1.)).T
             if style == 'rect2':
-                j, k = ((gxy % 1. < g) & (gxy > 1.)).T
-                a, t = torch.cat((a, a[j], a[k]), 0), torch.cat((t, t[j], t[k]), 0)
-                offsets = torch.cat((z, z[j] + off[0], z[k] + off[1]), 0) * g
+                j = torch.stack((torch.ones_like(j), j, k))
             elif style == 'rect4':
-                j, k = ((gxy % 1. < g) & (gxy > 1.)).T
-                l, m = ((gxy % 1. > (1 - g)) & (gxy < (gain[[2, 3]] - 1.))).T
-                a, t = torch.cat((a, a[j], a[k], a[l], a[m]), 0), torch.cat((t, t[j], t[k], t[l], t[m]), 0)
-                offsets = torch.cat((z, z[j] + off[0], z[k] + off[1], z[l] + off[2], z[m] + off[3]), 0) * g
+                l, m = ((gxy % 1. > (1 - g)) & (gxy < (gain[2:4] - 1.))).T
+                j = torch.stack((torch.ones_like(j), j, k, l, m))
+            a, t = a.repeat(n_off, 1)[j], t.repeat(n_off, 1, 1)[j]
+            offsets = off.expand(-1, len(gxy), -1)[j]
 
         # Define
         b, c = t[:, :2].long().T  # image, class
@@ -561,21 +585,31 @@ def build_targets(p, targets, model):
     return tcls, tbox, indices, anch
 
 
-def non_max_suppression(prediction, conf_thres=0.1, iou_thres=0.6, merge=False, classes=None, agnostic=False):
+def non_max_suppression(prediction, conf_thres=0.1, iou_thres=0.6, merge=False, classes=None, agnostic=False,
+                        batched=False, max_det=300, fixed_shape=False):
     """Performs Non-Maximum Suppression (NMS) on inference results
 
+    Args:
+        batched: one NMS call for the whole batch (boxes offset by image and class), no time limit
+        max_det: maximum number of detections per image
+        fixed_shape: (batched only) return a [batch, max_det, 6] tensor padded with zeros and
+            the number of detections of every image [batch], e.g. for export
+
     Returns:
          detections with shape: nx6 (x1, y1, x2, y2, conf, cls)
     """
     if prediction.dtype is torch.float16:
         prediction = prediction.float()  # to FP32
 
+    if batched or fixed_shape:
+        return batched_non_max_suppression(prediction, conf_thres, iou_thres, classes=classes, agnostic=agnostic,
+                                           max_det=max_det, fixed_shape=fixed_shape)
+
     nc = prediction[0].shape[1] - 5  # number of classes
     xc = prediction[..., 4] > conf_thres  # candidates
 
     # Settings
     min_wh, max_wh = 2, 4096  # (pixels) minimum and maximum box width and height
-    max_det = 300  # maximum number of detections per image
     time_limit = 10.0  # seconds to quit after
     redundant = True  # require redundant detections
     multi_label = nc > 1  # multiple labels per box (adds 0.5ms/img)
@@ -645,6 +679,61 @@ def non_max_suppression(prediction, conf_thres=0.1, iou_thres=0.6, merge=False,
     return output
 
 
+def batched_non_max_suppression(prediction, conf_thres=0.1, iou_thres=0.6, classes=None, agnostic=False,
+                                max_det=300, fixed_shape=False):
+    """Same as non_max_suppression (merge=False), but a single NMS call covers the whole batch
+
+    Returns:
+         list of detections with shape: nx6 (x1, y1, x2, y2, conf, cls), None for images without detections
+         or (if fixed_shape) detections [batch, max_det, 6] padded with zeros and number of detections [batch]
+    """
+    batch_size = prediction.shape[0]
+    nc = prediction.shape[2] - 5  # number of classes
+    multi_label = nc > 1  # multiple labels per box (adds 0.5ms/img)
+
+    xc = prediction[..., 4:5] > conf_thres  # candidates
+    scores = prediction[..., 5:] * prediction[..., 4:5] * xc  # conf = obj_conf * cls_conf
+
+    if multi_label:
+        bi, ni, j = (scores > conf_thres).nonzero(as_tuple=True)
+        conf = scores[bi, ni, j]
+    else:  # best class only
+        conf, j = scores.max(2)
+        bi, ni = (conf > conf_thres).nonzero(as_tuple=True)
+        conf, j = conf[bi, ni], j[bi, ni]
+
+    # Filter by class
+    if classes:
+        i = (j[:, None] == torch.tensor(classes, device=j.device)).any(1)
+        bi, ni, j, conf = bi[i], ni[i], j[i], conf[i]
+
+    # Box (center x, center y, width, height) to (x1, y1, x2, y2)
+    box = xywh2xyxy(prediction[bi, ni, :4])
+
+    # Batched NMS, boxes are offset by image and class
+    groups = bi if agnostic else bi * nc + j
+    i = torchvision.ops.boxes.batched_nms(box, conf, groups, iou_thres)
+    i = i[topk_per_image(bi[i], batch_size, max_det)]  # limit detections, grouped by image
+
+    x = torch.cat((box[i], conf[i, None], j[i, None].float()), 1)
+    bi = bi[i]
+
+    counts = torch.bincount(bi, minlength=batch_size)
+    if fixed_shape:
+        starts = torch.cumsum(counts, 0) - counts
+        rank = torch.arange(len(bi), device=bi.device) - starts[bi]
+        output = x.new_zeros((batch_size, max_det, 6))
+        output[bi, rank] = x
+        return output, counts
+
+    output = [None] * batch_size
+    for xi, d in enumerate(x.split(counts.tolist())):
+        if len(d):
+            output[xi] = d
+
+    return output
+
+
 def strip_optimizer(f='weights/best.pt'):  # from utils.utils import *; strip_optimizer()
     # Strip optimizer from *.pt files for lighter files (reduced by 1/2 size)
     x = torch.load(f, map_location=torch.device('cpu'))
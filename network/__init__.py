@@ -1,8 +1,10 @@
 from .Effdet.Model import Model as Effdet
+from .Effdet.Model import AnchorTargets as EffdetTargets
 from .YoloV2V3.Model import Model as Yolo2
 from .YoloV2V3.Model import Model as Yolo3
 from .SSD.Model import Model as SSD300
 from .SSD.Model import Model as SSD512
+from .SSD.Model import PriorTargets as SSDTargets
 from .RetinaNet.Model import Model as RetinaNet
 from .Faster_RCNN.Model import Model as Faster_RCNN
 from .YoloV5.Model import Model as Yolo5
@@ -30,3 +32,16 @@ def get_model(model: str):
     else:
         raise AttributeError('No such model: "%s", available: {%s}.' % (model, '|'.join(models.keys())))
 
+
+# --collate_targets, 在训练集dataloader的train_collate_fn里计算训练用的targets
+collate_targets = {
+    'Effdet': EffdetTargets,
+    'SSD300': SSDTargets,
+    'SSD512': SSDTargets,
+}
+
+def get_collate_targets(model: str):
+    if model in collate_targets:
+        return collate_targets[model]()
+    else:
+        raise AttributeError('--collate_targets is not supported by model "%s", available: {%s}.' % (model, '|'.join(collate_targets.keys())))
@@ -5,8 +5,11 @@ import cv2
 import torch
 import warnings
 import sys
+import threading
 import ipdb
-from utils.eval_metrics.eval_map import eval_detection_voc
+from queue import Queue
+from utils.eval_metrics.eval_map import eval_detection_voc, VOCAccumulator, ParallelAccumulator
+from utils.eval_metrics.eval_coco import COCOAccumulator
 
 from misc_utils import color_print, progress_bar
 from options import opt
@@ -17,6 +20,21 @@ from mscv.image import tensor2im
 from mscv.summary import write_loss, write_image
 from utils.vis import visualize_boxes
 
+EVAL_QUEUE_SIZE = 4  # eval时最多积压几个batch的预测结果等待计算mAP
+
+def rect_scale(org_size, image_size):
+    """Scale from network input coordinates back to the original image, used by --rect_eval."""
+    org_w, org_h = org_size
+    w, h = image_size
+    return np.array([org_w / w, org_h / h, org_w / w, org_h / h], dtype=np.float32)
+
+
+def scale_boxes(boxes, scale):
+    if boxes.size == 0:
+        return boxes
+    return boxes * scale
+
+
 class BaseModel(torch.nn.Module):
     def __init__(self):
         super(BaseModel, self).__init__()
@@ -53,65 +71,108 @@ class BaseModel(torch.nn.Module):
 
     def eval_mAP(self, dataloader, epoch, writer, logger, data_name='val'):
         # eval_yolo(self.detector, dataloader, epoch, writer, logger, dataname=data_name)
+        iou_threshs = [0.5, 0.55, 0.6, 0.65, 0.7, 0.75]
+        # 每个batch的结果马上计算匹配, 不保存所有预测框; --eval_workers > 0 时在多个进程中计算
+        # 出错时也要结束进程池的worker, 否则每次eval都会留下2 × eval_workers个进程
+        with ParallelAccumulator(VOCAccumulator(iou_threshs, use_07_metric=False), opt.eval_workers) as accumulator, \
+                ParallelAccumulator(COCOAccumulator(), opt.eval_workers) as coco_accumulator:  # COCO的mAP@[.5:.95]
+            """
+            网络推理在主线程, 计算匹配和可视化在后台线程, 两者同时进行
+            """
+            queue = Queue(maxsize=EVAL_QUEUE_SIZE)
+            errors = []
+
+            def consume():
+                while True:
+                    item = queue.get()
+                    if item is None:
+                        break
+                    if errors:  # 出错之后只取出队列里的数据, 不再计算
+                        continue
+                    try:
+                        self._eval_batch(item, accumulator, coco_accumulator, writer, epoch, data_name)
+                    except Exception as e:
+                        errors.append(e)
+
+            consumer = threading.Thread(target=consume, daemon=True)
+            consumer.start()
+
+            try:
+                with torch.no_grad():
+                    for i, sample in enumerate(dataloader):
+                        utils.progress_bar(i, len(dataloader), 'Eva... ')
+                        if errors:
+                            break
+
+                        image = sample['image'].to(opt.device)
+                        batch_bboxes, batch_labels, batch_scores = self.forward(image)
+
+                        queue.put({
+                            'index': i,
+                            'sample': sample,
+                            'image': image.detach().cpu() if opt.vis else None,
+                            'predicted': (batch_bboxes, batch_labels, batch_scores),
+                        })
+            finally:
+                queue.put(None)
+                consumer.join()
+
+            if errors:
+                raise errors[0]
+
+            with torch.no_grad():
+                result = []
+                for iou_thresh, AP in zip(iou_threshs, accumulator.result().evaluate()):
+                    APs = AP['ap']
+                    mAP = AP['map']
+                    result.append(mAP)
+
+                    logger.info(f'Eva({data_name}) epoch {epoch}, IoU: {iou_thresh}, APs: {str(APs[:opt.num_classes])}, mAP: {mAP}')
+
+                    write_loss(writer, f'val/{data_name}', 'mAP', mAP, epoch)
+
+                logger.info(
+                    f'Eva({data_name}) epoch {epoch}, mean of (AP50-AP75): {sum(result)/len(result)}')
+
+                stats = coco_accumulator.result().summarize()
+                logger.info(f'Eva({data_name}) epoch {epoch}, (COCO) ' + ', '.join([f'{k}: {v:.4f}' for k, v in stats.items()]))
+                write_loss(writer, f'val/{data_name}', 'mAP@[.5:.95]', stats['AP'], epoch)
+
+
+    def _eval_batch(self, item, accumulator, coco_accumulator, writer, epoch, data_name):
+        """CPU side of eval_mAP for one batch: match predictions with gt and visualize."""
+        sample = item['sample']
+        batch_bboxes, batch_labels, batch_scores = item['predicted']
+        gt_bbox = sample['bboxes']
+        labels = sample['labels']
+
         pred_bboxes = []
-        pred_labels = []
-        pred_scores = []
         gt_bboxes = []
         gt_labels = []
-        gt_difficults = []
-
-        with torch.no_grad():
-            for i, sample in enumerate(dataloader):
-                utils.progress_bar(i, len(dataloader), 'Eva... ')
-                image = sample['image'].to(opt.device)
-                gt_bbox = sample['bboxes']
-                labels = sample['labels']
-                paths = sample['path']
-
-                batch_bboxes, batch_labels, batch_scores = self.forward(image)
-                pred_bboxes.extend(batch_bboxes)
-                pred_labels.extend(batch_labels)
-                pred_scores.extend(batch_scores)
-
-                for b in range(len(gt_bbox)):
-                    gt_bboxes.append(gt_bbox[b].detach().cpu().numpy())
-                    gt_labels.append(labels[b].int().detach().cpu().numpy())
-                    gt_difficults.append(np.array([False] * len(gt_bbox[b])))
-
-                if opt.vis:  # 可视化预测结果
-                    img = tensor2im(image).copy()
-                    # for x1, y1, x2, y2 in gt_bbox[0]:
-                    #     cv2.rectangle(img, (x1,y1), (x2,y2), (0, 255, 0), 2)  # 绿色的是gt
-
-                    num = len(batch_scores[0])
-                    visualize_boxes(image=img, boxes=batch_bboxes[0],
-                             labels=batch_labels[0].astype(np.int32), probs=batch_scores[0], class_labels=opt.class_names)
-
-                    write_image(writer, f'{data_name}/{i}', 'image', img, epoch, 'HWC')
-
-            result = []
-            for iou_thresh in [0.5, 0.55, 0.6, 0.65, 0.7, 0.75]:
-                AP = eval_detection_voc(
-                    pred_bboxes,
-                    pred_labels,
-                    pred_scores,
-                    gt_bboxes,
-                    gt_labels,
-                    gt_difficults=None,
-                    iou_thresh=iou_thresh,
-                    use_07_metric=False)
-
-                APs = AP['ap']
-                mAP = AP['map']
-                result.append(mAP)
-
-                logger.info(f'Eva({data_name}) epoch {epoch}, IoU: {iou_thresh}, APs: {str(APs[:opt.num_classes])}, mAP: {mAP}')
-
-                write_loss(writer, f'val/{data_name}', 'mAP', mAP, epoch)
-
-            logger.info(
-                f'Eva({data_name}) epoch {epoch}, mean of (AP50-AP75): {sum(result)/len(result)}')
-
+        for b in range(len(gt_bbox)):
+            pred_bbox = batch_bboxes[b]
+            gt = gt_bbox[b].detach().cpu().numpy()
+            if opt.rect_eval:  # 预测框和gt都映射回原图坐标
+                scale = rect_scale(sample['org_size'][b], sample['image_size'][b])
+                pred_bbox = scale_boxes(pred_bbox, scale)
+                gt = scale_boxes(gt, scale)
+
+            pred_bboxes.append(pred_bbox)
+            gt_bboxes.append(gt)
+            gt_labels.append(labels[b].int().detach().cpu().numpy())
+
+        accumulator.add_batch(pred_bboxes, batch_labels, batch_scores, gt_bboxes, gt_labels)
+        coco_accumulator.add_batch(pred_bboxes, batch_labels, batch_scores, gt_bboxes, gt_labels)
+
+        if opt.vis:  # 可视化预测结果
+            img = tensor2im(item['image']).copy()
+            # for x1, y1, x2, y2 in gt_bbox[0]:
+            #     cv2.rectangle(img, (x1,y1), (x2,y2), (0, 255, 0), 2)  # 绿色的是gt
+
+            visualize_boxes(image=img, boxes=batch_bboxes[0],
+                     labels=batch_labels[0].astype(np.int32), probs=batch_scores[0], class_labels=opt.class_names)
+
+            write_image(writer, f'{data_name}/{item["index"]}', 'image', img, epoch, 'HWC')
 
     def load(self, ckpt_path):
         load_dict = {
@@ -50,12 +50,17 @@ def parse_args():
     parser.add_argument('--scale', type=int, default=None, help='scale images to this size')
     parser.add_argument('--crop', type=int, default=None, help='then crop to this size')
     parser.add_argument('--workers', '-w', type=int, default=4, help='num of workers')
+    parser.add_argument('--aspect_ratio_group', action='store_true', help='batch training images of similar aspect ratio together')
+    parser.add_argument('--collate_targets', action='store_true', help='match anchors/priors to the ground truth in dataloader workers (Effdet, SSD)')
 
     # for datasets
     parser.add_argument('--dataset', default='voc', help='training dataset')
     parser.add_argument('--transform', default=None, help='transform')
     parser.add_argument('--val_set', type=str, default=None)
     parser.add_argument('--test_set', type=str, default=None)
+    parser.add_argument('--anno_workers', type=int, default=None, help='processes to parse xml annotations, default: cpu count')
+    parser.add_argument('--cache_images', choices=['ram', 'disk'], default=None, help='cache decoded uint8 images in memory or on disk')
+    parser.add_argument('--cache_budget', type=float, default=8, help='GB of memory per dataloader worker for --cache_images ram')
 
     # init weights
     parser.add_argument('--init', type=str, default=None, help='{normal, xavier, kaiming, orthogonal}')
@@ -74,10 +79,17 @@ def parse_args():
     parser.add_argument('--lr', type=float, default=0.0001, help='initial learning rate for adam')
 
     # test time bbox settings
-    parser.add_argument('--conf_thresh', type=float, default=0.01, help='bboxes with conf < this threshold will be ignored')
-    parser.add_argument('--nms_thresh', type=float, default=0.45, help='nms threshold')
-    parser.add_argument('--wbf_thresh', type=float, default=0.5, help='wbf threshold')
-    parser.add_argument('--box_fusion', choices=['nms', 'wbf'], default='nms')
+    # 不指定时使用模型和--postprocess profile的默认值, 见utils/postprocess.py
+    parser.add_argument('--postprocess', choices=['eval', 'fast'], default='eval',
+                        help='post-processing profile, [eval] for mAP, [fast] for inference')
+    parser.add_argument('--conf_thresh', type=float, default=None, help='bboxes with conf < this threshold will be ignored')
+    parser.add_argument('--nms_thresh', type=float, default=None, help='nms threshold')
+    parser.add_argument('--max_per_image', type=int, default=None, help='max detections per image')
+    parser.add_argument('--pre_nms_topk', type=int, default=None, help='keep at most this many candidates per feature level and per image before decode and nms')
+    parser.add_argument('--wbf_thresh', type=float, default=None, help='wbf threshold')
+    parser.add_argument('--box_fusion', choices=['nms', 'wbf'], default=None)
+    parser.add_argument('--rect_eval', action='store_true', help='eval without square padding, images are sorted by aspect ratio')
+    parser.add_argument('--eval_workers', type=int, default=0, help='processes to compute mAP, 0 for the main process')
 
     parser.add_argument('--save_freq', type=int, default=10, help='freq to save models')
     parser.add_argument('--eval_freq', '--val_freq', type=int, default=10, help='freq to eval models')
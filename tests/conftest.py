@@ -0,0 +1,34 @@
+# encoding=utf-8
+"""
+测试只导入要测的模块:
+    - network/__init__.py 会导入所有模型(timm, mscv等), 这里只注册包的路径, 不执行它
+    - effdet/__init__.py 依赖timm, omegaconf, 没有安装时同样只注册包的路径
+    - options在导入时解析sys.argv, 导入时不带pytest的命令行参数
+"""
+import os
+import sys
+import types
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+
+def _register_package(name, path):
+    if name not in sys.modules:
+        package = types.ModuleType(name)
+        package.__path__ = [os.path.join(ROOT, path)]
+        sys.modules[name] = package
+
+
+_register_package('network', 'network')
+try:
+    import network.Effdet.effdet  # noqa: F401
+except ImportError:
+    _register_package('network.Effdet.effdet', 'network/Effdet/effdet')
+
+_argv = sys.argv
+sys.argv = [_argv[0], '--gpu_ids', '-1']
+try:
+    import options  # noqa: F401
+finally:
+    sys.argv = _argv
@@ -0,0 +1,97 @@
+import pytest
+import torch
+
+from network.Effdet.effdet.anchors import Anchors, AnchorLabeler
+from network.Effdet.effdet.object_detection.argmax_matcher import ArgMaxMatcher
+
+
+def make_similarity(seed, batch_size=4, num_rows=6, num_columns=300):
+    torch.manual_seed(seed)
+    # 取0.1的倍数, 保证有相同的值
+    similarity = (torch.rand(batch_size, num_rows, num_columns) * 10).floor() / 10
+    similarity[0, 1] = similarity[0, 0]  # 两行强制匹配到同一列
+    similarity[2, 3, :] = 0  # 和所有列都不相交的行, 强制匹配到第0列
+    valid = torch.ones(batch_size, num_rows, dtype=torch.bool)
+    valid[1] = False  # 没有gt的图片
+    valid[2, 4:] = False
+    valid[3, 1:] = False
+    return similarity, valid
+
+
+def test_match_batch_matches_match():
+    matchers = [
+        ArgMaxMatcher(0.5, unmatched_threshold=0.5, negatives_lower_than_unmatched=True, force_match_for_each_row=True),
+        ArgMaxMatcher(0.6, unmatched_threshold=0.4, negatives_lower_than_unmatched=True, force_match_for_each_row=True),
+        ArgMaxMatcher(0.6, unmatched_threshold=0.4, negatives_lower_than_unmatched=False),
+    ]
+    for seed in range(3):
+        similarity, valid = make_similarity(seed)
+        for matcher in matchers:
+            matches = matcher.match_batch(similarity, valid)
+            for b in range(similarity.shape[0]):
+                n = int(valid[b].sum())
+                assert torch.equal(matches[b], matcher._match(similarity[b, :n]))
+
+
+def make_labeler():
+    anchors = Anchors(3, 7, 3, [(1.0, 1.0), (1.4, 0.7), (0.7, 1.4)], 4.0, 256)
+    return AnchorLabeler(anchors, 5, match_threshold=0.5)
+
+
+def make_groundtruth(seed):
+    torch.manual_seed(seed)
+    gt_boxes, gt_labels = [], []
+    for n in (5, 0, 9, 1):  # 第二张图片没有gt
+        yx = torch.rand(n, 2) * 200
+        hw = torch.rand(n, 2) * 100 + 4
+        boxes = torch.cat([yx, yx + hw], 1)
+        labels = torch.randint(1, 6, (n,)).float()
+        if n >= 3:
+            # 相同的框类别不同, 强制匹配时取序号小的gt
+            boxes[1] = boxes[0]
+            labels[1] = labels[0] % 5 + 1
+        gt_boxes.append(boxes)
+        gt_labels.append(labels)
+    return gt_boxes, gt_labels
+
+
+def test_batch_label_anchors_matches_label_anchors():
+    labeler = make_labeler()
+    for seed in range(3):
+        gt_boxes, gt_labels = make_groundtruth(seed)
+        cls_targets, box_targets, num_positives = labeler.batch_label_anchors(gt_boxes, gt_labels)
+        for b, (boxes, labels) in enumerate(zip(gt_boxes, gt_labels)):
+            cls_expected, box_expected, num_expected = labeler.label_anchors(boxes, labels)
+            for level in range(len(cls_expected)):
+                assert torch.equal(cls_targets[level][b], cls_expected[level])
+                torch.testing.assert_close(box_targets[level][b], box_expected[level])
+            assert num_positives[b] == num_expected
+        assert num_positives[1] == 0 and (num_positives[[0, 2, 3]] > 0).all()
+
+
+def test_anchor_targets_with_default_options():
+    # 依赖timm, omegaconf, mscv等训练用的包, 没有安装时跳过
+    try:
+        from network.Effdet import Model as effdet_model
+    except ImportError as e:
+        pytest.skip('network.Effdet.Model can not be imported: %s' % e)
+    assert effdet_model.opt.scale is None
+
+    torch.manual_seed(0)
+    height, width = 256, 384  # 和config默认的image_size不同, anchor按batch的尺寸生成
+    bboxes = []
+    for n in (3, 0):
+        xy = torch.rand(n, 2) * 200
+        bboxes.append(torch.cat([xy, xy + torch.rand(n, 2) * 50 + 20], 1))
+    sample = {
+        'image': torch.zeros(2, 3, height, width),
+        'bboxes': bboxes,
+        'labels': [torch.zeros(3), torch.zeros(0)],
+    }
+
+    sample = effdet_model.AnchorTargets()(sample)
+    cls_targets, box_targets, num_positives = sample['anchor_targets']
+    for level, (cls_target, box_target) in enumerate(zip(cls_targets, box_targets), 3):
+        assert cls_target.shape[:3] == (2, height // 2 ** level, width // 2 ** level)
+        assert box_target.shape[:3] == cls_target.shape[:3]
+    assert num_positives[0] > 0 and num_positives[1] == 0
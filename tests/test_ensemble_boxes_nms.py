@@ -0,0 +1,38 @@
+import numpy as np
+import torch
+
+from utils.ensemble_boxes.ensemble_boxes_nms import cpu_soft_nms_float, soft_nms_float
+from utils.ensemble_boxes import soft_nms_torch
+
+
+def make_dets(rng, n, ties=True):
+    xy = rng.rand(n, 2) * 0.8
+    wh = rng.rand(n, 2) * 0.2 + 0.01
+    dets = np.concatenate([xy, xy + wh], axis=1).astype(np.float32)
+    sc = rng.rand(n).astype(np.float32)
+    if ties:
+        sc[rng.rand(n) < 0.1] = 0.5
+    return dets, sc
+
+
+def test_soft_nms_float_matches_reference():
+    rng = np.random.RandomState(0)
+    for trial in range(40):
+        dets, sc = make_dets(rng, rng.randint(1, 300))
+        for method in (1, 2, 3):
+            for thresh in (0.001, 0.3):  # thresh较大时提前结束
+                reference = cpu_soft_nms_float(dets.copy(), sc.copy(), Nt=0.5, sigma=0.5, thresh=thresh, method=method)
+                keep = soft_nms_float(dets.copy(), sc.copy(), Nt=0.5, sigma=0.5, thresh=thresh, method=method)
+                assert np.array_equal(reference, keep), (trial, method, thresh)
+
+
+def test_soft_nms_torch_matches_numpy():
+    rng = np.random.RandomState(1)
+    for trial in range(10):
+        dets, sc = make_dets(rng, rng.randint(1, 200), ties=False)
+        for method in (1, 2, 3):
+            for thresh in (0.001, 0.3):
+                expected = soft_nms_float(dets.copy(), sc.copy(), Nt=0.5, sigma=0.5, thresh=thresh, method=method)
+                keep = soft_nms_torch(torch.from_numpy(dets), torch.from_numpy(sc), iou_thr=0.5, sigma=0.5,
+                                      thresh=thresh, method=method, check_every=4)
+                assert np.array_equal(keep.numpy(), expected), (trial, method, thresh)
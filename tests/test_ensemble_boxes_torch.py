@@ -0,0 +1,93 @@
+import numpy as np
+import torch
+
+from utils.ensemble_boxes import weighted_boxes_fusion, non_maximum_weighted
+from utils.ensemble_boxes import weighted_boxes_fusion_torch, non_maximum_weighted_torch
+from utils.ensemble_boxes.ensemble_boxes_torch import batch_to_numpy
+
+
+def make_batch(seed, batch_size=3, num_boxes=120, num_classes=4):
+    # 在少数几个中心附近取框, 保证有多个框的cluster
+    rng = np.random.RandomState(seed)
+    centers = rng.rand(batch_size, 10, 2) * 0.8 + 0.1
+    index = rng.randint(0, 10, (batch_size, num_boxes))
+    xy = np.take_along_axis(centers, index[..., None], 1) + rng.randn(batch_size, num_boxes, 2) * 0.01
+    wh = rng.rand(batch_size, num_boxes, 2) * 0.05 + 0.1
+    boxes = np.concatenate([xy - wh / 2, xy + wh / 2], 2).clip(0, 1)
+    scores = rng.rand(batch_size, num_boxes)
+    labels = (index + rng.randint(0, 2, (batch_size, num_boxes))) % num_classes
+    mask = np.ones([batch_size, num_boxes], dtype=bool)
+    mask[1, 30:] = False  # padding
+    mask[2] = False  # 没有框的图片
+    return boxes, scores, labels, mask
+
+
+def to_torch(boxes, scores, labels, mask):
+    return torch.from_numpy(boxes), torch.from_numpy(scores), torch.from_numpy(labels), torch.from_numpy(mask)
+
+
+def sort_rows(boxes, scores, labels):
+    rows = np.concatenate([scores[:, None], labels[:, None], boxes], 1)
+    return rows[np.lexsort(rows.T[::-1])]
+
+
+def assert_same_per_image(fused, expected_fn, boxes, scores, labels, mask):
+    batch_bboxes, batch_labels, batch_scores = batch_to_numpy(*fused)
+    for i in range(len(mask)):
+        keep = mask[i]
+        if keep.sum() == 0:
+            assert len(batch_bboxes[i]) == 0
+            continue
+        expected = expected_fn([boxes[i][keep]], [scores[i][keep]], [labels[i][keep]])
+        np.testing.assert_allclose(sort_rows(batch_bboxes[i], batch_scores[i], batch_labels[i]),
+                                   sort_rows(*expected), rtol=1e-6, atol=1e-7)
+
+
+def test_wbf_torch_matches_numpy():
+    for seed in range(3):
+        boxes, scores, labels, mask = make_batch(seed)
+        for conf_type in ('avg', 'max'):
+            fused = weighted_boxes_fusion_torch(*to_torch(boxes, scores, labels, mask), iou_thr=0.55,
+                                                skip_box_thr=0.05, conf_type=conf_type)
+            assert_same_per_image(fused, lambda b, s, l: weighted_boxes_fusion(b, s, l, iou_thr=0.55, skip_box_thr=0.05,
+                                                                               conf_type=conf_type),
+                                  boxes, scores, labels, mask & (scores >= 0.05))
+
+
+def test_nmw_torch_matches_numpy():
+    for seed in range(3):
+        boxes, scores, labels, mask = make_batch(seed)
+        fused = non_maximum_weighted_torch(*to_torch(boxes, scores, labels, mask), iou_thr=0.3)
+        assert_same_per_image(fused, lambda b, s, l: non_maximum_weighted(b, s, l, iou_thr=0.3),
+                              boxes, scores, labels, mask)
+
+
+def test_fusion_caps():
+    boxes, scores, labels, mask = make_batch(0)
+    for fusion in (weighted_boxes_fusion_torch, non_maximum_weighted_torch):
+        # max_boxes: 只融合每张图片分数最高的框
+        top = np.argsort(-np.where(mask, scores, -1), 1)[:, :20]
+        top_mask = np.zeros_like(mask)
+        np.put_along_axis(top_mask, top, True, 1)
+        capped = batch_to_numpy(*fusion(*to_torch(boxes, scores, labels, mask), max_boxes=20))
+        expected = batch_to_numpy(*fusion(*to_torch(boxes, scores, labels, mask & top_mask)))
+        for c, e in zip(capped, expected):
+            for x, y in zip(c, e):
+                np.testing.assert_array_equal(x, y)
+
+        # max_per_image: 保留融合后分数最高的框
+        full = batch_to_numpy(*fusion(*to_torch(boxes, scores, labels, mask)))
+        kept = fusion(*to_torch(boxes, scores, labels, mask), max_per_image=5)
+        assert kept[0].shape[1] == 5
+        kept = batch_to_numpy(*kept)
+        for c, e in zip(kept, full):
+            for x, y in zip(c, e):
+                np.testing.assert_array_equal(x, y[:5])
+
+
+def test_fusion_without_boxes():
+    boxes, scores, labels, mask = make_batch(0)
+    for fusion in (weighted_boxes_fusion_torch, non_maximum_weighted_torch):
+        fused = fusion(*to_torch(boxes, scores, labels, np.zeros_like(mask)))
+        assert fused[0].shape == (3, 0, 4)
+        assert all(len(b) == 0 for b in batch_to_numpy(*fused)[0])
@@ -0,0 +1,104 @@
+import numpy as np
+
+from utils.ensemble_boxes import weighted_boxes_fusion
+from utils.ensemble_boxes.ensemble_boxes_wbf import find_matching_box, get_weighted_box
+
+
+def prefilter_boxes_loop(boxes, scores, labels, weights, thr):
+    # prefilter_boxes before it was vectorized
+    new_boxes = dict()
+    for t in range(len(boxes)):
+        for j in range(len(boxes[t])):
+            score = scores[t][j]
+            if score < thr:
+                continue
+            label = int(labels[t][j])
+            box_part = boxes[t][j]
+            b = [int(label), float(score) * weights[t], float(box_part[0]), float(box_part[1]), float(box_part[2]), float(box_part[3])]
+            if label not in new_boxes:
+                new_boxes[label] = []
+            new_boxes[label].append(b)
+
+    for k in new_boxes:
+        current_boxes = np.array(new_boxes[k])
+        new_boxes[k] = current_boxes[current_boxes[:, 1].argsort()[::-1]]
+
+    return new_boxes
+
+
+def weighted_boxes_fusion_loop(boxes_list, scores_list, labels_list, weights=None, iou_thr=0.55, skip_box_thr=0.0,
+                               conf_type='avg', allows_overflow=False):
+    # weighted_boxes_fusion with the find_matching_box / get_weighted_box loop
+    if weights is None:
+        weights = np.ones(len(boxes_list))
+    weights = np.array(weights)
+
+    filtered_boxes = prefilter_boxes_loop(boxes_list, scores_list, labels_list, weights, skip_box_thr)
+    if len(filtered_boxes) == 0:
+        return np.zeros((0, 4)), np.zeros((0,)), np.zeros((0,))
+
+    overall_boxes = []
+    for label in filtered_boxes:
+        boxes = filtered_boxes[label]
+        new_boxes = []
+        weighted_boxes = []
+
+        for j in range(0, len(boxes)):
+            index, best_iou = find_matching_box(weighted_boxes, boxes[j], iou_thr)
+            if index != -1:
+                new_boxes[index].append(boxes[j])
+                weighted_boxes[index] = get_weighted_box(new_boxes[index], conf_type)
+            else:
+                new_boxes.append([boxes[j].copy()])
+                weighted_boxes.append(boxes[j].copy())
+
+        for i in range(len(new_boxes)):
+            if not allows_overflow:
+                weighted_boxes[i][1] = weighted_boxes[i][1] * min(weights.sum(), len(new_boxes[i])) / weights.sum()
+            else:
+                weighted_boxes[i][1] = weighted_boxes[i][1] * len(new_boxes[i]) / weights.sum()
+        overall_boxes.append(np.array(weighted_boxes))
+
+    overall_boxes = np.concatenate(overall_boxes, axis=0)
+    overall_boxes = overall_boxes[overall_boxes[:, 1].argsort()[::-1]]
+    return overall_boxes[:, 2:], overall_boxes[:, 1], overall_boxes[:, 0]
+
+
+def make_predictions(rng, num_models, num_boxes, num_classes=5):
+    # 每个模型在相同的几个物体附近预测, 保证有多个框的cluster
+    centers = rng.rand(8, 2) * 0.8 + 0.1
+    boxes_list, scores_list, labels_list = [], [], []
+    for _ in range(num_models):
+        index = rng.randint(0, 8, num_boxes)
+        xy = centers[index] + rng.randn(num_boxes, 2) * 0.02
+        wh = rng.rand(num_boxes, 2) * 0.05 + 0.1
+        boxes_list.append(np.concatenate([xy - wh / 2, xy + wh / 2], 1).clip(0, 1).astype(np.float32))
+        scores_list.append(rng.rand(num_boxes).astype(np.float32))
+        labels_list.append((index + rng.randint(0, 2, num_boxes)) % num_classes)
+    return boxes_list, scores_list, labels_list
+
+
+def sort_rows(boxes, scores, labels):
+    rows = np.concatenate([scores[:, None], labels[:, None], boxes], 1)
+    return rows[np.lexsort(rows.T[::-1])]
+
+
+def test_wbf_matches_loop():
+    rng = np.random.RandomState(0)
+    for trial in range(20):
+        num_models = rng.randint(1, 4)
+        predictions = make_predictions(rng, num_models, rng.randint(1, 80))
+        weights = list(rng.randint(1, 3, num_models))
+        for conf_type in ('avg', 'max'):
+            for allows_overflow in (False, True):
+                kwargs = dict(weights=weights, iou_thr=0.55, skip_box_thr=0.1, conf_type=conf_type,
+                              allows_overflow=allows_overflow)
+                expected = weighted_boxes_fusion_loop(*predictions, **kwargs)
+                fused = weighted_boxes_fusion(*predictions, **kwargs)
+                assert len(fused[0]) == len(expected[0]), trial
+                np.testing.assert_allclose(sort_rows(*fused), sort_rows(*expected), rtol=1e-6, atol=1e-7)
+
+
+def test_wbf_without_boxes():
+    boxes, scores, labels = weighted_boxes_fusion([np.zeros((0, 4))], [np.zeros(0)], [np.zeros(0)])
+    assert len(boxes) == len(scores) == len(labels) == 0
@@ -0,0 +1,20 @@
+import pytest
+
+from utils.eval_metrics.eval_map import VOCAccumulator, ParallelAccumulator
+
+
+def test_parallel_accumulator_terminates_workers_on_error():
+    with pytest.raises(RuntimeError):
+        with ParallelAccumulator(VOCAccumulator([0.5]), num_workers=2) as parallel:
+            workers = list(parallel.pool._pool)
+            assert all(worker.is_alive() for worker in workers)
+            raise RuntimeError('eval failed')
+
+    assert parallel.pool is None
+    assert not any(worker.is_alive() for worker in workers)
+
+
+def test_parallel_accumulator_close_after_result():
+    with ParallelAccumulator(VOCAccumulator([0.5]), num_workers=2) as parallel:
+        accumulator = parallel.result()
+    assert parallel.pool is None and accumulator is parallel.accumulator
@@ -0,0 +1,141 @@
+import torch
+
+from network.RetinaNet.losses import FocalLoss, calc_iou
+
+
+def focal_loss_loop(classifications, regressions, anchors, annotations):
+    # FocalLoss.forward before it was batched (cpu branch)
+    alpha = 0.25
+    gamma = 2.0
+    batch_size = classifications.shape[0]
+    classification_losses = []
+    regression_losses = []
+
+    anchor = anchors[0, :, :]
+
+    anchor_widths = anchor[:, 2] - anchor[:, 0]
+    anchor_heights = anchor[:, 3] - anchor[:, 1]
+    anchor_ctr_x = anchor[:, 0] + 0.5 * anchor_widths
+    anchor_ctr_y = anchor[:, 1] + 0.5 * anchor_heights
+
+    for j in range(batch_size):
+        classification = classifications[j, :, :]
+        regression = regressions[j, :, :]
+        bbox_annotation = annotations[j]
+        bbox_annotation = bbox_annotation[bbox_annotation[:, 4] != -1]
+
+        classification = torch.clamp(classification, 1e-4, 1.0 - 1e-4)
+
+        if bbox_annotation.shape[0] == 0:
+            alpha_factor = 1. - torch.ones(classification.shape) * alpha
+            focal_weight = alpha_factor * torch.pow(classification, gamma)
+            bce = -(torch.log(1.0 - classification))
+            classification_losses.append((focal_weight * bce).sum())
+            regression_losses.append(torch.tensor(0).float())
+            continue
+
+        IoU = calc_iou(anchors[0, :, :], bbox_annotation[:, :4])
+        IoU_max, IoU_argmax = torch.max(IoU, dim=1)
+
+        targets = torch.ones(classification.shape) * -1
+        targets[torch.lt(IoU_max, 0.4), :] = 0
+        positive_indices = torch.ge(IoU_max, 0.5)
+        num_positive_anchors = positive_indices.sum()
+        assigned_annotations = bbox_annotation[IoU_argmax, :]
+
+        targets[positive_indices, :] = 0
+        targets[positive_indices, assigned_annotations[positive_indices, 4].long()] = 1
+
+        alpha_factor = torch.ones(targets.shape) * alpha
+        alpha_factor = torch.where(torch.eq(targets, 1.), alpha_factor, 1. - alpha_factor)
+        focal_weight = torch.where(torch.eq(targets, 1.), 1. - classification, classification)
+        focal_weight = alpha_factor * torch.pow(focal_weight, gamma)
+
+        bce = -(targets * torch.log(classification) + (1.0 - targets) * torch.log(1.0 - classification))
+        cls_loss = focal_weight * bce
+        cls_loss = torch.where(torch.ne(targets, -1.0), cls_loss, torch.zeros(cls_loss.shape))
+        classification_losses.append(cls_loss.sum() / torch.clamp(num_positive_anchors.float(), min=1.0))
+
+        if positive_indices.sum() > 0:
+            assigned_annotations = assigned_annotations[positive_indices, :]
+
+            anchor_widths_pi = anchor_widths[positive_indices]
+            anchor_heights_pi = anchor_heights[positive_indices]
+            anchor_ctr_x_pi = anchor_ctr_x[positive_indices]
+            anchor_ctr_y_pi = anchor_ctr_y[positive_indices]
+
+            gt_widths = assigned_annotations[:, 2] - assigned_annotations[:, 0]
+            gt_heights = assigned_annotations[:, 3] - assigned_annotations[:, 1]
+            gt_ctr_x = assigned_annotations[:, 0] + 0.5 * gt_widths
+            gt_ctr_y = assigned_annotations[:, 1] + 0.5 * gt_heights
+
+            gt_widths = torch.clamp(gt_widths, min=1)
+            gt_heights = torch.clamp(gt_heights, min=1)
+
+            targets_dx = (gt_ctr_x - anchor_ctr_x_pi) / anchor_widths_pi
+            targets_dy = (gt_ctr_y - anchor_ctr_y_pi) / anchor_heights_pi
+            targets_dw = torch.log(gt_widths / anchor_widths_pi)
+            targets_dh = torch.log(gt_heights / anchor_heights_pi)
+
+            targets = torch.stack((targets_dx, targets_dy, targets_dw, targets_dh)).t()
+            targets = targets / torch.Tensor([[0.1, 0.1, 0.2, 0.2]])
+
+            regression_diff = torch.abs(targets - regression[positive_indices, :])
+            regression_loss = torch.where(
+                torch.le(regression_diff, 1.0 / 9.0),
+                0.5 * 9.0 * torch.pow(regression_diff, 2),
+                regression_diff - 0.5 / 9.0
+            )
+            regression_losses.append(regression_loss.mean())
+        else:
+            regression_losses.append(torch.tensor(0).float())
+
+    return torch.stack(classification_losses).mean(dim=0, keepdim=True), \
+        torch.stack(regression_losses).mean(dim=0, keepdim=True)
+
+
+def make_batch(seed, batch_size=4, num_anchors=500, num_classes=6):
+    torch.manual_seed(seed)
+    xy = torch.rand(num_anchors, 2) * 200
+    wh = torch.rand(num_anchors, 2) * 40 + 8
+    anchors = torch.cat([xy, xy + wh], 1)[None]
+
+    annotations = []
+    for j in range(batch_size):
+        n = [3, 0, 7, 1][j % 4]  # 第二张图片没有box
+        # 从anchor附近取box, 保证有正样本和ignore的anchor
+        boxes = anchors[0, torch.randint(0, num_anchors, (n,))] + torch.randn(n, 4) * 3
+        labels = torch.randint(0, num_classes, (n, 1)).float()
+        annotations.append(torch.cat([boxes, labels], 1))
+
+    classifications = torch.rand(batch_size, num_anchors, num_classes)
+    regressions = torch.randn(batch_size, num_anchors, 4) * 0.5
+    return classifications, regressions, anchors, annotations
+
+
+def pad(annotations):
+    max_num = max(len(a) for a in annotations)
+    padded = torch.full([len(annotations), max_num, 5], -1.)
+    for j, a in enumerate(annotations):
+        padded[j, :len(a)] = a
+    return padded
+
+
+def test_focal_loss_matches_loop():
+    for seed in range(3):
+        classifications, regressions, anchors, annotations = make_batch(seed)
+        expected = focal_loss_loop(classifications, regressions, anchors, pad(annotations))
+        # list输入和pad好的tensor输入结果相同
+        for inputs in (annotations, pad(annotations)):
+            cls_loss, reg_loss = FocalLoss()(classifications, regressions, anchors, inputs)
+            torch.testing.assert_close(cls_loss, expected[0])
+            torch.testing.assert_close(reg_loss, expected[1])
+
+
+def test_focal_loss_without_boxes():
+    classifications, regressions, anchors, _ = make_batch(0, batch_size=2)
+    annotations = [torch.zeros(0, 5), torch.zeros(0, 5)]
+    expected = focal_loss_loop(classifications, regressions, anchors, pad([torch.full([1, 5], -1.)] * 2))
+    cls_loss, reg_loss = FocalLoss()(classifications, regressions, anchors, annotations)
+    torch.testing.assert_close(cls_loss, expected[0])
+    assert reg_loss.item() == 0
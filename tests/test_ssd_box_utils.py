@@ -0,0 +1,77 @@
+import torch
+
+from network.SSD.transform.target_transform import SSDTargetTransform
+from network.SSD.utils import box_utils
+
+
+def make_priors(sizes=(8, 4, 2), scales=(0.1, 0.3, 0.6)):
+    # center form priors, 每个位置一大一小两个prior
+    priors = []
+    for size, scale in zip(sizes, scales):
+        for j in range(size):
+            for i in range(size):
+                cx, cy = (i + 0.5) / size, (j + 0.5) / size
+                priors.append([cx, cy, scale, scale])
+                priors.append([cx, cy, scale * 1.4, scale * 0.7])
+    return torch.tensor(priors).clamp(0, 1)
+
+
+def make_groundtruth(seed):
+    torch.manual_seed(seed)
+    gt_boxes, gt_labels = [], []
+    for n in (4, 1, 0, 7):  # 第三张图片没有gt
+        xy = torch.rand(n, 2) * 0.7
+        wh = torch.rand(n, 2) * 0.3 + 0.02
+        boxes = torch.cat([xy, xy + wh], 1)
+        labels = torch.randint(1, 21, (n,))
+        if n >= 3:
+            # 三个target的最佳prior相同, 保留最后一个
+            boxes[1] = boxes[0] + 0.001
+            boxes[2] = boxes[0] - 0.001
+            labels[1] = labels[0] % 20 + 1
+        gt_boxes.append(boxes)
+        gt_labels.append(labels)
+    return gt_boxes, gt_labels
+
+
+def test_assign_priors_batch_matches_assign_priors():
+    corner_form_priors = box_utils.center_form_to_corner_form(make_priors())
+    for seed in range(3):
+        gt_boxes, gt_labels = make_groundtruth(seed)
+        max_num = max(len(boxes) for boxes in gt_boxes)
+        padded_boxes = torch.zeros(len(gt_boxes), max_num, 4)
+        padded_labels = torch.full([len(gt_boxes), max_num], -1, dtype=torch.long)
+        for i, (boxes, labels) in enumerate(zip(gt_boxes, gt_labels)):
+            padded_boxes[i, :len(boxes)] = boxes
+            padded_labels[i, :len(boxes)] = labels
+
+        boxes, labels = box_utils.assign_priors_batch(padded_boxes, padded_labels, corner_form_priors, 0.5)
+        for i in range(len(gt_boxes)):
+            if len(gt_boxes[i]) == 0:
+                assert (labels[i] == 0).all()
+                continue
+            expected_boxes, expected_labels = box_utils.assign_priors(gt_boxes[i], gt_labels[i], corner_form_priors, 0.5)
+            assert torch.equal(labels[i], expected_labels)
+            assert torch.equal(boxes[i], expected_boxes)
+
+
+def test_shared_best_prior_keeps_last_target():
+    corner_form_priors = box_utils.center_form_to_corner_form(make_priors())
+    gt_boxes, gt_labels = make_groundtruth(0)
+    boxes, labels = box_utils.assign_priors_batch(gt_boxes[0][None], gt_labels[0][None], corner_form_priors, 0.5)
+    ious = box_utils.iou_of(gt_boxes[0][:3].unsqueeze(1), corner_form_priors.unsqueeze(0))
+    best_prior = ious.argmax(1)
+    assert (best_prior == best_prior[0]).all()
+    assert labels[0, best_prior[0]] == gt_labels[0][2]
+    assert torch.equal(boxes[0, best_prior[0]], gt_boxes[0][2])
+
+
+def test_target_transform_batch_matches_per_image():
+    transform = SSDTargetTransform(make_priors(), 0.1, 0.2, 0.5)
+    gt_boxes, gt_labels = make_groundtruth(1)
+    gt_boxes, gt_labels = gt_boxes[:2] + gt_boxes[3:], gt_labels[:2] + gt_labels[3:]
+    locations, labels = transform.batch(gt_boxes, gt_labels)
+    for i, (boxes, image_labels) in enumerate(zip(gt_boxes, gt_labels)):
+        expected_locations, expected_labels = transform(boxes, image_labels)
+        assert torch.equal(labels[i], expected_labels)
+        torch.testing.assert_close(locations[i], expected_locations)
@@ -0,0 +1,59 @@
+import os
+
+import numpy as np
+
+from dataloader.voc_index import AnnotationIndex, annotation_fingerprint
+
+
+def make_voc(root, image_ids):
+    os.makedirs(os.path.join(root, 'ImageSets/Main'))
+    os.makedirs(os.path.join(root, 'Annotations'))
+    with open(os.path.join(root, 'ImageSets/Main/train.txt'), 'w') as f:
+        f.write('\n'.join(image_ids))
+    for image_id in image_ids:
+        with open(os.path.join(root, f'Annotations/{image_id}.xml'), 'w') as f:
+            f.write('<annotation></annotation>')
+
+
+def test_index_without_boxes_is_reused(tmp_path):
+    cache_dir = str(tmp_path / 'cache')
+    index = AnnotationIndex.save(cache_dir, str(tmp_path), 'jpg', ['a', 'b'], [[], []], [[], []],
+                                 [(10, 20), (30, 40)], fingerprint='f')
+    assert index is not None and index.num_boxes == 0
+
+    index = AnnotationIndex.load(cache_dir, 'f')
+    assert index is not None
+    assert index.boxes(1).shape == (0, 4) and index.labels(0).shape == (0,)
+    assert index.size(1) == (30, 40)
+
+
+def test_fingerprint_of_every_xml(tmp_path):
+    root = str(tmp_path)
+    image_ids = ['a', 'b', 'c']
+    make_voc(root, image_ids)
+
+    def fingerprint():
+        return annotation_fingerprint(root, 'train.txt', ['cat'], False, 'jpg', image_ids)
+
+    # 修改时间早于最新的xml, 总大小不变
+    xml = os.path.join(root, 'Annotations/a.xml')
+    before = fingerprint()
+    st = os.stat(xml)
+    os.utime(xml, ns=(st.st_atime_ns, st.st_mtime_ns - 10 ** 9))
+    assert fingerprint() != before
+
+    # 两个xml交换大小
+    with open(os.path.join(root, 'Annotations/b.xml'), 'w') as f:
+        f.write('<annotation>1</annotation>')
+    with open(os.path.join(root, 'Annotations/c.xml'), 'w') as f:
+        f.write('<annotation>12</annotation>')
+    for image_id in ('b', 'c'):
+        os.utime(os.path.join(root, f'Annotations/{image_id}.xml'), ns=(0, 10 ** 18))
+    before = fingerprint()
+    with open(os.path.join(root, 'Annotations/b.xml'), 'w') as f:
+        f.write('<annotation>12</annotation>')
+    with open(os.path.join(root, 'Annotations/c.xml'), 'w') as f:
+        f.write('<annotation>1</annotation>')
+    for image_id in ('b', 'c'):
+        os.utime(os.path.join(root, f'Annotations/{image_id}.xml'), ns=(0, 10 ** 18))
+    assert fingerprint() != before
@@ -0,0 +1,226 @@
+import math
+
+import torch
+
+from network.YoloV2V3.yolo.region_layer import RegionLayer
+from network.YoloV2V3.yolo.yolo_layer import YoloLayer
+from network.YoloV2V3.yolo.utils import bbox_iou, multi_bbox_ious
+
+
+def yolo_build_targets_loop(self, pred_boxes, target, anchors, nA, nH, nW):
+    # YoloLayer.build_targets before it was batched
+    nB = target.size(0)
+    anchor_step = anchors.size(1)
+    noobj_mask = torch.ones (nB, nA, nH, nW)
+    obj_mask   = torch.zeros(nB, nA, nH, nW)
+    coord_mask = torch.zeros(nB, nA, nH, nW)
+    tcoord     = torch.zeros( 4, nB, nA, nH, nW)
+    tconf      = torch.zeros(nB, nA, nH, nW)
+    tcls       = torch.zeros(nB, nA, nH, nW, self.num_classes)
+
+    nAnchors = nA*nH*nW
+    nPixels  = nH*nW
+    nGT = 0
+    nRecall = 0
+    nRecall75 = 0
+    anchors = anchors.to("cpu")
+
+    for b in range(nB):
+        cur_pred_boxes = pred_boxes[b*nAnchors:(b+1)*nAnchors].t()
+        cur_ious = torch.zeros(nAnchors)
+        tbox = target[b].view(-1,5).to("cpu")
+
+        for t in range(50):
+            if tbox[t][1] == 0:
+                break
+            gx, gy = tbox[t][1] * nW, tbox[t][2] * nH
+            gw, gh = tbox[t][3] * self.net_width, tbox[t][4] * self.net_height
+            cur_gt_boxes = torch.FloatTensor([gx, gy, gw, gh]).repeat(nAnchors,1).t()
+            cur_ious = torch.max(cur_ious, multi_bbox_ious(cur_pred_boxes, cur_gt_boxes, x1y1x2y2=False))
+        ignore_ix = (cur_ious>self.ignore_thresh).view(nA,nH,nW)
+        noobj_mask[b][ignore_ix] = 0
+
+        for t in range(50):
+            if tbox[t][1] == 0:
+                break
+            nGT += 1
+            gx, gy = tbox[t][1] * nW, tbox[t][2] * nH
+            gw, gh = tbox[t][3] * self.net_width, tbox[t][4] * self.net_height
+            gw, gh = gw.float(), gh.float()
+            gi, gj = int(gx), int(gy)
+
+            tmp_gt_boxes = torch.FloatTensor([0, 0, gw, gh]).repeat(nA,1).t()
+            anchor_boxes = torch.cat((torch.zeros(nA, anchor_step), anchors),1).t()
+            _, best_n = torch.max(multi_bbox_ious(anchor_boxes, tmp_gt_boxes, x1y1x2y2=False), 0)
+
+            gt_box = torch.FloatTensor([gx, gy, gw, gh])
+            pred_box = pred_boxes[b*nAnchors+best_n*nPixels+gj*nW+gi]
+            iou = bbox_iou(gt_box, pred_box, x1y1x2y2=False)
+
+            obj_mask  [b][best_n][gj][gi] = 1
+            noobj_mask[b][best_n][gj][gi] = 0
+            coord_mask[b][best_n][gj][gi] = 2. - tbox[t][3]*tbox[t][4]
+            tcoord [0][b][best_n][gj][gi] = gx - gi
+            tcoord [1][b][best_n][gj][gi] = gy - gj
+            tcoord [2][b][best_n][gj][gi] = math.log(gw/anchors[best_n][0])
+            tcoord [3][b][best_n][gj][gi] = math.log(gh/anchors[best_n][1])
+            tcls      [b][best_n][gj][gi][int(tbox[t][0])] = 1
+            tconf     [b][best_n][gj][gi] = iou if self.rescore else 1.
+
+            if iou > 0.5:
+                nRecall += 1
+                if iou > 0.75:
+                    nRecall75 += 1
+
+    return nGT, nRecall, nRecall75, obj_mask, noobj_mask, coord_mask, tcoord, tconf, tcls
+
+
+def region_build_targets_loop(self, pred_boxes, target, nH, nW):
+    # RegionLayer.build_targets before it was batched (anchor_step == 2)
+    nB = target.size(0)
+    nA = self.num_anchors
+    noobj_mask = torch.ones (nB, nA, nH, nW)
+    obj_mask   = torch.zeros(nB, nA, nH, nW)
+    coord_mask = torch.zeros(nB, nA, nH, nW)
+    tcoord     = torch.zeros( 4, nB, nA, nH, nW)
+    tconf      = torch.zeros(nB, nA, nH, nW)
+    tcls       = torch.zeros(nB, nA, nH, nW)
+
+    nAnchors = nA*nH*nW
+    nPixels  = nH*nW
+    nGT = 0
+    nRecall = 0
+    anchors = self.anchors.to("cpu")
+
+    if self.seen < 12800:
+        tcoord[0].fill_(0.5)
+        tcoord[1].fill_(0.5)
+        coord_mask.fill_(0.01)
+
+    for b in range(nB):
+        cur_pred_boxes = pred_boxes[b*nAnchors:(b+1)*nAnchors].t()
+        cur_ious = torch.zeros(nAnchors)
+        tbox = target[b].view(-1,5).to("cpu")
+        for t in range(50):
+            if tbox[t][1] == 0:
+                break
+            gx, gw = [ i * nW for i in (tbox[t][1], tbox[t][3]) ]
+            gy, gh = [ i * nH for i in (tbox[t][2], tbox[t][4]) ]
+            cur_gt_boxes = torch.FloatTensor([gx, gy, gw, gh]).repeat(nAnchors,1).t()
+            cur_ious = torch.max(cur_ious, multi_bbox_ious(cur_pred_boxes, cur_gt_boxes, x1y1x2y2=False))
+        ignore_ix = (cur_ious>self.thresh).view(nA,nH,nW)
+        noobj_mask[b][ignore_ix] = 0
+
+        for t in range(50):
+            if tbox[t][1] == 0:
+                break
+            nGT += 1
+            gx, gw = [ i * nW for i in (tbox[t][1], tbox[t][3]) ]
+            gy, gh = [ i * nH for i in (tbox[t][2], tbox[t][4]) ]
+            gw, gh = gw.float(), gh.float()
+            gi, gj = int(gx), int(gy)
+
+            tmp_gt_boxes = torch.FloatTensor([0, 0, gw, gh]).repeat(nA,1).t()
+            anchor_boxes = torch.cat((torch.zeros(nA, 2), anchors),1).t()
+            tmp_ious = multi_bbox_ious(anchor_boxes, tmp_gt_boxes, x1y1x2y2=False)
+            best_iou, best_n = torch.max(tmp_ious, 0)
+
+            gt_box = torch.FloatTensor([gx, gy, gw, gh])
+            pred_box = pred_boxes[b*nAnchors+best_n*nPixels+gj*nW+gi]
+            iou = bbox_iou(gt_box, pred_box, x1y1x2y2=False)
+
+            obj_mask  [b][best_n][gj][gi] = 1
+            noobj_mask[b][best_n][gj][gi] = 0
+            coord_mask[b][best_n][gj][gi] = 2. - tbox[t][3]*tbox[t][4]
+            tcoord [0][b][best_n][gj][gi] = gx - gi
+            tcoord [1][b][best_n][gj][gi] = gy - gj
+            tcoord [2][b][best_n][gj][gi] = math.log(gw/anchors[best_n][0])
+            tcoord [3][b][best_n][gj][gi] = math.log(gh/anchors[best_n][1])
+            tcls      [b][best_n][gj][gi] = tbox[t][0]
+            tconf     [b][best_n][gj][gi] = iou if self.rescore else 1.
+            if iou > 0.5:
+                nRecall += 1
+
+    return nGT, nRecall, obj_mask, noobj_mask, coord_mask, tcoord, tconf, tcls
+
+
+def make_target(nB, num_classes, seed):
+    torch.manual_seed(seed)
+    target = torch.zeros(nB, 50 * 5)
+    for b in range(nB):
+        n = [6, 0, 50, 3][b % 4]  # 第二张图片没有gt, 第三张gt填满50个
+        tbox = target[b].view(50, 5)
+        tbox[:n, 0] = torch.randint(0, num_classes, (n,)).float()
+        tbox[:n, 1:3] = torch.rand(n, 2) * 0.9 + 0.05
+        tbox[:n, 3:5] = torch.rand(n, 2) * 0.5 + 0.02
+        if n >= 3:
+            # 同一个cell同一个anchor的多个gt, 类别不同
+            tbox[1, 1:5] = tbox[0, 1:5] + 0.001
+            tbox[2, 1:5] = tbox[0, 1:5] - 0.001
+            tbox[1, 0] = (tbox[0, 0] + 1) % num_classes
+    return target
+
+
+def make_pred_boxes(target, nA, nH, nW, wh_scale, seed):
+    # 一部分预测框就是gt, 保证有被忽略的预测框和recall
+    torch.manual_seed(seed)
+    nB = target.size(0)
+    pred = torch.cat([torch.rand(nB * nA * nH * nW, 2) * nW,
+                      torch.rand(nB * nA * nH * nW, 2) * 4 + 0.2], 1)
+    for b in range(nB):
+        tbox = target[b].view(50, 5)
+        n = int((tbox[:, 1] > 0).sum())
+        for t in range(0, n, 2):
+            gx, gy = tbox[t, 1] * nW, tbox[t, 2] * nH
+            idx = b * nA * nH * nW + (t % nA) * nH * nW + int(gy) * nW + int(gx)
+            pred[idx] = torch.stack([gx, gy, tbox[t, 3] * wh_scale[0], tbox[t, 4] * wh_scale[1]]) * 1.05
+    return pred
+
+
+def assert_same_targets(new, old):
+    assert new[:-6] == old[:-6]  # nGT, nRecall (, nRecall75)
+    for n, o in zip(new[-6:], old[-6:]):
+        torch.testing.assert_close(n, o)
+
+
+def test_yolo_build_targets_matches_loop():
+    anchors = [10, 13, 16, 30, 33, 23, 30, 61, 62, 45, 59, 119, 116, 90, 156, 198, 373, 326]
+    layer = YoloLayer(anchor_mask=[3, 4, 5], num_classes=5, anchors=anchors, num_anchors=9, device='cpu')
+    layer.net_width, layer.net_height = 416, 416
+    masked_anchors = layer.get_mask_boxes(None)['a'].view(3, 2) / 16
+    nA, nH, nW = 3, 26, 26
+
+    for seed in range(3):
+        target = make_target(4, layer.num_classes, seed)
+        pred_boxes = make_pred_boxes(target, nA, nH, nW, (layer.net_width, layer.net_height), seed)
+        new = layer.build_targets(pred_boxes, target, masked_anchors, nA, nH, nW)
+        old = yolo_build_targets_loop(layer, pred_boxes, target, masked_anchors, nA, nH, nW)
+        assert new[0] > 0 and new[1] > 0
+        assert_same_targets(new, old)
+
+
+def test_region_build_targets_matches_loop():
+    anchors = [1.08, 1.19, 3.42, 4.41, 6.63, 11.38, 9.42, 5.11, 16.62, 10.52]
+    layer = RegionLayer(num_classes=20, anchors=anchors, num_anchors=5, device='cpu')
+    nH, nW = 13, 13
+
+    for seen in (0, 12800):  # 前12800张图片tcoord和coord_mask有默认值
+        layer.seen = seen
+        for seed in range(3):
+            target = make_target(4, layer.num_classes, seed)
+            pred_boxes = make_pred_boxes(target, layer.num_anchors, nH, nW, (nW, nH), seed)
+            new = layer.build_targets(pred_boxes, target, nH, nW)
+            old = region_build_targets_loop(layer, pred_boxes, target, nH, nW)
+            assert new[0] > 0 and new[1] > 0
+            assert_same_targets(new, old)
+
+
+def test_build_targets_without_gt():
+    layer = RegionLayer(num_classes=3, anchors=[1., 1., 2., 2.], num_anchors=2, device='cpu')
+    layer.seen = 12800
+    target = torch.zeros(2, 250)
+    pred_boxes = torch.rand(2 * 2 * 5 * 5, 4) * 5
+    nGT, nRecall, obj_mask, noobj_mask, coord_mask, tcoord, tconf, tcls = layer.build_targets(pred_boxes, target, 5, 5)
+    assert nGT == 0 and nRecall == 0
+    assert (noobj_mask == 1).all()
+    assert not obj_mask.any() and not coord_mask.any() and not tcoord.any() and not tconf.any() and not tcls.any()
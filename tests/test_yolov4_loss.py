@@ -0,0 +1,117 @@
+import torch
+
+from options import opt
+from network.YoloV4.loss import Yolo_loss, bboxes_iou
+
+
+def build_target_loop(self, pred, labels, batchsize, fsize, n_ch, output_id):
+    # Yolo_loss.build_target before it was batched
+    tgt_mask = torch.zeros(batchsize, self.n_anchors, fsize, fsize, 4 + self.n_classes)
+    obj_mask = torch.ones(batchsize, self.n_anchors, fsize, fsize)
+    tgt_scale = torch.zeros(batchsize, self.n_anchors, fsize, fsize, 2)
+    target = torch.zeros(batchsize, self.n_anchors, fsize, fsize, n_ch)
+
+    nlabel = (labels.sum(dim=2) > 0).sum(dim=1)
+    masked_anchors = self.masked_anchors[output_id].cpu().numpy()
+
+    truth_x_all = (labels[:, :, 2] + labels[:, :, 0]) / (self.strides[output_id] * 2)
+    truth_y_all = (labels[:, :, 3] + labels[:, :, 1]) / (self.strides[output_id] * 2)
+    truth_w_all = (labels[:, :, 2] - labels[:, :, 0]) / self.strides[output_id]
+    truth_h_all = (labels[:, :, 3] - labels[:, :, 1]) / self.strides[output_id]
+    truth_i_all = truth_x_all.to(torch.int16).cpu().numpy()
+    truth_j_all = truth_y_all.to(torch.int16).cpu().numpy()
+
+    for b in range(batchsize):
+        n = int(nlabel[b])
+        if n == 0:
+            continue
+        truth_box = torch.zeros(n, 4)
+        truth_box[:n, 2] = truth_w_all[b, :n]
+        truth_box[:n, 3] = truth_h_all[b, :n]
+        truth_i = truth_i_all[b, :n]
+        truth_j = truth_j_all[b, :n]
+
+        anchor_ious_all = bboxes_iou(truth_box.cpu(), self.ref_anchors[output_id].cpu(), CIoU=True)
+
+        best_n_all = anchor_ious_all.argmax(dim=1)
+        best_n = best_n_all % 3
+        best_n_mask = ((best_n_all == self.anch_masks[output_id][0]) |
+                       (best_n_all == self.anch_masks[output_id][1]) |
+                       (best_n_all == self.anch_masks[output_id][2]))
+
+        if sum(best_n_mask) == 0:
+            continue
+
+        truth_box[:n, 0] = truth_x_all[b, :n]
+        truth_box[:n, 1] = truth_y_all[b, :n]
+
+        pred_ious = bboxes_iou(pred[b].view(-1, 4), truth_box, xyxy=False)
+        pred_best_iou, _ = pred_ious.max(dim=1)
+        pred_best_iou = (pred_best_iou > self.ignore_thre)
+        pred_best_iou = pred_best_iou.view(pred[b].shape[:3])
+        obj_mask[b] = ~ pred_best_iou
+
+        for ti in range(best_n.shape[0]):
+            if best_n_mask[ti] == 1:
+                i, j = truth_i[ti], truth_j[ti]
+                a = best_n[ti]
+                obj_mask[b, a, j, i] = 1
+                tgt_mask[b, a, j, i, :] = 1
+                target[b, a, j, i, 0] = truth_x_all[b, ti] - truth_x_all[b, ti].to(torch.int16).to(torch.float)
+                target[b, a, j, i, 1] = truth_y_all[b, ti] - truth_y_all[b, ti].to(torch.int16).to(torch.float)
+                target[b, a, j, i, 2] = torch.log(
+                    truth_w_all[b, ti] / torch.Tensor(masked_anchors)[best_n[ti], 0] + 1e-16)
+                target[b, a, j, i, 3] = torch.log(
+                    truth_h_all[b, ti] / torch.Tensor(masked_anchors)[best_n[ti], 1] + 1e-16)
+                target[b, a, j, i, 4] = 1
+                target[b, a, j, i, 5 + labels[b, ti, 4].to(torch.int16).cpu().numpy()] = 1
+                tgt_scale[b, a, j, i, :] = torch.sqrt(2 - truth_w_all[b, ti] * truth_h_all[b, ti] / fsize / fsize)
+    return obj_mask, tgt_mask, tgt_scale, target
+
+
+def make_labels(batch_size, max_boxes, image_size, n_classes, seed):
+    torch.manual_seed(seed)
+    labels = torch.zeros(batch_size, max_boxes, 5)
+    for b in range(batch_size):
+        n = [5, 0, max_boxes, 2][b % 4]  # 第二张图片没有truth
+        xy = torch.rand(n, 2) * image_size * 0.7
+        wh = torch.rand(n, 2) * image_size * 0.4 + 4
+        labels[b, :n, :2] = xy
+        labels[b, :n, 2:4] = xy + wh
+        labels[b, :n, 4] = torch.randint(0, n_classes, (n,)).float()
+        if n >= 3:
+            # 同一个cell同一个anchor的多个truth, 类别不同
+            labels[b, 1, :4] = labels[b, 0, :4] + 0.5
+            labels[b, 2, :4] = labels[b, 0, :4] - 0.5
+            labels[b, 1, 4] = (labels[b, 0, 4] + 1) % n_classes
+    return labels
+
+
+def test_build_target_matches_loop():
+    opt.width = 128
+    n_classes, batch_size = 4, 4
+    loss = Yolo_loss(n_classes=n_classes, device='cpu', batch=batch_size)
+    n_ch = 5 + n_classes
+
+    for seed in range(4):
+        labels = make_labels(batch_size, 8, opt.width, n_classes, seed)
+        for output_id, stride in enumerate(loss.strides):
+            fsize = opt.width // stride
+            # 预测框在truth附近, 保证有被忽略的预测框
+            pred = torch.rand(batch_size, 3, fsize, fsize, 4) * fsize
+            pred[..., 2:] = torch.rand(batch_size, 3, fsize, fsize, 2) * fsize / 2 + 0.5
+
+            new = loss.build_target(pred, labels, batch_size, fsize, n_ch, output_id)
+            old = build_target_loop(loss, pred, labels, batch_size, fsize, n_ch, output_id)
+            for name, n, o in zip(['obj_mask', 'tgt_mask', 'tgt_scale', 'target'], new, old):
+                torch.testing.assert_close(n, o, msg=lambda m: f'{name}, seed {seed}, layer {output_id}: {m}')
+
+
+def test_build_target_without_truths():
+    opt.width = 64
+    loss = Yolo_loss(n_classes=3, device='cpu', batch=2)
+    labels = torch.zeros(2, 6, 5)
+    pred = torch.rand(2, 3, 8, 8, 4) * 8
+    obj_mask, tgt_mask, tgt_scale, target = loss.build_target(pred, labels, 2, 8, 8, 0)
+    assert (obj_mask == 1).all()
+    assert not tgt_mask.any() and not tgt_scale.any() and not target.any()
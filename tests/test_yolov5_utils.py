@@ -0,0 +1,140 @@
+from types import SimpleNamespace
+
+import torch
+
+from network.YoloV5 import utils
+
+
+def build_targets_loop(p, targets, model):
+    # build_targets before the tensors were cached (rect4)
+    det = model.model[-1]
+    na, nt = det.na, targets.shape[0]
+    tcls, tbox, indices, anch = [], [], [], []
+    gain = torch.ones(6, device=targets.device)
+    off = torch.tensor([[1, 0], [0, 1], [-1, 0], [0, -1]], device=targets.device).float()
+    at = torch.arange(na).view(na, 1).repeat(1, nt)
+
+    g = 0.5
+    for i in range(det.nl):
+        anchors = det.anchors[i]
+        gain[2:] = torch.tensor(p[i].shape)[[3, 2, 3, 2]]
+
+        a, t, offsets = [], targets * gain, 0
+        if nt:
+            r = t[None, :, 4:6] / anchors[:, None]
+            j = torch.max(r, 1. / r).max(2)[0] < model.hyp['anchor_t']
+            a, t = at[j], t.repeat(na, 1, 1)[j]
+
+            gxy = t[:, 2:4]
+            z = torch.zeros_like(gxy)
+            j, k = ((gxy % 1. < g) & (gxy > 1.)).T
+            l, m = ((gxy % 1. > (1 - g)) & (gxy < (gain[[2, 3]] - 1.))).T
+            a, t = torch.cat((a, a[j], a[k], a[l], a[m]), 0), torch.cat((t, t[j], t[k], t[l], t[m]), 0)
+            offsets = torch.cat((z, z[j] + off[0], z[k] + off[1], z[l] + off[2], z[m] + off[3]), 0) * g
+
+        b, c = t[:, :2].long().T
+        gxy = t[:, 2:4]
+        gwh = t[:, 4:6]
+        gij = (gxy - offsets).long()
+        gi, gj = gij.T
+
+        indices.append((b, torch.as_tensor(a, dtype=torch.long), gj, gi))
+        tbox.append(torch.cat((gxy - gij, gwh), 1))
+        anch.append(anchors[a])
+        tcls.append(c)
+
+    return tcls, tbox, indices, anch
+
+
+def make_model():
+    anchors = torch.tensor([[10, 13, 16, 30, 33, 23],
+                            [30, 61, 62, 45, 59, 119],
+                            [116, 90, 156, 198, 373, 326]]).float().view(3, 3, 2)
+    anchors /= torch.tensor([8., 16., 32.]).view(3, 1, 1)
+    det = SimpleNamespace(na=3, nl=3, anchors=anchors)
+    return SimpleNamespace(model=[det], hyp={'anchor_t': 4.0})
+
+
+def make_targets(batch_size, nt):
+    torch.manual_seed(nt)
+    image = torch.randint(0, batch_size, (nt,)).sort()[0].float()  # 按图片排序, 同collate_fn
+    cls = torch.randint(0, 20, (nt,)).float()
+    xy = torch.rand(nt, 2)
+    wh = torch.rand(nt, 2) * 0.5 + 0.01
+    targets = torch.cat([image[:, None], cls[:, None], xy, wh], 1)
+    if nt > 1:
+        targets[1, 2:] = targets[0, 2:]  # 同一个位置的两个gt
+    return targets
+
+
+def as_rows(tcls, tbox, indices, anch, layer):
+    b, a, gj, gi = indices[layer]
+    rows = torch.cat([torch.stack([b, a, gj, gi, tcls[layer]], 1).float(), tbox[layer], anch[layer]], 1)
+    return sorted(tuple(round(v, 5) for v in row) for row in rows.tolist())
+
+
+def test_build_targets_matches_loop():
+    model = make_model()
+    p = [torch.zeros(4, 3, s, s, 25) for s in (32, 16, 8)]
+    for nt in (0, 1, 7, 40):
+        targets = make_targets(4, nt)
+        new = utils.build_targets(p, targets, model)
+        old = build_targets_loop(p, targets, model)
+        for layer in range(3):
+            assert as_rows(*new, layer) == as_rows(*old, layer)
+
+
+def test_build_targets_cache_reused():
+    model = make_model()
+    p = [torch.zeros(2, 3, s, s, 25) for s in (16, 8, 4)]
+    utils.build_targets(p, make_targets(2, 5), model)
+    cached = len(utils._target_tensors)
+    utils.build_targets(p, make_targets(2, 6), model)  # 同一个nt bucket
+    assert len(utils._target_tensors) == cached
+
+
+def make_prediction(batch_size, n, nc, seed=0):
+    torch.manual_seed(seed)
+    xy = torch.rand(batch_size, n, 2) * 320
+    wh = torch.rand(batch_size, n, 2) * 60 + 4
+    conf = torch.rand(batch_size, n, 1 + nc)
+    prediction = torch.cat([xy, wh, conf], 2)
+    prediction[-1, :, 4] = 0  # 最后一张图片没有检测结果
+    return prediction
+
+
+def sort_rows(x):
+    # 分数相同的框顺序可能不同, 按(分数, 类别, 坐标)排序后比较
+    order = sorted(range(len(x)), key=lambda i: x[i, [4, 5, 0, 1]].tolist())
+    return x[order]
+
+
+def assert_same_detections(batched, per_image):
+    assert len(batched) == len(per_image)
+    for b, p in zip(batched, per_image):
+        if p is None:
+            assert b is None
+            continue
+        torch.testing.assert_close(sort_rows(b), sort_rows(p))
+
+
+def test_batched_nms_matches_per_image():
+    for nc in (1, 5):
+        prediction = make_prediction(3, 400, nc, seed=nc)
+        for max_det in (300, 10):
+            per_image = utils.non_max_suppression(prediction.clone(), 0.3, 0.5, max_det=max_det)
+            batched = utils.non_max_suppression(prediction.clone(), 0.3, 0.5, max_det=max_det, batched=True)
+            assert_same_detections(batched, per_image)
+
+
+def test_batched_nms_fixed_shape():
+    prediction = make_prediction(3, 200, 4)
+    per_image = utils.non_max_suppression(prediction.clone(), 0.3, 0.5, max_det=20)
+    output, counts = utils.non_max_suppression(prediction.clone(), 0.3, 0.5, max_det=20, fixed_shape=True)
+    assert output.shape == (3, 20, 6)
+    for i, p in enumerate(per_image):
+        n = 0 if p is None else len(p)
+        assert counts[i] == n
+        assert (output[i, n:] == 0).all()
+        if n:
+            assert_same_detections([output[i, :n]], [p])
@@ -3,6 +3,9 @@ __author__ = 'ZFTurbo: https://kaggle.com/zfturbo'
 
 from .ensemble_boxes_wbf import weighted_boxes_fusion
 from .ensemble_boxes_nmw import non_maximum_weighted
+from .ensemble_boxes_torch import weighted_boxes_fusion_torch
+from .ensemble_boxes_torch import non_maximum_weighted_torch
+from .ensemble_boxes_torch import soft_nms_torch
 from .ensemble_boxes_nms import nms_method
 from .ensemble_boxes_nms import nms
 from .ensemble_boxes_nms import soft_nms
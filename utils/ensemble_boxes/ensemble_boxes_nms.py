@@ -87,6 +87,72 @@ def cpu_soft_nms_float(dets, sc, Nt, sigma, thresh, method):
     return keep
 
 
+def iou_of_one(boxes, areas, i, others):
+    """
+    IoU of box i with the boxes others, same values as the IoU computed in cpu_soft_nms_float.
+
+    :param boxes: [N, 4] float64 boxes, order: x1, y1, x2, y2
+    :param areas: [N] areas of boxes
+    :param i: index of one box
+    :param others: [M] indexes of the other boxes
+    :return: [M] float64 IoU values
+    """
+    w = np.maximum(0.0, np.minimum(boxes[i, 2], boxes[others, 2]) - np.maximum(boxes[i, 0], boxes[others, 0]))
+    h = np.maximum(0.0, np.minimum(boxes[i, 3], boxes[others, 3]) - np.maximum(boxes[i, 1], boxes[others, 1]))
+    inter = h * w
+    with np.errstate(divide='ignore', invalid='ignore'):
+        return inter / (areas[i] + areas[others] - inter)
+
+
+def soft_nms_float(dets, sc, Nt, sigma, thresh, method):
+    """
+    Same results as cpu_soft_nms_float, without the per-step concatenations and copies of the boxes.
+    Only the IoU row of the selected box is computed at every step (O(N) memory), and the loop stops
+    once every remaining score is at or below thresh.
+
+    :param dets:   boxes format [x1, y1, x2, y2]
+    :param sc:     scores for boxes
+    :param Nt:     required iou
+    :param sigma:
+    :param thresh:
+    :param method: 1 - linear soft-NMS, 2 - gaussian soft-NMS, 3 - standard NMS
+    :return:       index of boxes to keep
+    """
+    N = dets.shape[0]
+    boxes = np.asarray(dets, dtype=np.float64)
+    areas = (boxes[:, 2] - boxes[:, 0]) * (boxes[:, 3] - boxes[:, 1])
+
+    # order[k] is the box at position k, positions are swapped in the same way as cpu_soft_nms_float
+    order = np.arange(N)
+    scores = np.array(sc, copy=True)
+
+    for i in range(N - 1):  # 最后一个框后面没有需要衰减的框
+        pos = i + 1
+        maxpos = np.argmax(scores[pos:], axis=0)
+        if scores[i] < scores[pos + maxpos]:
+            j = pos + maxpos
+            order[i], order[j] = order[j], order[i]
+            scores[i], scores[j] = scores[j], scores[i]
+
+        if thresh >= 0 and not scores[i] > thresh:
+            break  # 剩下的分数都不大于thresh, 衰减之后也不会大于thresh
+
+        ovr = iou_of_one(boxes, areas, order[i], order[pos:])
+
+        # Three methods: 1.linear 2.gaussian 3.original NMS
+        if method == 1:  # linear
+            weight = np.where(ovr > Nt, 1 - ovr, 1.)
+        elif method == 2:  # gaussian
+            weight = np.exp(-(ovr * ovr) / sigma)
+        else:  # original NMS
+            weight = np.where(ovr > Nt, 0., 1.)
+
+        scores[pos:] = weight * scores[pos:]
+
+    # select the boxes and keep the corresponding indexes
+    return order[scores > thresh]
+
+
 def nms_float_fast(dets, scores, thresh):
     """
     # It's different from original nms because we have float coordinates on range [0; 1]
@@ -165,7 +231,7 @@ def nms_method(boxes, scores, labels, method=3, iou_thr=0.5, sigma=0.5, thresh=0
         labels_by_label = np.array([l] * len(boxes_by_label))
 
         if method != 3:
-            keep = cpu_soft_nms_float(boxes_by_label.copy(), scores_by_label.copy(), Nt=iou_thr, sigma=sigma, thresh=thresh, method=method)
+            keep = soft_nms_float(boxes_by_label.copy(), scores_by_label.copy(), Nt=iou_thr, sigma=sigma, thresh=thresh, method=method)
         else:
             # Use faster function
             keep = nms_float_fast(boxes_by_label, scores_by_label, thresh=iou_thr)
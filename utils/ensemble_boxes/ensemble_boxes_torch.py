@@ -0,0 +1,320 @@
+# coding: utf-8
+"""
+Torch versions of weighted_boxes_fusion, non_maximum_weighted and soft-NMS.
+
+The inputs are padded batches [B, N, 4] with a validity mask [B, N], the whole batch is fused on the
+device of the inputs and copied to the host only once, by batch_to_numpy. Boxes are regrouped by
+(image, label) first, WBF takes one step per box of the largest group for all groups at once.
+"""
+
+import numpy as np
+import torch
+
+
+def box_iou_one_to_many(boxes, box):
+    """
+    IoU of box [B, 4] with boxes [B, M, 4] (same formula as bb_intersection_over_union)
+    :return: iou [B, M]
+    """
+    lt = torch.max(boxes[..., :2], box[:, None, :2])
+    rb = torch.min(boxes[..., 2:], box[:, None, 2:])
+    wh = (rb - lt).clamp(min=0)
+    inter = wh[..., 0] * wh[..., 1]
+
+    area_a = (boxes[..., 2] - boxes[..., 0]) * (boxes[..., 3] - boxes[..., 1])
+    area_b = (box[:, 2] - box[:, 0]) * (box[:, 3] - box[:, 1])
+    union = area_a + area_b[:, None] - inter
+    return torch.where(inter > 0, inter / union.clamp(min=1e-12), torch.zeros_like(inter))
+
+
+def box_iou_batch(boxes):
+    """
+    Pairwise IoU of boxes [B, N, 4]
+    :return: iou [B, N, N]
+    """
+    lt = torch.max(boxes[:, :, None, :2], boxes[:, None, :, :2])
+    rb = torch.min(boxes[:, :, None, 2:], boxes[:, None, :, 2:])
+    wh = (rb - lt).clamp(min=0)
+    inter = wh[..., 0] * wh[..., 1]
+
+    area = (boxes[..., 2] - boxes[..., 0]) * (boxes[..., 3] - boxes[..., 1])
+    union = area[:, :, None] + area[:, None, :] - inter
+    return torch.where(inter > 0, inter / union.clamp(min=1e-12), torch.zeros_like(inter))
+
+
+def prefilter_boxes_batch(boxes, scores, labels, mask=None, thr=0.0, max_boxes=None):
+    """
+    Drop boxes with score lower than thr and sort the others by score (descending), invalid boxes go last
+    :param max_boxes: keep at most this many boxes (highest scores) of every image, None for keeping all
+    :return: boxes [B, n, 4], scores [B, n], labels [B, n], valid [B, n], n = max number of valid boxes of an image
+    """
+    valid = scores >= thr
+    if mask is not None:
+        valid = valid & mask.bool()
+
+    key = torch.where(valid, scores, torch.full_like(scores, -float('inf')))
+    order = key.argsort(dim=1, descending=True)
+    n = int(valid.sum(1).max()) if valid.numel() else 0  # 每个batch只同步一次
+    if max_boxes is not None and max_boxes > 0:
+        n = min(n, max_boxes)
+    order = order[:, :n]
+
+    boxes = boxes.gather(1, order[..., None].expand(-1, -1, 4))
+    return boxes, scores.gather(1, order), labels.gather(1, order), valid.gather(1, order)
+
+
+def group_by_label(boxes, scores, labels, valid):
+    """
+    Regroup score-sorted boxes of every image into one row per (image, label), boxes of a row keep their order.
+    Boxes are only matched with boxes of the same label, so the rows are fused independently and the
+    clustering loop takes as many steps as the largest row instead of the largest image.
+    :return: boxes [G, m, 4], scores [G, m], valid [G, m], image [G], label [G]
+    """
+    device = scores.device
+    b_idx, j_idx = valid.nonzero(as_tuple=True)  # 每张图片内按分数排序
+    key = torch.stack([b_idx, labels[b_idx, j_idx].long()], 1)
+    groups, group = torch.unique(key, dim=0, return_inverse=True)
+
+    # 按(图片, 类别)分组, 组内保持原来的顺序
+    order = torch.sort(group, stable=True)[1]
+    group, b_idx, j_idx = group[order], b_idx[order], j_idx[order]
+    counts = torch.bincount(group, minlength=len(groups))
+    pos = torch.arange(len(group), device=device) - (counts.cumsum(0) - counts)[group]
+    g, m = len(groups), int(counts.max()) if len(groups) else 0
+
+    grouped_boxes = boxes.new_zeros([g, m, 4])
+    grouped_scores = scores.new_zeros([g, m])
+    grouped_valid = torch.zeros([g, m], dtype=torch.bool, device=device)
+    grouped_boxes[group, pos] = boxes[b_idx, j_idx]
+    grouped_scores[group, pos] = scores[b_idx, j_idx]
+    grouped_valid[group, pos] = True
+    return grouped_boxes, grouped_scores, grouped_valid, groups[:, 0], groups[:, 1].to(labels.dtype)
+
+
+def ungroup_by_image(boxes, scores, valid, image, label, batch_size, max_per_image=None):
+    """
+    Gather the fused boxes of every (image, label) row back into their images, sorted by score
+    :param max_per_image: keep at most this many boxes of every image, None for keeping all
+    :return: boxes [B, n, 4], scores [B, n], labels [B, n], valid [B, n]
+    """
+    device = scores.device
+    g_idx, c_idx = valid.nonzero(as_tuple=True)
+    batch_idx = image[g_idx]
+    order = scores[g_idx, c_idx].argsort(descending=True)
+    order = order[torch.sort(batch_idx[order], stable=True)[1]]  # 按图片分组, 组内按分数排序
+    g_idx, c_idx, batch_idx = g_idx[order], c_idx[order], batch_idx[order]
+
+    counts = torch.bincount(batch_idx, minlength=batch_size)
+    pos = torch.arange(len(batch_idx), device=device) - (counts.cumsum(0) - counts)[batch_idx]
+    n = int(counts.max()) if len(batch_idx) else 0
+    if max_per_image is not None and max_per_image > 0:
+        keep = pos < max_per_image
+        g_idx, c_idx, batch_idx, pos = g_idx[keep], c_idx[keep], batch_idx[keep], pos[keep]
+        n = min(n, max_per_image)
+
+    out_boxes = boxes.new_zeros([batch_size, n, 4])
+    out_scores = scores.new_zeros([batch_size, n])
+    out_labels = label.new_zeros([batch_size, n])
+    out_valid = torch.zeros([batch_size, n], dtype=torch.bool, device=device)
+    out_boxes[batch_idx, pos] = boxes[g_idx, c_idx]
+    out_scores[batch_idx, pos] = scores[g_idx, c_idx]
+    out_labels[batch_idx, pos] = label[g_idx]
+    out_valid[batch_idx, pos] = True
+    return out_boxes, out_scores, out_labels, out_valid
+
+
+def weighted_boxes_fusion_torch(boxes, scores, labels, mask=None, iou_thr=0.55, skip_box_thr=0.0, conf_type='avg', num_models=1,
+                                allows_overflow=False, max_boxes=None, max_per_image=None):
+    '''
+    :param boxes: [B, N, 4] padded boxes of every image. Order of boxes: x1, y1, x2, y2
+    :param scores: [B, N] confidence scores
+    :param labels: [B, N] labels
+    :param mask: [B, N] bool, False for padding. Default: None, which means all boxes are valid
+    :param iou_thr: IoU value for boxes to be a match
+    :param skip_box_thr: exclude boxes with score lower than this variable
+    :param conf_type: how to calculate confidence in weighted boxes. 'avg': average value, 'max': maximum value
+    :param num_models: number of predictions (e.g. TTA) fused in every image, confidence is rescaled by it
+    :param allows_overflow: false if we want confidence score not exceed 1.0
+    :param max_boxes: fuse at most this many boxes (highest scores) of every image, None for all of them
+    :param max_per_image: keep at most this many fused boxes of every image, None for all of them
+
+    :return: boxes: [B, n, 4] fused boxes, sorted by score
+    :return: scores: [B, n] confidence scores
+    :return: labels: [B, n] boxes labels
+    :return: valid: [B, n] bool, False for padding
+    '''
+    if conf_type not in ['avg', 'max']:
+        raise ValueError('Unknown conf_type: {}. Must be "avg" or "max"'.format(conf_type))
+
+    batch_size = scores.shape[0]
+    boxes, scores, labels, valid = prefilter_boxes_batch(boxes, scores, labels, mask, skip_box_thr, max_boxes)
+    boxes, scores, valid, image, label = group_by_label(boxes, scores, labels, valid)
+    g, m = scores.shape
+    device = scores.device
+
+    cluster_sums = boxes.new_zeros([g, m, 4])  # sum of score * box
+    cluster_boxes = boxes.new_zeros([g, m, 4])  # weighted box, matched against new boxes
+    cluster_conf = scores.new_zeros([g, m])
+    cluster_max = scores.new_zeros([g, m])
+    cluster_counts = scores.new_zeros([g, m])
+    num_clusters = torch.zeros(g, dtype=torch.long, device=device)
+
+    group_index = torch.arange(g, device=device)
+    cluster_index = torch.arange(m, device=device)
+
+    # 每一步处理所有(图片, 类别)的第j个框
+    for j in range(m):
+        box = boxes[:, j]
+        score = torch.where(valid[:, j], scores[:, j], torch.zeros_like(scores[:, j]))
+
+        iou = box_iou_one_to_many(cluster_boxes, box)
+        iou = torch.where(cluster_index[None] < num_clusters[:, None], iou, torch.full_like(iou, -1.))
+        best_iou, best = iou.max(1)
+
+        matched = valid[:, j] & (best_iou > iou_thr)
+        new = valid[:, j] & ~matched
+        target = torch.where(matched, best, num_clusters)  # 没有匹配的框放到新的cluster
+
+        cluster_sums[group_index, target] += score[:, None] * box
+        cluster_conf[group_index, target] += score
+        cluster_max[group_index, target] = torch.max(cluster_max[group_index, target], score)
+        cluster_counts[group_index, target] += valid[:, j].to(cluster_counts.dtype)
+
+        weighted = cluster_sums[group_index, target] / cluster_conf[group_index, target].clamp(min=1e-12)[:, None]
+        cluster_boxes[group_index, target] = torch.where(new[:, None], box, weighted)
+
+        num_clusters += new.long()
+
+    fused_valid = cluster_index[None] < num_clusters[:, None]
+    fused_scores = cluster_conf / cluster_counts.clamp(min=1) if conf_type == 'avg' else cluster_max
+
+    # Rescale confidence based on number of models and boxes
+    if not allows_overflow:
+        fused_scores = fused_scores * cluster_counts.clamp(max=num_models) / num_models
+    else:
+        fused_scores = fused_scores * cluster_counts / num_models
+
+    return ungroup_by_image(cluster_boxes, fused_scores, fused_valid, image, label, batch_size, max_per_image)
+
+
+def non_maximum_weighted_torch(boxes, scores, labels, mask=None, iou_thr=0.55, skip_box_thr=0.0, max_boxes=None,
+                               max_per_image=None):
+    '''
+    :param boxes: [B, N, 4] padded boxes of every image. Order of boxes: x1, y1, x2, y2
+    :param scores: [B, N] confidence scores
+    :param labels: [B, N] labels
+    :param mask: [B, N] bool, False for padding. Default: None, which means all boxes are valid
+    :param iou_thr: IoU value for boxes to be a match
+    :param skip_box_thr: exclude boxes with score lower than this variable
+    :param max_boxes: fuse at most this many boxes (highest scores) of every image, None for all of them
+    :param max_per_image: keep at most this many fused boxes of every image, None for all of them
+
+    :return: boxes: [B, n, 4] fused boxes, sorted by score
+    :return: scores: [B, n] confidence scores
+    :return: labels: [B, n] boxes labels
+    :return: valid: [B, n] bool, False for padding
+    '''
+    batch_size = scores.shape[0]
+    boxes, scores, labels, valid = prefilter_boxes_batch(boxes, scores, labels, mask, skip_box_thr, max_boxes)
+    boxes, scores, valid, image, label = group_by_label(boxes, scores, labels, valid)
+    g, m = scores.shape
+    device = scores.device
+    if m == 0:
+        return ungroup_by_image(boxes, scores, valid, image, label, batch_size)
+
+    # main box of a cluster is its first box, so all IoUs needed can be computed at once
+    iou = box_iou_batch(boxes)
+    iou = torch.where(valid[:, :, None] & valid[:, None, :], iou, torch.full_like(iou, -1.))
+
+    # 框j是main box当且仅当前面的main box和它的IoU都不超过iou_thr (即贪心NMS), 迭代到不再变化, 次数为抑制链的长度
+    earlier = torch.ones([m, m], dtype=torch.bool, device=device).tril(-1)  # earlier[j, i]: i < j
+    is_main = valid.clone()
+    while True:
+        suppressed = ((iou > iou_thr) & earlier & is_main[:, None, :]).any(2)
+        updated = valid & ~suppressed
+        if torch.equal(updated, is_main):
+            break
+        is_main = updated
+
+    # 其余的框分到前面和它IoU最大的main box
+    main_iou = torch.where(earlier & is_main[:, None, :], iou, torch.full_like(iou, -1.))
+    assign = torch.where(is_main, torch.arange(m, device=device)[None], main_iou.argmax(2))
+
+    # weight of every box is score * IoU with the main box of its cluster
+    weights = scores * iou.gather(2, assign[..., None])[..., 0].clamp(min=0)
+    weights = torch.where(valid, weights, torch.zeros_like(weights))
+
+    box_sums = boxes.new_zeros([g, m, 4]).scatter_add_(1, assign[..., None].expand(-1, -1, 4), weights[..., None] * boxes)
+    weight_sums = scores.new_zeros([g, m]).scatter_add_(1, assign, weights)
+    fused_boxes = box_sums / weight_sums.clamp(min=1e-12)[..., None]
+
+    return ungroup_by_image(fused_boxes, scores, is_main, image, label, batch_size, max_per_image)
+
+
+def batch_to_numpy(boxes, scores, labels, valid):
+    """
+    Copy fused results to the host once and split them per image
+
+    :return: (batch_bboxes, batch_labels, batch_scores), same as BaseModel.forward
+    """
+    boxes = boxes.detach().cpu().numpy()
+    scores = scores.detach().cpu().numpy()
+    labels = labels.detach().cpu().numpy()
+    valid = valid.detach().cpu().numpy()
+
+    batch_bboxes = []
+    batch_labels = []
+    batch_scores = []
+    for bi in range(len(valid)):
+        keep = valid[bi]
+        batch_bboxes.append(boxes[bi][keep])
+        batch_labels.append(labels[bi][keep].astype(np.int32))
+        batch_scores.append(scores[bi][keep])
+
+    return batch_bboxes, batch_labels, batch_scores
+
+
+def soft_nms_torch(boxes, scores, iou_thr=0.5, sigma=0.5, thresh=0.001, method=2, check_every=32):
+    """
+    Soft-NMS on the device of the inputs, same algorithm as soft_nms_float in ensemble_boxes_nms.py
+    (ties between equal scores may be broken differently)
+
+    :param boxes: [N, 4] boxes, order: x1, y1, x2, y2
+    :param scores: [N] scores
+    :param iou_thr: required iou (linear soft-NMS and standard NMS)
+    :param sigma: Sigma value for gaussian soft-NMS
+    :param thresh: threshold for boxes to keep
+    :param method: 1 - linear soft-NMS, 2 - gaussian soft-NMS, 3 - standard NMS
+    :param check_every: stop once every remaining score is at or below thresh, checked every check_every steps
+        (each check waits for the device)
+    :return: index of boxes to keep, in the order they are selected
+    """
+    n = scores.shape[0]
+    boxes = boxes.double()
+    scores = scores.clone()
+    remaining = torch.ones(n, dtype=torch.bool, device=scores.device)
+    order = torch.empty(n, dtype=torch.long, device=scores.device)
+
+    selected = n
+    for i in range(n):
+        key = torch.where(remaining, scores, torch.full_like(scores, -float('inf')))
+        best = key.argmax()
+        if thresh >= 0 and i % check_every == 0 and not key[best] > thresh:
+            selected = i  # 剩下的分数都不大于thresh, 衰减之后也不会大于thresh
+            break
+        order[i] = best
+        remaining[best] = False
+
+        # 每一步只计算选中的框和其他框的IoU
+        ovr = box_iou_one_to_many(boxes[None], boxes[best][None])[0].to(scores.dtype)
+        if method == 1:  # linear
+            weight = torch.where(ovr > iou_thr, 1 - ovr, torch.ones_like(ovr))
+        elif method == 2:  # gaussian
+            weight = torch.exp(-(ovr * ovr) / sigma)
+        else:  # original NMS
+            weight = torch.where(ovr > iou_thr, torch.zeros_like(ovr), torch.ones_like(ovr))
+
+        scores = torch.where(remaining, scores * weight, scores)
+
+    order = order[:selected]
+    return order[scores[order] > thresh]
@@ -27,23 +27,33 @@ def bb_intersection_over_union(A, B):
 
 def prefilter_boxes(boxes, scores, labels, weights, thr):
     # Create dict with boxes stored by its label
-    new_boxes = dict()
+    # Boxes of all models are filtered at once, rows keep the order (model, box) of the inputs
+    rows = []
     for t in range(len(boxes)):
-        for j in range(len(boxes[t])):
-            score = scores[t][j]
-            if score < thr:
-                continue
-            label = int(labels[t][j])
-            box_part = boxes[t][j]
-            b = [int(label), float(score) * weights[t], float(box_part[0]), float(box_part[1]), float(box_part[2]), float(box_part[3])]
-            if label not in new_boxes:
-                new_boxes[label] = []
-            new_boxes[label].append(b)
-
-    # Sort each list in dict by score and transform it to numpy array
-    for k in new_boxes:
-        current_boxes = np.array(new_boxes[k])
-        new_boxes[k] = current_boxes[current_boxes[:, 1].argsort()[::-1]]
+        if len(boxes[t]) == 0:
+            continue
+        model_scores = np.asarray(scores[t], dtype=np.float64).reshape(-1)
+        b = np.zeros((len(model_scores), 6), dtype=np.float64)
+        b[:, 0] = np.asarray(labels[t], dtype=np.float64).reshape(-1).astype(np.int64)
+        b[:, 1] = model_scores * weights[t]
+        b[:, 2:] = np.asarray(boxes[t], dtype=np.float64).reshape(-1, 4)
+        rows.append(b[~(model_scores < thr)])
+
+    new_boxes = dict()
+    if len(rows) == 0:
+        return new_boxes
+
+    rows = np.concatenate(rows, axis=0)
+    if len(rows) == 0:
+        return new_boxes
+
+    # Labels in order of first appearance, same as inserting into the dict one by one
+    unique_labels, first_index = np.unique(rows[:, 0], return_index=True)
+
+    # Sort each list in dict by score
+    for label in unique_labels[np.argsort(first_index)]:
+        current_boxes = rows[rows[:, 0] == label]
+        new_boxes[int(label)] = current_boxes[current_boxes[:, 1].argsort()[::-1]]
 
     return new_boxes
 
@@ -87,6 +97,101 @@ def find_matching_box(boxes_list, new_box, match_iou):
     return best_index, best_iou
 
 
+def _box_area(box):
+    return (box[..., 2] - box[..., 0]) * (box[..., 3] - box[..., 1])
+
+
+def _iou_with_clusters(cluster_boxes, cluster_areas, new_boxes):
+    """
+    IoU of the new box of every label with the clusters of its label, in float64
+    (bb_intersection_over_union mixes float32 and float64 depending on which boxes are fused,
+    so values can differ from it in the last bits)
+    :param cluster_boxes: [L, M, 4] cluster boxes of every label
+    :param cluster_areas: [L, M] areas of cluster_boxes
+    :param new_boxes: [L, 4] one new box of every label
+    :return: iou [L, M]
+    """
+    lt = np.maximum(cluster_boxes[..., :2], new_boxes[:, None, :2])
+    rb = np.minimum(cluster_boxes[..., 2:], new_boxes[:, None, 2:])
+    wh = np.maximum(rb - lt, 0.)
+    inter = wh[..., 0] * wh[..., 1]
+
+    iou = np.zeros(inter.shape, dtype=np.float64)
+    np.divide(inter, cluster_areas + _box_area(new_boxes)[:, None] - inter, out=iou, where=inter != 0)
+    return iou
+
+
+def cluster_boxes(groups, iou_thr, conf_type='avg'):
+    """
+    Clusterize the boxes of every label and fuse each cluster, same algorithm as the
+    find_matching_box / get_weighted_box loop. Labels are processed together: step j matches
+    the j-th box of every label against the clusters of that label.
+    :param groups: list of [N_l, 6] arrays of (label, score, x1, y1, x2, y2), one per label, sorted by score
+    :param iou_thr: IoU value for boxes to be a match
+    :param conf_type: type of confidence one of 'avg' or 'max'
+    :return: weighted boxes: [K, 6] array, clusters of the first label first. Fused clusters are
+        rounded to float32 as in get_weighted_box, single box clusters are the box itself
+    :return: counts: [K] number of boxes in every cluster
+    """
+    num_labels = len(groups)
+    sizes = np.array([len(g) for g in groups])
+    m = sizes.max()
+    boxes = np.zeros((num_labels, m, 6), dtype=np.float64)
+    for i, g in enumerate(groups):
+        boxes[i, :len(g)] = g
+    areas = _box_area(boxes[..., 2:])
+
+    cluster_boxes = np.zeros((num_labels, m, 4), dtype=np.float64)
+    cluster_areas = np.zeros((num_labels, m), dtype=np.float64)
+    first = np.zeros((num_labels, m), dtype=np.int64)  # first (best) box of every cluster
+    sums = np.zeros((num_labels, m, 4), dtype=np.float32)  # sum of score * box, accumulated in float32 as get_weighted_box
+    conf_sum = np.zeros((num_labels, m), dtype=np.float64)
+    conf_max = np.zeros((num_labels, m), dtype=np.float64)
+    counts = np.zeros((num_labels, m), dtype=np.int64)
+    num_clusters = np.zeros(num_labels, dtype=np.int64)
+
+    label_index = np.arange(num_labels)
+    cluster_index = np.arange(m)
+    for j in range(m):
+        active = j < sizes
+        iou = _iou_with_clusters(cluster_boxes, cluster_areas, boxes[:, j, 2:])
+        iou[cluster_index[None] >= num_clusters[:, None]] = -1.
+        best = iou.argmax(1)  # 相同的IoU取第一个cluster, 同find_matching_box
+        matched = active & (iou[label_index, best] > iou_thr)
+        new = active & ~matched
+
+        # 没有匹配的框作为新的cluster
+        l, t = label_index[new], num_clusters[new]
+        first[l, t] = j
+        cluster_boxes[l, t] = boxes[l, j, 2:]
+        cluster_areas[l, t] = areas[l, j]
+        num_clusters[new] += 1
+
+        l, t = label_index[active], np.where(matched, best, num_clusters - 1)[active]
+        score = boxes[l, j, 1]
+        sums[l, t] = sums[l, t] + score[:, None] * boxes[l, j, 2:]
+        conf_sum[l, t] += score
+        conf_max[l, t] = np.maximum(conf_max[l, t], score)
+        counts[l, t] += 1
+
+        # 匹配到的cluster更新加权后的框
+        l, t = label_index[matched], best[matched]
+        cluster_boxes[l, t] = (sums[l, t] / conf_sum[l, t, None]).astype(np.float32)
+        cluster_areas[l, t] = _box_area(cluster_boxes[l, t])
+
+    valid = cluster_index[None] < num_clusters[:, None]
+    l, t = valid.nonzero()  # 按类别, 再按cluster的顺序
+    weighted_boxes = boxes[l, first[l, t]]
+    counts = counts[l, t]
+
+    fused = counts > 1
+    l, t = l[fused], t[fused]
+    scores = conf_sum[l, t] / counts[fused] if conf_type == 'avg' else conf_max[l, t]
+    weighted_boxes[fused, 1] = scores.astype(np.float32)
+    weighted_boxes[fused, 2:] = cluster_boxes[l, t]
+    return weighted_boxes, counts
+
+
 def weighted_boxes_fusion(boxes_list, scores_list, labels_list, weights=None, iou_thr=0.55, skip_box_thr=0.0, conf_type='avg', allows_overflow=False):
     '''
     :param boxes_list: list of boxes predictions from each model, each box is 4 numbers. 
@@ -120,31 +225,17 @@ def weighted_boxes_fusion(boxes_list, scores_list, labels_list, weights=None, io
     if len(filtered_boxes) == 0:
         return np.zeros((0, 4)), np.zeros((0,)), np.zeros((0,))
 
-    overall_boxes = []
-    for label in filtered_boxes:
-        boxes = filtered_boxes[label]
-        new_boxes = []
-        weighted_boxes = []
-
-        # Clusterize boxes
-        for j in range(0, len(boxes)):
-            index, best_iou = find_matching_box(weighted_boxes, boxes[j], iou_thr)
-            if index != -1:
-                new_boxes[index].append(boxes[j])
-                weighted_boxes[index] = get_weighted_box(new_boxes[index], conf_type)
-            else:
-                new_boxes.append([boxes[j].copy()])
-                weighted_boxes.append(boxes[j].copy())
-
-        # Rescale confidence based on number of models and boxes
-        for i in range(len(new_boxes)):
-            if not allows_overflow:
-                weighted_boxes[i][1] = weighted_boxes[i][1] * min(weights.sum(), len(new_boxes[i])) / weights.sum()
-            else:
-                weighted_boxes[i][1] = weighted_boxes[i][1] * len(new_boxes[i]) / weights.sum()
-        overall_boxes.append(np.array(weighted_boxes))
-
-    overall_boxes = np.concatenate(overall_boxes, axis=0)
+    overall_boxes, counts = cluster_boxes(list(filtered_boxes.values()), iou_thr, conf_type)
+
+    # Rescale confidence based on number of models and boxes
+    if not allows_overflow:
+        scale = np.minimum(weights.sum(), counts) / weights.sum()
+    else:
+        scale = counts / weights.sum()
+    fused = counts > 1
+    overall_boxes[:, 1] *= scale
+    overall_boxes[fused, 1] = overall_boxes[fused, 1].astype(np.float32)  # 融合的框的分数是float32, 同get_weighted_box
+
     overall_boxes = overall_boxes[overall_boxes[:, 1].argsort()[::-1]]
     boxes = overall_boxes[:, 2:]
     scores = overall_boxes[:, 1]
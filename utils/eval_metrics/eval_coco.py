@@ -0,0 +1,267 @@
+from __future__ import division
+
+from collections import defaultdict
+import numpy as np
+import six
+
+# COCO protocol, same as pycocotools.cocoeval.Params
+IOU_THRESHS = np.linspace(.5, 0.95, int(np.round((0.95 - .5) / .05)) + 1, endpoint=True)
+REC_THRESHS = np.linspace(.0, 1.00, int(np.round((1.00 - .0) / .01)) + 1, endpoint=True)
+MAX_DETS = (1, 10, 100)
+AREA_RANGES = ((0 ** 2, 1e5 ** 2), (0 ** 2, 32 ** 2), (32 ** 2, 96 ** 2), (96 ** 2, 1e5 ** 2))
+AREA_NAMES = ('all', 'small', 'medium', 'large')
+
+
+def box_iou(bbox_a, bbox_b):
+    """IoU between xyxy boxes as computed by pycocotools (no +1 on coordinates).
+
+    Args:
+        bbox_a (numpy.ndarray): [N, 4]
+        bbox_b (numpy.ndarray): [K, 4]
+
+    Returns:
+        numpy.ndarray: [N, K]
+    """
+    tl = np.maximum(bbox_a[:, None, :2], bbox_b[:, :2])
+    br = np.minimum(bbox_a[:, None, 2:], bbox_b[:, 2:])
+
+    area_i = np.prod(np.clip(br - tl, 0, None), axis=2)
+    area_a = np.prod(bbox_a[:, 2:] - bbox_a[:, :2], axis=1)
+    area_b = np.prod(bbox_b[:, 2:] - bbox_b[:, :2], axis=1)
+    union = area_a[:, None] + area_b - area_i
+    return np.where(union > 0, area_i / np.maximum(union, 1e-12), 0)
+
+
+class COCOAccumulator(object):
+    """COCO protocol mAP@[.5:.95] without pycocotools.
+
+    Follows ``pycocotools.cocoeval.COCOeval`` for bbox evaluation: 10 IoU thresholds,
+    4 area ranges, max detections 1/10/100 per image and class, 101-point interpolated
+    precision. The greedy matching of each image and class is done for all IoU thresholds
+    and area ranges at once, looping only over the (at most 100) detections. There are
+    no crowd annotations, ground truth area is the box area.
+
+    Args:
+        iou_threshs (numpy.ndarray): IoU thresholds.
+        rec_threshs (numpy.ndarray): recall thresholds for interpolated precision.
+        max_dets (tuple of int): max detections per image and class, ascending.
+        area_ranges (tuple): (min_area, max_area) of each area range.
+
+    Example:
+        accumulator = COCOAccumulator()
+        for sample in dataloader:
+            accumulator.add_batch(pred_bboxes, pred_labels, pred_scores, gt_bboxes, gt_labels)
+
+        stats = accumulator.summarize()  # {'AP': ..., 'AP50': ..., 'AP75': ..., ...}
+
+    """
+
+    def __init__(self, iou_threshs=IOU_THRESHS, rec_threshs=REC_THRESHS, max_dets=MAX_DETS, area_ranges=AREA_RANGES):
+        self.iou_threshs = np.asarray(iou_threshs, dtype=np.float64)
+        self.rec_threshs = np.asarray(rec_threshs, dtype=np.float64)
+        self.max_dets = tuple(max_dets)
+        self.area_ranges = np.asarray(area_ranges, dtype=np.float64)
+
+        self.n_pos = {}  # 每一类 [A] 不忽略的gt数量
+        self.score = defaultdict(list)  # 每张图一个 [D]
+        self.rank = defaultdict(list)  # [D] 在这张图这一类里的名次, 用于max_dets截断
+        self.match = defaultdict(list)  # [A, T, D] bool
+        self.ignore = defaultdict(list)  # [A, T, D] bool
+
+    def _match(self, pred_bbox, gt_bbox):
+        """Greedy matching of one image and class, for all area ranges and IoU thresholds.
+
+        Returns:
+            tuple: (dt_match [A, T, D], dt_ignore [A, T, D], gt_ignore [A, G])
+        """
+        n_area, n_thresh = len(self.area_ranges), len(self.iou_threshs)
+        n_dt, n_gt = len(pred_bbox), len(gt_bbox)
+
+        gt_area = np.prod(gt_bbox[:, 2:] - gt_bbox[:, :2], axis=1)
+        dt_area = np.prod(pred_bbox[:, 2:] - pred_bbox[:, :2], axis=1)
+        gt_ignore = (gt_area[None] < self.area_ranges[:, :1]) | (gt_area[None] > self.area_ranges[:, 1:])  # [A, G]
+        dt_outside = (dt_area[None] < self.area_ranges[:, :1]) | (dt_area[None] > self.area_ranges[:, 1:])  # [A, D]
+
+        dt_match = np.zeros([n_area, n_thresh, n_dt], dtype=bool)
+        dt_ignore = np.zeros([n_area, n_thresh, n_dt], dtype=bool)
+
+        if n_gt > 0 and n_dt > 0:
+            ious = box_iou(pred_bbox, gt_bbox)
+            gt_taken = np.zeros([n_area, n_thresh, n_gt], dtype=bool)
+            thresh = np.minimum(self.iou_threshs, 1 - 1e-10)[None, :, None]  # [1, T, 1]
+            ignore = gt_ignore[:, None, :]  # [A, 1, G]
+
+            for d in range(n_dt):
+                iou_d = ious[d][None, None, :]  # [1, 1, G]
+                candidate = ~gt_taken & (iou_d >= thresh)  # [A, T, G]
+
+                # 优先匹配不忽略的gt, 没有的话再匹配忽略的gt; IoU相同时取后一个, 和pycocotools一致
+                best = None
+                for group in (candidate & ~ignore, candidate & ignore):
+                    found = group.any(axis=2)
+                    score = np.where(group, iou_d, -1.)[:, :, ::-1]
+                    m = n_gt - 1 - score.argmax(axis=2)
+                    best = np.where(found, m, -1) if best is None else np.where(best >= 0, best, np.where(found, m, -1))
+
+                matched = best >= 0  # [A, T]
+                a_idx, t_idx = np.nonzero(matched)
+                g_idx = best[a_idx, t_idx]
+                gt_taken[a_idx, t_idx, g_idx] = True
+                dt_match[:, :, d] = matched
+                dt_ignore[a_idx, t_idx, d] = gt_ignore[a_idx, g_idx]
+
+        # 没匹配上且面积不在范围内的检测框忽略
+        dt_ignore |= ~dt_match & dt_outside[:, None, :]
+
+        return dt_match, dt_ignore, gt_ignore
+
+    def add(self, pred_bbox, pred_label, pred_score, gt_bbox, gt_label):
+        """Add predictions and ground truths of one image.
+
+        Args:
+            pred_bbox (numpy.ndarray): [R, 4] predicted xyxy bounding boxes.
+            pred_label (numpy.ndarray): [R] predicted labels.
+            pred_score (numpy.ndarray): [R] confidence scores.
+            gt_bbox (numpy.ndarray): [R', 4] ground truth xyxy bounding boxes.
+            gt_label (numpy.ndarray): [R'] ground truth labels.
+
+        """
+        max_det = self.max_dets[-1]
+        pred_bbox = np.asarray(pred_bbox, dtype=np.float64).reshape([-1, 4])
+        gt_bbox = np.asarray(gt_bbox, dtype=np.float64).reshape([-1, 4])
+        pred_label = np.asarray(pred_label).reshape([-1])
+        pred_score = np.asarray(pred_score).reshape([-1])
+        gt_label = np.asarray(gt_label).reshape([-1])
+
+        for l in np.unique(np.concatenate((pred_label, gt_label)).astype(int)):
+            pred_mask_l = pred_label == l
+            order = np.argsort(-pred_score[pred_mask_l], kind='mergesort')[:max_det]
+            pred_bbox_l = pred_bbox[pred_mask_l][order]
+            pred_score_l = pred_score[pred_mask_l][order]
+            gt_bbox_l = gt_bbox[gt_label == l]
+
+            dt_match, dt_ignore, gt_ignore = self._match(pred_bbox_l, gt_bbox_l)
+
+            self.n_pos[l] = self.n_pos.get(l, 0) + np.logical_not(gt_ignore).sum(axis=1)
+            if len(pred_bbox_l) == 0:
+                continue
+
+            self.score[l].append(pred_score_l)
+            self.rank[l].append(np.arange(len(pred_score_l)))
+            self.match[l].append(dt_match)
+            self.ignore[l].append(dt_ignore)
+
+    def empty(self):
+        """A new accumulator with the same settings and no data."""
+        return COCOAccumulator(self.iou_threshs, self.rec_threshs, self.max_dets, self.area_ranges)
+
+    def merge(self, other):
+        """Append the data of ``other``, as if its images were added after the images of ``self``."""
+        for l, n_pos in other.n_pos.items():
+            self.n_pos[l] = self.n_pos.get(l, 0) + n_pos
+            self.score[l].extend(other.score[l])
+            self.rank[l].extend(other.rank[l])
+            self.match[l].extend(other.match[l])
+            self.ignore[l].extend(other.ignore[l])
+
+    def add_batch(self, pred_bboxes, pred_labels, pred_scores, gt_bboxes, gt_labels):
+        """Add a batch, arguments are lists of per-image arrays."""
+        for pred_bbox, pred_label, pred_score, gt_bbox, gt_label in \
+                six.moves.zip(pred_bboxes, pred_labels, pred_scores, gt_bboxes, gt_labels):
+            self.add(pred_bbox, pred_label, pred_score, gt_bbox, gt_label)
+
+    def accumulate(self):
+        """Precision and recall tables, same layout as ``COCOeval.eval``.
+
+        Returns:
+            tuple: (precision [T, R, K, A, M], recall [T, K, A, M], classes [K]),
+            -1 for classes without ground truth.
+        """
+        classes = sorted(self.n_pos.keys())
+        T, R, K = len(self.iou_threshs), len(self.rec_threshs), len(classes)
+        A, M = len(self.area_ranges), len(self.max_dets)
+
+        precision = -np.ones([T, R, K, A, M])
+        recall = -np.ones([T, K, A, M])
+
+        for k, l in enumerate(classes):
+            if not self.score[l]:
+                score_l = np.zeros([0])
+                rank_l = np.zeros([0], dtype=np.int64)
+                match_l = np.zeros([A, T, 0], dtype=bool)
+                ignore_l = np.zeros([A, T, 0], dtype=bool)
+            else:
+                score_l = np.concatenate(self.score[l])
+                rank_l = np.concatenate(self.rank[l])
+                match_l = np.concatenate(self.match[l], axis=2)
+                ignore_l = np.concatenate(self.ignore[l], axis=2)
+
+            for m, max_det in enumerate(self.max_dets):
+                selected = rank_l < max_det
+                order = np.argsort(-score_l[selected], kind='mergesort')
+                dt_match = match_l[:, :, selected][:, :, order]
+                dt_ignore = ignore_l[:, :, selected][:, :, order]
+
+                for a in range(A):
+                    n_pos = self.n_pos[l][a]
+                    if n_pos == 0:
+                        continue
+
+                    tp = np.cumsum(dt_match[a] & ~dt_ignore[a], axis=1).astype(np.float64)  # [T, D]
+                    fp = np.cumsum(~dt_match[a] & ~dt_ignore[a], axis=1).astype(np.float64)
+                    n_dt = tp.shape[1]
+
+                    rc = tp / n_pos
+                    pr = tp / (fp + tp + np.spacing(1))
+                    recall[:, k, a, m] = rc[:, -1] if n_dt else 0
+
+                    # precision取右侧最大值, 再在101个recall上插值
+                    pr = np.maximum.accumulate(pr[:, ::-1], axis=1)[:, ::-1]
+                    for t in range(T):
+                        q = np.zeros(R)
+                        inds = np.searchsorted(rc[t], self.rec_threshs, side='left')
+                        valid = inds < n_dt
+                        q[valid] = pr[t, inds[valid]]
+                        precision[t, :, k, a, m] = q
+
+        return precision, recall, classes
+
+    def summarize(self):
+        """The 12 numbers printed by ``COCOeval.summarize``.
+
+        Returns:
+            dict: AP, AP50, AP75, APs, APm, APl, AR1, AR10, AR100, ARs, ARm, ARl
+        """
+        precision, recall, _ = self.accumulate()
+        max_det = len(self.max_dets) - 1
+
+        def _mean(s):
+            s = s[s > -1]
+            return float(np.mean(s)) if len(s) else -1.
+
+        def _ap(iou_thresh=None, area=0, m=max_det):
+            s = precision
+            if iou_thresh is not None:
+                s = s[np.isclose(self.iou_threshs, iou_thresh)]
+            return _mean(s[:, :, :, area, m])
+
+        def _ar(area=0, m=max_det):
+            return _mean(recall[:, :, area, m])
+
+        stats = {
+            'AP': _ap(),
+            'AP50': _ap(.5),
+            'AP75': _ap(.75),
+            'APs': _ap(area=1),
+            'APm': _ap(area=2),
+            'APl': _ap(area=3),
+        }
+        for m, max_det_m in enumerate(self.max_dets):
+            stats[f'AR{max_det_m}'] = _ar(m=m)
+        stats.update({
+            'ARs': _ar(area=1),
+            'ARm': _ar(area=2),
+            'ARl': _ar(area=3),
+        })
+
+        return stats
@@ -1,7 +1,8 @@
 from __future__ import division
 
-from collections import defaultdict
+from collections import defaultdict, deque
 import itertools
+import multiprocessing
 import numpy as np
 import six
 
@@ -353,3 +354,256 @@ def calc_detection_voc_ap(prec, rec, use_07_metric=False):
             ap[l] = np.sum((mrec[i + 1] - mrec[i]) * mpre[i + 1])
 
     return ap
+
+
+class VOCAccumulator(object):
+    """Streaming version of :func:`eval_detection_voc` for several IoU thresholds at once.
+
+    Predictions and ground truths are added image by image (or batch by batch) while the
+    dataset is being evaluated. The IoU matrix of each image and class is computed
+    once and matches for all thresholds are recorded from it, so the result for each
+    threshold is identical to calling :func:`eval_detection_voc` with that threshold.
+    Only scores and match flags of predictions are kept (int8 flags), memory is
+    O(number of detections).
+
+    Args:
+        iou_threshs (iterable of float): IoU thresholds to evaluate.
+        use_07_metric (bool): Whether to use PASCAL VOC 2007 evaluation metric.
+
+    Example:
+        accumulator = VOCAccumulator([0.5, 0.75])
+        for sample in dataloader:
+            accumulator.add_batch(pred_bboxes, pred_labels, pred_scores, gt_bboxes, gt_labels)
+
+        for iou_thresh, result in zip(accumulator.iou_threshs, accumulator.evaluate()):
+            print(iou_thresh, result['map'])
+
+    """
+
+    def __init__(self, iou_threshs=(0.5, 0.55, 0.6, 0.65, 0.7, 0.75), use_07_metric=False):
+        self.iou_threshs = np.array(iou_threshs, dtype=np.float64)
+        self.use_07_metric = use_07_metric
+
+        self.n_pos = defaultdict(int)
+        self.score = defaultdict(list)  # 每张图一个 [R]
+        self.match = defaultdict(list)  # 每张图一个 [R, T] int8, 1: tp, 0: fp, -1: difficult
+
+    def add(self, pred_bbox, pred_label, pred_score, gt_bbox, gt_label, gt_difficult=None):
+        """Add predictions and ground truths of one image.
+
+        Args:
+            pred_bbox (numpy.ndarray): [R, 4] predicted bounding boxes.
+            pred_label (numpy.ndarray): [R] predicted labels.
+            pred_score (numpy.ndarray): [R] confidence scores.
+            gt_bbox (numpy.ndarray): [R', 4] ground truth bounding boxes.
+            gt_label (numpy.ndarray): [R'] ground truth labels.
+            gt_difficult (numpy.ndarray): [R'] boolean array, :obj:`None`
+                means no bounding box is difficult.
+
+        """
+        n_thresh = len(self.iou_threshs)
+        pred_bbox = np.asarray(pred_bbox).reshape([-1, 4])
+        gt_bbox = np.asarray(gt_bbox).reshape([-1, 4])
+
+        if gt_difficult is None:
+            gt_difficult = np.zeros(gt_bbox.shape[0], dtype=bool)
+
+        for l in np.unique(np.concatenate((pred_label, gt_label)).astype(int)):
+            pred_mask_l = pred_label == l
+            pred_bbox_l = pred_bbox[pred_mask_l]
+            pred_score_l = pred_score[pred_mask_l]
+            # sort by score
+            order = pred_score_l.argsort()[::-1]
+            pred_bbox_l = pred_bbox_l[order]
+            pred_score_l = pred_score_l[order]
+
+            gt_mask_l = gt_label == l
+            gt_bbox_l = gt_bbox[gt_mask_l]
+            gt_difficult_l = gt_difficult[gt_mask_l]
+
+            self.n_pos[l] += np.logical_not(gt_difficult_l).sum()
+
+            if len(pred_bbox_l) == 0:
+                continue
+
+            match_l = np.zeros([len(pred_bbox_l), n_thresh], dtype=np.int8)
+            self.score[l].append(pred_score_l)
+            self.match[l].append(match_l)
+
+            if len(gt_bbox_l) == 0:
+                continue
+
+            # VOC evaluation follows integer typed bounding boxes.
+            pred_bbox_l = pred_bbox_l.copy()
+            pred_bbox_l[:, 2:] += 1
+            gt_bbox_l = gt_bbox_l.copy()
+            gt_bbox_l[:, 2:] += 1
+
+            iou = bbox_iou(pred_bbox_l, gt_bbox_l)
+            gt_index = iou.argmax(axis=1)
+            max_iou = iou.max(axis=1)
+            del iou
+
+            for t, iou_thresh in enumerate(self.iou_threshs):
+                matched = np.nonzero(max_iou >= iou_thresh)[0]
+                if len(matched) == 0:
+                    continue
+
+                # 按分数从高到低, 每个gt只有第一个匹配上的预测框算tp
+                matched_gt = gt_index[matched]
+                _, first = np.unique(matched_gt, return_index=True)
+                m = np.zeros(len(matched), dtype=np.int8)
+                m[first] = 1
+                m[gt_difficult_l[matched_gt]] = -1
+                match_l[matched, t] = m
+
+    def empty(self):
+        """A new accumulator with the same settings and no data."""
+        return VOCAccumulator(self.iou_threshs, use_07_metric=self.use_07_metric)
+
+    def merge(self, other):
+        """Append the data of ``other``, as if its images were added after the images of ``self``."""
+        for l, n_pos in other.n_pos.items():
+            self.n_pos[l] += n_pos
+            self.score[l].extend(other.score[l])
+            self.match[l].extend(other.match[l])
+
+    def add_batch(self, pred_bboxes, pred_labels, pred_scores, gt_bboxes, gt_labels, gt_difficults=None):
+        """Add a batch, arguments are lists of per-image arrays like :func:`eval_detection_voc`."""
+        if gt_difficults is None:
+            gt_difficults = itertools.repeat(None)
+
+        for pred_bbox, pred_label, pred_score, gt_bbox, gt_label, gt_difficult in \
+                six.moves.zip(
+                    pred_bboxes, pred_labels, pred_scores,
+                    gt_bboxes, gt_labels, gt_difficults):
+            self.add(pred_bbox, pred_label, pred_score, gt_bbox, gt_label, gt_difficult)
+
+    def prec_rec(self):
+        """Precision and recall of every class for every threshold.
+
+        Returns:
+            tuple of two lists: :obj:`prec[t]` and :obj:`rec[t]` are the same as
+            what :func:`calc_detection_voc_prec_rec` returns for :obj:`iou_threshs[t]`.
+
+        """
+        n_thresh = len(self.iou_threshs)
+        n_fg_class = max(self.n_pos.keys()) + 1 if self.n_pos else 0
+        prec = [[None] * n_fg_class for _ in range(n_thresh)]
+        rec = [[None] * n_fg_class for _ in range(n_thresh)]
+
+        for l in self.n_pos.keys():
+            if self.score[l]:
+                score_l = np.concatenate(self.score[l])
+                match_l = np.concatenate(self.match[l])
+            else:
+                score_l = np.zeros([0], dtype=np.float32)
+                match_l = np.zeros([0, n_thresh], dtype=np.int8)
+
+            order = score_l.argsort()[::-1]
+            match_l = match_l[order]
+
+            tp = np.cumsum(match_l == 1, axis=0)
+            fp = np.cumsum(match_l == 0, axis=0)
+
+            with np.errstate(divide='ignore', invalid='ignore'):
+                prec_l = tp / (fp + tp)
+
+            for t in range(n_thresh):
+                # If an element of fp + tp is 0,
+                # the corresponding element of prec[t][l] is nan.
+                prec[t][l] = prec_l[:, t]
+                # If n_pos[l] is 0, rec[t][l] is None.
+                if self.n_pos[l] > 0:
+                    rec[t][l] = tp[:, t] / self.n_pos[l]
+
+        return prec, rec
+
+    def evaluate(self):
+        """Average precisions for every threshold.
+
+        Returns:
+            list of dict: one ``{'ap': ap, 'map': map}`` for each of :obj:`iou_threshs`,
+            same as what :func:`eval_detection_voc` returns.
+
+        """
+        results = []
+        for prec, rec in zip(*self.prec_rec()):
+            ap = calc_detection_voc_ap(prec, rec, use_07_metric=self.use_07_metric)
+            results.append({'ap': ap, 'map': np.nanmean(ap)})
+
+        return results
+
+
+def _add_batch(args):
+    accumulator, batch = args
+    accumulator.add_batch(*batch)
+    return accumulator
+
+
+class ParallelAccumulator(object):
+    """Shards the matching of an accumulator across a process pool.
+
+    Every :meth:`add_batch` is sent to a worker with an empty copy of the accumulator,
+    the partial accumulators are merged back in submission order, so the result is
+    identical to adding all batches serially. Works with :class:`VOCAccumulator` and
+    :class:`utils.eval_metrics.eval_coco.COCOAccumulator`.
+
+    Args:
+        accumulator: the accumulator to fill, must provide ``empty``, ``merge`` and ``add_batch``.
+        num_workers (int): number of processes, 0 runs in the current process.
+
+    Example:
+        parallel = ParallelAccumulator(VOCAccumulator(), num_workers=8)
+        for sample in dataloader:
+            parallel.add_batch(pred_bboxes, pred_labels, pred_scores, gt_bboxes, gt_labels)
+
+        results = parallel.result().evaluate()
+
+    The pool is released by :meth:`result`, use it as a context manager (or call
+    :meth:`close`) so that the workers are also terminated when the evaluation fails.
+
+    """
+
+    def __init__(self, accumulator, num_workers=0):
+        self.accumulator = accumulator
+        self.num_workers = num_workers
+        self.pool = multiprocessing.Pool(num_workers) if num_workers > 0 else None
+        self.pending = deque()
+
+    def add_batch(self, *batch):
+        if self.pool is None:
+            self.accumulator.add_batch(*batch)
+            return
+
+        self.pending.append(self.pool.apply_async(_add_batch, ((self.accumulator.empty(), batch),)))
+
+        # 最多积压 4 × num_workers 个batch, 按顺序合并最早的
+        while len(self.pending) > 4 * self.num_workers:
+            self.accumulator.merge(self.pending.popleft().get())
+
+    def result(self):
+        """Wait for all workers, merge and return the filled accumulator."""
+        while self.pending:
+            self.accumulator.merge(self.pending.popleft().get())
+
+        if self.pool is not None:
+            self.pool.close()
+            self.pool.join()
+            self.pool = None
+
+        return self.accumulator
+
+    def close(self):
+        """Terminate the workers without waiting for pending batches."""
+        if self.pool is not None:
+            self.pool.terminate()
+            self.pool.join()
+            self.pool = None
+        self.pending.clear()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
@@ -0,0 +1,75 @@
+# encoding=utf-8
+"""
+Yolo系列解码时用到的网格和anchor, 按(形状, device, dtype)缓存, 多尺度推理时不用每次重新生成.
+
+Example:
+    grid = get_grid(ny, nx, x.device, x.dtype)  # [ny, nx, 2], grid[y, x] = (x, y)
+    anchors = get_anchors([10, 13, 16, 30, 33, 23], x.device, x.dtype)  # [3, 2]
+
+"""
+from collections import OrderedDict
+
+import torch
+
+
+class TensorCache(object):
+    """LRU cache of tensors, the least recently used one is dropped when there are more than maxsize tensors.
+
+    Args:
+        maxsize(int): max number of cached tensors
+
+    """
+    def __init__(self, maxsize=32):
+        self.maxsize = maxsize
+        self.cache = OrderedDict()
+
+    def get(self, key, make):
+        """Return the tensor of key, make() is called to create it when it is not cached."""
+        if key in self.cache:
+            self.cache.move_to_end(key)
+            return self.cache[key]
+
+        tensor = make()
+        self.cache[key] = tensor
+        if len(self.cache) > self.maxsize:
+            self.cache.popitem(last=False)
+        return tensor
+
+    def clear(self):
+        self.cache.clear()
+
+    def __len__(self):
+        return len(self.cache)
+
+
+_grids = TensorCache()
+_anchors = TensorCache()
+
+
+def get_grid(ny, nx, device, dtype=torch.float32):
+    """Cell offsets of a feature map.
+
+    Returns:
+        Tensor: [ny, nx, 2], grid[y, x] = (x, y)
+
+    """
+    def make():
+        yv, xv = torch.meshgrid([torch.arange(ny, device=device), torch.arange(nx, device=device)])
+        return torch.stack((xv, yv), 2).to(dtype)
+
+    return _grids.get((ny, nx, str(device), dtype), make)
+
+
+def get_anchors(anchors, device, dtype=torch.float32):
+    """Anchors given as a flat list [w0, h0, w1, h1, ...].
+
+    Returns:
+        Tensor: [num_anchors, 2]
+
+    """
+    anchors = tuple(float(a) for a in anchors)
+
+    def make():
+        return torch.tensor(anchors, dtype=dtype, device=device).view(-1, 2)
+
+    return _anchors.get((anchors, str(device), dtype), make)
@@ -0,0 +1,223 @@
+# encoding=utf-8
+"""
+所有检测模型共用的后处理: 阈值过滤 + 整个batch一次NMS + top-k.
+
+Example:
+    # boxes: [B, N, 4] xyxy, scores: [B, N, C]
+    batch_bboxes, batch_labels, batch_scores = postprocess(boxes, scores, conf_thresh=0.01, nms_thresh=0.45)
+
+    # 模型的默认参数 + --postprocess profile + 命令行参数
+    cfg = get_postprocess_config(opt, conf_thresh=0.001, nms_thresh=0.65, max_per_image=300)
+    batch_bboxes, batch_labels, batch_scores = cfg(boxes, scores)
+
+"""
+import numpy as np
+import torch
+from torchvision.ops.boxes import batched_nms
+
+
+def postprocess(boxes, scores, conf_thresh=0.01, nms_thresh=0.45, max_per_image=100, multi_label=True, agnostic=False,
+                pre_nms_topk=None):
+    """Threshold, NMS and top-k for a batch, NMS of all images and classes is done in one call.
+
+    Args:
+        boxes(Tensor): [B, N, 4] xyxy boxes, or [B, N, C, 4] one box for each class
+        scores(Tensor): [B, N, C] score of each class (multiplied by objectness if any)
+        conf_thresh(float): boxes with score <= conf_thresh are dropped
+        nms_thresh(float): IoU threshold of NMS
+        max_per_image(int): keep at most this many boxes of every image, None or <= 0 for no limit
+        multi_label(bool): a box can be kept for several classes, otherwise only for its best class
+        agnostic(bool): class-agnostic NMS
+        pre_nms_topk(int): keep at most this many boxes (highest class score) of every image before thresholding and NMS
+
+    Returns:
+        tuple: (batch_bboxes, batch_labels, batch_scores), same as BaseModel.forward
+
+    """
+    boxes, scores = select_topk(boxes, scores, pre_nms_topk)
+    batch_size, num_boxes, num_classes = scores.shape
+
+    if multi_label:
+        batch_idx, box_idx, labels = (scores > conf_thresh).nonzero(as_tuple=True)
+        cand_scores = scores[batch_idx, box_idx, labels]
+    else:
+        max_scores, max_labels = scores.max(2)
+        batch_idx, box_idx = (max_scores > conf_thresh).nonzero(as_tuple=True)
+        labels = max_labels[batch_idx, box_idx]
+        cand_scores = max_scores[batch_idx, box_idx]
+
+    if boxes.dim() == 4:  # 每个类别有单独的box
+        cand_boxes = boxes[batch_idx, box_idx, labels]
+    else:
+        cand_boxes = boxes[batch_idx, box_idx]
+
+    cand_boxes = cand_boxes.float()
+    cand_scores = cand_scores.float()
+
+    # 不同图片、不同类别的box加上不同的偏移量, 一次NMS处理整个batch
+    groups = batch_idx if agnostic else batch_idx * num_classes + labels
+    keep = batched_nms(cand_boxes, cand_scores, groups, nms_thresh)  # 按分数从高到低
+
+    if max_per_image is not None and max_per_image > 0:
+        keep = keep[topk_per_image(batch_idx[keep], batch_size, max_per_image)]
+
+    return split_batch(cand_boxes[keep], labels[keep], cand_scores[keep], batch_idx[keep], batch_size)
+
+
+# 每种部署场景对模型默认参数的修改, 命令行中指定的参数优先级最高
+PROFILES = {
+    'eval': {},  # 计算mAP, 使用模型的默认参数
+    'fast': dict(conf_thresh=0.25, max_per_image=100, multi_label=False, pre_nms_topk=1000),  # 线上推理
+}
+
+
+class PostprocessConfig(object):
+    """Parameters of postprocess() (and of box fusion) used by Model.forward.
+
+    Args:
+        conf_thresh(float): boxes with score <= conf_thresh are dropped
+        nms_thresh(float): IoU threshold of NMS
+        max_per_image(int): keep at most this many boxes of every image, None for no limit
+        multi_label(bool): a box can be kept for several classes
+        agnostic(bool): class-agnostic NMS
+        pre_nms_topk(int): candidates kept per feature level and per image before decode and NMS
+        box_fusion(str): 'nms' or 'wbf'
+        wbf_thresh(float): IoU threshold of weighted boxes fusion
+
+    """
+    def __init__(self, conf_thresh=0.01, nms_thresh=0.45, max_per_image=100, multi_label=True, agnostic=False,
+                 pre_nms_topk=None, box_fusion='nms', wbf_thresh=0.5):
+        self.conf_thresh = conf_thresh
+        self.nms_thresh = nms_thresh
+        self.max_per_image = max_per_image
+        self.multi_label = multi_label
+        self.agnostic = agnostic
+        self.pre_nms_topk = pre_nms_topk
+        self.box_fusion = box_fusion
+        self.wbf_thresh = wbf_thresh
+
+    def update(self, **kwargs):
+        """Set the given parameters, None values are ignored."""
+        for k, v in kwargs.items():
+            if not hasattr(self, k):
+                raise KeyError(f'Unknown postprocess parameter: {k}')
+            if v is not None:
+                setattr(self, k, v)
+        return self
+
+    def __call__(self, boxes, scores):
+        return postprocess(boxes, scores, conf_thresh=self.conf_thresh, nms_thresh=self.nms_thresh,
+                           max_per_image=self.max_per_image, multi_label=self.multi_label, agnostic=self.agnostic,
+                           pre_nms_topk=self.pre_nms_topk)
+
+    def __repr__(self):
+        return 'PostprocessConfig(' + ', '.join(f'{k}={v}' for k, v in self.__dict__.items()) + ')'
+
+
+def get_postprocess_config(opt, **defaults):
+    """Post-processing parameters of a model.
+
+    Args:
+        opt: parsed options, uses opt.postprocess (profile name) and the test time bbox settings
+            (opt.conf_thresh, opt.nms_thresh, opt.max_per_image, opt.pre_nms_topk, opt.box_fusion, opt.wbf_thresh)
+        **defaults: default parameters of the model, see PostprocessConfig
+
+    Returns:
+        PostprocessConfig: defaults < profile < options given in the command line
+
+    """
+    profile = getattr(opt, 'postprocess', 'eval')
+    if profile not in PROFILES:
+        raise ValueError(f'Unknown postprocess profile: {profile}, must be one of {list(PROFILES)}')
+
+    cfg = PostprocessConfig(**defaults)
+    cfg.update(**PROFILES[profile])
+
+    cfg.update(**{k: getattr(opt, k, None) for k in
+                  ['conf_thresh', 'nms_thresh', 'max_per_image', 'pre_nms_topk', 'box_fusion', 'wbf_thresh']})
+    return cfg
+
+
+def select_topk(boxes, scores, k):
+    """Keep the k boxes with the highest class score of every image.
+
+    Args:
+        boxes(Tensor): [B, N, ...] boxes
+        scores(Tensor): [B, N, C] or [B, N] scores
+        k(int): number of boxes to keep, None or <= 0 for keeping all
+
+    Returns:
+        tuple: (boxes [B, k, ...], scores [B, k, C] or [B, k])
+
+    """
+    num_boxes = scores.shape[1]
+    if k is None or k <= 0 or k >= num_boxes:
+        return boxes, scores
+
+    max_scores = scores.max(2)[0] if scores.dim() == 3 else scores
+    _, indices = max_scores.topk(k, dim=1)
+
+    return gather_boxes(boxes, indices), gather_boxes(scores, indices)
+
+
+def gather_boxes(x, indices):
+    """x[b, indices[b]] for every image, x: [B, N, ...], indices: [B, k]"""
+    index = indices.view(indices.shape + (1,) * (x.dim() - 2)).expand(indices.shape + x.shape[2:])
+    return x.gather(1, index)
+
+
+def topk_per_image(batch_idx, batch_size, k):
+    """Select the first k detections of every image, detections are grouped by image (keeping their order).
+
+    Args:
+        batch_idx(Tensor): [M] image index of every detection, detections sorted by score
+        batch_size(int): number of images
+        k(int): detections kept for every image
+
+    Returns:
+        Tensor: [M'] indices of the kept detections, grouped by image
+
+    """
+    m = len(batch_idx)
+    positions = torch.arange(m, device=batch_idx.device)
+    # 按图片分组, 每组内保持原来的顺序
+    order = (batch_idx * m + positions).argsort()
+
+    counts = torch.bincount(batch_idx, minlength=batch_size)
+    starts = torch.cumsum(counts, 0) - counts
+    rank = positions - starts[batch_idx[order]]
+    return order[rank < k]
+
+
+def split_batch(boxes, labels, scores, batch_idx, batch_size):
+    """Copy detections of the whole batch to the host at once and split them by image.
+
+    Args:
+        boxes(Tensor): [M, 4]
+        labels(Tensor): [M]
+        scores(Tensor): [M]
+        batch_idx(Tensor): [M] image index of every detection
+        batch_size(int): number of images
+
+    Returns:
+        tuple: (batch_bboxes, batch_labels, batch_scores), same as BaseModel.forward
+
+    """
+    detections = torch.cat([boxes.float(), scores.float()[:, None], labels.float()[:, None],
+                            batch_idx.float()[:, None]], dim=1).detach().cpu().numpy()
+
+    batch_idx = detections[:, 6].astype(np.int64)
+    order = np.argsort(batch_idx, kind='stable')
+    detections = detections[order]
+    bounds = np.searchsorted(batch_idx[order], np.arange(batch_size + 1))
+
+    batch_bboxes = []
+    batch_labels = []
+    batch_scores = []
+    for i in range(batch_size):
+        d = detections[bounds[i]: bounds[i + 1]]
+        batch_bboxes.append(d[:, :4])
+        batch_scores.append(d[:, 4])
+        batch_labels.append(d[:, 5].astype(np.int32))
+
+    return batch_bboxes, batch_labels, batch_scores